@@ -0,0 +1,78 @@
+"""
+Row-band threading for the pointwise stages of a single frame.
+
+NumPy ufuncs, fancy-index table lookups and OpenCV release the GIL, so a
+per-pixel stage split into horizontal bands runs on several cores from a
+thread pool. Each band writes into its slice of one preallocated output,
+and its temporaries are band-sized instead of frame-sized.
+
+Off by default (one thread): batch.py already runs one frame per core.
+set_threads() turns it on for single-frame latency, e.g. in watch.py with
+fewer workers than cores.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+MIN_BAND_SIZE = 1 << 18   # elements; smaller bands cost more in dispatch than they gain
+
+_threads = 1
+_pool = None
+
+
+def set_threads(n: int = None):
+    """Threads for banded stages in this process; 0 or None: one per core."""
+    global _threads, _pool
+    n = max(1, n or os.cpu_count() or 1)
+    if n != _threads and _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+    _threads = n
+
+
+def threads() -> int:
+    return _threads
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=_threads, thread_name_prefix="bands")
+    return _pool
+
+
+def row_bands(height: int, row_size: int = 1):
+    """(y0, y1) bands covering height rows of row_size elements, one per thread, none under MIN_BAND_SIZE."""
+    n = max(1, min(_threads, height * row_size // MIN_BAND_SIZE))
+    edges = np.linspace(0, height, n + 1).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def run(fn, height: int, row_size: int = 1):
+    """Call fn(y0, y1) for each row band, on the pool when there is more than one."""
+    bands = row_bands(height, row_size)
+    if len(bands) == 1:
+        return [fn(*bands[0])]
+    return list(_executor().map(lambda band: fn(*band), bands))
+
+
+def pointwise(fn, image: np.ndarray, out: np.ndarray = None, shape=None, dtype=None) -> np.ndarray:
+    """
+    fn applied to row bands of image and written into out (allocated with
+    shape and dtype if not given, by default those of image). fn must treat
+    each pixel on its own, so the result equals fn(image). With one thread
+    fn(image) is returned as it is.
+    """
+    h = len(image)
+    row_size = image.size // max(h, 1)
+    if out is None and len(row_bands(h, row_size)) == 1:
+        return fn(image)
+    if out is None:
+        out = np.empty(image.shape if shape is None else shape, dtype=image.dtype if dtype is None else dtype)
+
+    def band(y0, y1):
+        out[y0:y1] = fn(image[y0:y1])
+
+    run(band, h, row_size)
+    return out
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Parallel batch conversion of a folder of scanned negatives.
+
+Python replacement for the invert_folder.bat loop: every frame runs the
+in-process pipeline (see pipeline.py) in a pool of worker processes.
+Same skip rules as the batch file: names already containing `_inverted`
+and frames whose `<name>_inverted.png` exists are left alone, and of scans
+sharing a name (f2.jpg, f2.png) only the first in the batch file's order
+(.jpg, then .png) is converted, since both would write f2_inverted.png. With
+--journal a progress journal decides instead, so an interrupted job resumes
+where it stopped (see journal.py).
+
+With --async-write each worker hands its positive to a writer thread
+(image_io.AsyncWriter) and starts on the next frame while it is encoded; a
+frame is reported once its write has finished.
+"""
+import argparse
+import glob
+import json
+import os
+import queue
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+IMAGE_EXTENSIONS = (".jpg", ".png", ".tif", ".tiff")
+
+
+def collect_images(inputs):
+    """Expand folders, glob patterns and plain file names into a sorted list of images."""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for name in sorted(os.listdir(item)):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(item, name))
+        elif glob.has_magic(item):
+            paths.extend(p for p in sorted(glob.glob(item)) if p.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.append(item)
+    # keep order, drop duplicates
+    return list(dict.fromkeys(paths))
+
+
+def skip_reason(image_path: str, out_path: str = None):
+    """Return why a frame is skipped, or None if it must be processed (out_path: skip if it exists)."""
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    if "_inverted" in name.lower():
+        return 'filename already contains "_inverted"'
+    if name.lower().endswith("_preview"):
+        return "preview written by progressive.py"
+    if out_path and os.path.exists(out_path):
+        return f"{out_path} already exists"
+    return None
+
+
+def extension_rank(image_path: str) -> int:
+    """Position of the file's extension in IMAGE_EXTENSIONS (invert_folder.bat takes .jpg before .png)."""
+    ext = os.path.splitext(image_path)[1].lower()
+    return IMAGE_EXTENSIONS.index(ext) if ext in IMAGE_EXTENSIONS else len(IMAGE_EXTENSIONS)
+
+
+def output_key(out_path: str) -> str:
+    return os.path.normcase(os.path.abspath(out_path))
+
+
+def claim_outputs(image_paths, out_paths) -> dict:
+    """
+    Output key (output_key) -> the input that writes it, the first by
+    extension_rank of the inputs mapped to the same output.
+    """
+    claims = {}
+    for image_path, out_path in sorted(zip(image_paths, out_paths), key=lambda item: extension_rank(item[0])):
+        claims.setdefault(output_key(out_path), image_path)
+    return claims
+
+
+writer = None   # this worker's image_io.AsyncWriter with --async-write
+
+
+def _init_worker(written=None):
+    # One OpenCV thread per worker, the pool already uses every core.
+    import cv2
+    cv2.setNumThreads(1)
+    init_writer(written)
+
+
+def init_writer(written=None):
+    """Start this worker's writer thread; its records go to the `written` queue."""
+    global writer
+    if written is not None and writer is None:
+        import image_io
+        writer = image_io.AsyncWriter(on_done=written.put)
+
+
+def _run_frame(image_path: str, options: dict, journal_dir: str = None, analysis: dict = None):
+    import pipeline
+    start = time.perf_counter()
+    on_analysis = None
+    if journal_dir and analysis is None:
+        import journal
+        progress = journal.Journal(journal_dir, options)
+        on_analysis = lambda result: progress.record_analysis(image_path, result)  # noqa: E731
+    result = pipeline.process_file(image_path, writer=writer, durable=journal_dir is not None, analysis=analysis,
+                                   on_analysis=on_analysis, **options)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+class WriteTracker:
+    """
+    Pairs the results of pool workers with the records of their writer
+    threads (--async-write): a frame is complete once both have arrived.
+    Write records come back through a multiprocessing queue given to every
+    worker in its initializer.
+    """
+
+    def __init__(self):
+        import multiprocessing
+        self.written = multiprocessing.Queue()
+        self.waiting = {}   # image_path -> result or write record, whichever came first
+
+    def add(self, result: dict):
+        """A worker result: returned as complete unless its write is still pending."""
+        if not result.pop("async_write", False):
+            return result
+        return self._pair(result, is_write=False)
+
+    def poll(self, timeout: float = 0):
+        """Results whose writes finished, waiting up to timeout for the first one."""
+        done = []
+        try:
+            record = self.written.get(timeout=timeout) if timeout else self.written.get_nowait()
+            while True:
+                result = self._pair(record, is_write=True)
+                if result:
+                    done.append(result)
+                record = self.written.get_nowait()
+        except queue.Empty:
+            pass
+        return done
+
+    def _pair(self, item: dict, is_write: bool):
+        other = self.waiting.pop(item["image_path"], None)
+        if other is None:
+            self.waiting[item["image_path"]] = item
+            return None
+        result, record = (other, item) if is_write else (item, other)
+        result.update(record)
+        return result
+
+
+def run_batch(image_paths, workers: int = None, options: dict = None, async_write: bool = False,
+              journal_dir: str = None):
+    """
+    Process frames in a process pool. options are passed to
+    pipeline.process_file. Yields one result dict per frame as it finishes;
+    failed frames carry an 'error' key, skipped ones a 'skipped' key.
+    async_write overlaps the encoding of each frame with the processing of
+    the worker's next one.
+    With journal_dir the job's progress is kept in a journal (see journal.py)
+    instead of relying on existing outputs: frames it records as done are
+    skipped, analysed ones are inverted without a new analysis, and every
+    output is fsynced before it is recorded.
+    """
+    import pipeline
+
+    options = options or {}
+    first_output = 1 if options.get("strip") else None   # strip captures: <name>_inverted_1.png
+    progress = None
+    if journal_dir:
+        import journal
+        progress = journal.Journal(journal_dir, options)
+        changed = progress.changed_options(options)
+        if changed:
+            print(f"Warning: the journal in {journal_dir} was written with other options ({', '.join(changed)});"
+                  f" frames it records as done are converted again", file=sys.stderr)
+        progress.write_manifest(options, len(image_paths))
+    todo = []
+    analyses = {}
+    out_paths = {path: pipeline.output_path_for(path, first_output, options.get("output_format", "png"))
+                 for path in image_paths}
+    # inputs sharing an output would write it at the same time in the pool
+    candidates = [path for path in image_paths if not skip_reason(path)]
+    claims = claim_outputs(candidates, [out_paths[path] for path in candidates])
+    for image_path in image_paths:
+        out_path = out_paths[image_path]
+        owner = claims.get(output_key(out_path), image_path)
+        claimed = f"output claimed by {owner}" if owner != image_path else None
+        if progress:
+            state, analysis = progress.plan(image_path)
+            reason = skip_reason(image_path) or claimed or ("done in journal" if state == "done" else None)
+            if state == "analysed":
+                analyses[image_path] = analysis
+            if not reason:
+                journal.remove_partials(out_path)
+        else:
+            reason = skip_reason(image_path) or claimed or skip_reason(image_path, out_path)
+        if reason:
+            yield {"image_path": image_path, "skipped": reason}
+        else:
+            todo.append(image_path)
+    if not todo:
+        return
+    if progress:
+        print(f"Journal: {len(analyses)} analysed frames resume at inversion", file=sys.stderr)
+    for result in _run_pool(todo, workers, options, async_write, journal_dir, analyses):
+        if progress and "error" not in result:
+            try:
+                progress.record_done(result["image_path"], result)
+            except OSError as e:
+                result = dict(result, error=f"Couldn’t record {result['image_path']} in the journal: {e}")
+        yield result
+
+
+def _run_pool(todo, workers, options, async_write, journal_dir, analyses):
+    def submit(pool, path):
+        return pool.submit(_run_frame, path, options, journal_dir, analyses.get(path))
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(todo)))
+    if not async_write:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = {submit(pool, path): path for path in todo}
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except Exception as e:
+                    yield {"image_path": futures[future], "error": str(e)}
+        return
+
+    tracker = WriteTracker()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(tracker.written,)) as pool:
+        pending = {submit(pool, path): path for path in todo}
+        remaining = len(todo)
+        while remaining:
+            finished = []
+            if pending:
+                done, _ = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    try:
+                        result = tracker.add(future.result())
+                    except Exception as e:
+                        result = {"image_path": path, "error": str(e)}
+                    if result:
+                        finished.append(result)
+            finished += tracker.poll(timeout=0 if pending else 0.05)
+            for result in finished:
+                remaining -= 1
+                yield result
+
+
+def main():
+    import pipeline
+
+    p = argparse.ArgumentParser(
+        description="Convert a folder (or glob / list) of scanned negatives using all CPU cores.")
+    p.add_argument("inputs", nargs="+", help="Folders, glob patterns or image files")
+    p.add_argument("-j", "--workers", type=int, default=None,
+                   help="Worker processes (default: number of CPU cores)")
+    p.add_argument("--autocontrast", action="store_true", help="Apply auto contrast after white balance")
+    p.add_argument("--profile", help="Roll profile JSON from roll_profile.py (shared blend colour / white balance)")
+    p.add_argument("--analysis-size", type=int, default=None,
+                   help="Run crop/skew analysis on a proxy with this longest edge in pixels (e.g. 1500)")
+    p.add_argument("--tile-mb", type=float, default=None,
+                   help="Analyse, crop and invert in strips within this memory budget in MB (for very large scans)")
+    pipeline.add_timing_arguments(p)
+    pipeline.add_cache_arguments(p)
+    pipeline.add_strip_arguments(p)
+    pipeline.add_warp_arguments(p)
+    pipeline.add_output_arguments(p)
+    pipeline.add_thread_arguments(p)
+    p.add_argument("--async-write", action="store_true",
+                   help="Encode each output in a writer thread while the worker processes its next frame")
+    p.add_argument("--journal", metavar="DIR",
+                   help="Keep the job's progress in this folder; re-running the same command resumes it")
+    p.add_argument("--timings-summary", metavar="JSON",
+                   help="Save the per-stage summary of the roll to this file (implies --timings)")
+    args = p.parse_args()
+    args.timings = args.timings or bool(args.timings_summary)
+
+    options = {"autocontrast": args.autocontrast, "analysis_size": args.analysis_size, "tile_mb": args.tile_mb}
+    options.update(pipeline.timing_options(args))
+    options.update(pipeline.cache_options(args))
+    options.update(pipeline.strip_options(args))
+    options.update(pipeline.warp_options(args))
+    options.update(pipeline.output_options(args))
+    options["threads"] = args.threads
+    if args.profile:
+        import roll_profile
+        options["profile"] = roll_profile.load_profile(args.profile)
+
+    image_paths = collect_images(args.inputs)
+    start = time.perf_counter()
+    done = failed = skipped = 0
+    megapixels = 0.0
+    encode_seconds = 0.0
+    timed_results = []
+    for result in run_batch(image_paths, workers=args.workers, options=options, async_write=args.async_write,
+                            journal_dir=args.journal):
+        if "skipped" in result:
+            skipped += 1
+            print(f"   Skipping: {result['image_path']}: {result['skipped']}", file=sys.stderr)
+            continue
+        if "error" in result:
+            failed += 1
+            print(json.dumps(result), file=sys.stderr)
+            continue
+        done += 1
+        w, h = result["input_size"]
+        megapixels += w * h / 1e6
+        encode = result.get("encode_seconds", sum(f.get("encode_seconds", 0) for f in result.get("frames", ())))
+        encode_seconds += encode
+        print(f"   Done: {result['image_path']} in {result['seconds']:.2f} s"
+              f" (encode {encode:.2f} s{', async' if args.async_write else ''})", file=sys.stderr)
+        print(json.dumps(result))
+        if "timings" in result:
+            timed_results.append(result)
+    elapsed = time.perf_counter() - start
+
+    print(f"=== {done} processed, {skipped} skipped, {failed} failed in {elapsed:.2f} s"
+          f" ({done / elapsed if elapsed else 0:.2f} frames/s,"
+          f" {megapixels / elapsed if elapsed else 0:.1f} MP/s, {encode_seconds:.2f} s encoding) ===",
+          file=sys.stderr)
+    if timed_results:
+        import instrument
+        summary = instrument.summarize(timed_results)
+        print(instrument.format_summary(summary), file=sys.stderr)
+        if args.timings_summary:
+            with open(args.timings_summary, 'w') as sf:
+                json.dump(summary, sf, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
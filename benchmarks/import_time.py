@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Cold-start cost of the neg2pos modules and command-line tools.
+
+Each module is imported in a fresh interpreter with `python -X importtime`
+and its cumulative import time is read from the report, together with its
+heaviest direct dependencies. Each CLI is also started with --help to time
+the whole interpreter start. The best of --repeat runs is kept; results go
+to JSON (-o) and --compare prints the change against an earlier file.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ("shape_image", "invert_image", "pipeline", "batch", "watch", "tiled", "roll_profile")
+SCRIPTS = ("shape_image.py", "invert_image.py", "pipeline.py", "batch.py")
+
+
+def parse_importtime(report: str):
+    """[(name, depth, cumulative µs)] in report order from a -X importtime report."""
+    entries = []
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((name.strip(), depth, int(cumulative)))
+    return entries
+
+
+def import_time(module: str, repeat: int = 5) -> dict:
+    """Best cumulative import time of a module in a fresh interpreter, and its heaviest dependencies."""
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                              cwd=REPO, capture_output=True, text=True, check=True)
+        entries = parse_importtime(proc.stderr)
+        index = max(i for i, (name, depth, _) in enumerate(entries) if name == module and depth == 0)
+        if best is None or entries[index][2] < best[0]:
+            best = (entries[index][2], entries[:index])
+    total, before = best
+    # the module's own imports are the depth-1 entries right before it
+    deps = []
+    for name, depth, us in reversed(before):
+        if depth == 0:
+            break
+        if depth == 1:
+            deps.append((name, us))
+    deps.sort(key=lambda d: -d[1])
+    return {"kind": "import", "module": module, "seconds": round(total / 1e6, 4),
+            "heaviest": [[name, round(us / 1e6, 4)] for name, us in deps[:5]]}
+
+
+def cli_start_time(script: str, repeat: int = 5) -> dict:
+    """Best wall time of `python <script> --help`."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script, "--help"], cwd=REPO, capture_output=True, check=True)
+        best = min(best, time.perf_counter() - start)
+    return {"kind": "cli", "script": script, "seconds": round(best, 4)}
+
+
+def run(repeat: int = 5):
+    """Yields one record per module import and one per CLI start."""
+    for module in MODULES:
+        yield import_time(module, repeat)
+    for script in SCRIPTS:
+        yield cli_start_time(script, repeat)
+
+
+def describe(r: dict) -> str:
+    if r["kind"] == "import":
+        heaviest = ", ".join(f"{name} {s * 1000:.0f} ms" for name, s in r["heaviest"][:3])
+        return f"import {r['module']:<14} {r['seconds'] * 1000:7.1f} ms   ({heaviest})"
+    return f"{r['script']} --help{'':<{18 - len(r['script'])}} {r['seconds'] * 1000:7.1f} ms"
+
+
+def _key(r: dict):
+    return r["kind"], r.get("module") or r.get("script")
+
+
+def compare(results: list, baseline_path: str):
+    """Print each time against an earlier results file."""
+    with open(baseline_path, 'r') as bf:
+        before = {_key(r): r["seconds"] for r in json.load(bf)["results"]}
+    print(f"\nAgainst {baseline_path}:")
+    for r in results:
+        old = before.get(_key(r))
+        if old:
+            print(f"{_key(r)[1]:<18} {old * 1000:7.1f} ms -> {r['seconds'] * 1000:7.1f} ms  x{old / r['seconds']:.2f}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Measure import and CLI start-up times of neg2pos.")
+    p.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per measurement (default: 5)")
+    p.add_argument("-o", "--output", default="import_times.json", help="Results JSON (default: import_times.json)")
+    p.add_argument("--compare", help="Earlier results JSON to compare against")
+    args = p.parse_args()
+
+    results = []
+    for r in run(args.repeat):
+        results.append(r)
+        print(describe(r), flush=True)
+    with open(args.output, 'w') as of:
+        json.dump({"python": sys.version.split()[0], "results": results}, of, indent=1)
+    print(f"Results saved as {args.output}", file=sys.stderr)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
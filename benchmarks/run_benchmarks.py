@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Benchmark every shape_image / invert_image stage and the full pipeline on
+synthetic negatives of 12, 24, 45 and 100 MP.
+
+For each frame size and stage the best wall time over --repeat runs, the
+throughput in MP/s of input and the peak Python-side allocation (tracemalloc,
+which sees NumPy and OpenCV output arrays but not OpenCV's internal scratch
+buffers) are recorded. The analysis of each synthetic frame is checked against
+its ground truth (crop rectangle, skew angle, blend colour) so that a faster
+stage cannot silently change the result.
+
+Results are written as JSON (-o); --compare prints the speed-up against an
+earlier results file. Exit status is 1 if any accuracy check fails.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bands  # noqa: E402
+import image_io  # noqa: E402
+import invert_image  # noqa: E402
+import pipeline  # noqa: E402
+import shape_image  # noqa: E402
+import synth  # noqa: E402
+
+DEFAULT_SIZES = (12, 24, 45, 100)
+PROXY_SIZE = 1500
+STACK_FRAMES = 64  # contact-sheet proxies of 300 px for the *_stack stages
+
+
+def _quiet():
+    """The stages log to stderr; keep that out of the benchmark output."""
+    return contextlib.redirect_stderr(io.StringIO())
+
+
+def prepare(img: np.ndarray) -> dict:
+    """Run the pipeline once and keep every intermediate the stages take as input."""
+    ctx = {"img": img}
+    with _quiet():
+        rgb = shape_image.remove_perforation(img.copy())
+        ref = shape_image.mean_rgb_of_top_percent_full(rgb, 3)
+        norm = shape_image.normalize_to_reference(rgb, ref)
+        rebate, rebate_thresh, rx, ry, rw, rh = shape_image.get_rebate_crop(norm, pct=90)
+        _, crop_rect, angle = shape_image.analyze_frame(rgb, ref_rgb=ref)
+        cropped = shape_image.apply_crop_and_deskew(rgb, crop_rect, angle)
+        inverted = invert_image.invert_image(invert_image.divide_blend(cropped, ref))
+        balanced = invert_image.enhanced_white_balance(inverted, 99.99, 0.1)
+        thumb = cv2.resize(cropped, (300, 300 * cropped.shape[0] // cropped.shape[1]), interpolation=cv2.INTER_AREA)
+        proxies = np.stack([thumb] * STACK_FRAMES)
+    ctx.update(rgb=rgb, ref=ref, norm=norm, rebate=rebate, rebate_thresh=rebate_thresh,
+               crop_rect=crop_rect, angle=angle, cropped=cropped, inverted=inverted, balanced=balanced,
+               proxies=proxies)
+    return ctx
+
+
+def full_frame_deskew(rgb, crop_rect, angle):
+    """The former apply_crop_and_deskew: rotate the whole frame, then slice the crop."""
+    x, y, w, h = crop_rect
+    white = image_io.max_value(rgb)
+    M = cv2.getRotationMatrix2D((rgb.shape[1] / 2.0, rgb.shape[0] / 2.0), angle, 1.0)
+    rotated = cv2.warpAffine(rgb, M, (rgb.shape[1], rgb.shape[0]), flags=cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=(white, white, white))
+    return rotated[y:y+h, x:x+w]
+
+
+def stages(tmpdir: str):
+    """
+    (name, make_args, function). make_args builds the arguments from the
+    prepared context; it runs outside the timed region, so stages that modify
+    their input get a fresh copy each time.
+    """
+    png_path = os.path.join(tmpdir, "bench.png")
+    return [
+        ("shape_image.remove_perforation", lambda c: (c["img"].copy(),), shape_image.remove_perforation),
+        ("shape_image.remove_perforation[full frame]", lambda c: (c["img"].copy(),),
+         lambda rgb: shape_image.remove_perforation(rgb, fast=False)),
+        ("shape_image.compute_brightness", lambda c: (c["rgb"],), shape_image.compute_brightness),
+        ("shape_image.mean_rgb_of_top_percent_full", lambda c: (c["rgb"], 3),
+         shape_image.mean_rgb_of_top_percent_full),
+        ("shape_image.normalize_to_reference", lambda c: (c["rgb"], c["ref"]), shape_image.normalize_to_reference),
+        ("shape_image.get_rebate_crop", lambda c: (c["norm"], 90), shape_image.get_rebate_crop),
+        ("shape_image.crop_inner_and_find_bright", lambda c: (c["rebate"], c["rebate_thresh"]),
+         shape_image.crop_inner_and_find_bright),
+        ("shape_image.apply_crop_and_deskew", lambda c: (c["rgb"], c["crop_rect"], c["angle"]),
+         shape_image.apply_crop_and_deskew),
+        ("shape_image.apply_crop_and_deskew[full-frame warp]", lambda c: (c["rgb"], c["crop_rect"], c["angle"]),
+         full_frame_deskew),
+        ("shape_image.apply_crop_and_deskew[lanczos]", lambda c: (c["rgb"], c["crop_rect"], c["angle"]),
+         lambda rgb, rect, angle: shape_image.apply_crop_and_deskew(rgb, rect, angle, interpolation="lanczos")),
+        ("shape_image.analyze_frame", lambda c: (c["rgb"],), shape_image.analyze_frame),
+        (f"shape_image.analyze_frame[proxy {PROXY_SIZE}]", lambda c: (c["rgb"],),
+         lambda rgb: shape_image.analyze_frame(rgb, analysis_size=PROXY_SIZE)),
+        ("invert_image.divide_blend", lambda c: (c["cropped"], c["ref"]), invert_image.divide_blend),
+        ("invert_image.invert_image", lambda c: (c["cropped"],), invert_image.invert_image),
+        ("invert_image.compute_brightness", lambda c: (c["inverted"],), invert_image.compute_brightness),
+        ("invert_image.white_balance_levels", lambda c: (c["inverted"], 99.99, 0.1),
+         invert_image.white_balance_levels),
+        ("invert_image.enhanced_white_balance", lambda c: (c["inverted"], 99.99, 0.1),
+         invert_image.enhanced_white_balance),
+        ("invert_image.auto_contrast", lambda c: (c["balanced"], 0.01), invert_image.auto_contrast),
+        ("invert_image.invert_array", lambda c: (c["cropped"], c["ref"]), invert_image.invert_array),
+        ("invert_image.invert_array[float_path]", lambda c: (c["cropped"], c["ref"]),
+         lambda img, ref: invert_image.invert_array(img, ref, float_path=True)),
+        (f"invert_image.invert_array[{STACK_FRAMES} proxies, loop]", lambda c: (c["proxies"], c["ref"]),
+         lambda stack, ref: [invert_image.invert_array(f, ref, autocontrast=True) for f in stack]),
+        (f"invert_image.invert_stack[{STACK_FRAMES} proxies]", lambda c: (c["proxies"], c["ref"]),
+         lambda stack, ref: invert_image.invert_stack(stack, ref, autocontrast=True)),
+        ("image_io.write_rgb[png]", lambda c: (png_path, c["balanced"]),
+         lambda path, img: image_io.write_rgb(path, img, format="PNG")),
+        ("image_io.write_rgb[png level 1]", lambda c: (os.path.join(tmpdir, "bench1.png"), c["balanced"]),
+         lambda path, img: image_io.write_rgb(path, img, format="PNG", compress_level=1)),
+        ("image_io.write_rgb[tiff]", lambda c: (os.path.join(tmpdir, "bench.tif"), c["balanced"]),
+         lambda path, img: image_io.write_rgb(path, img, format="TIFF")),
+        ("image_io.write_rgb[tiff lzw]", lambda c: (os.path.join(tmpdir, "bench_lzw.tif"), c["balanced"]),
+         lambda path, img: image_io.write_rgb(path, img, format="TIFF", lzw=True)),
+        ("image_io.write_rgb[jpeg 95]", lambda c: (os.path.join(tmpdir, "bench.jpg"), c["balanced"]),
+         lambda path, img: image_io.write_rgb(path, img, format="JPEG")),
+        ("image_io.read_rgb[png]", lambda c: (png_path,), image_io.read_rgb),
+        ("pipeline.process_array", lambda c: (c["img"].copy(),), pipeline.process_array),
+        (f"pipeline.process_array[proxy {PROXY_SIZE}]", lambda c: (c["img"].copy(),),
+         lambda rgb: pipeline.process_array(rgb, analysis_size=PROXY_SIZE)),
+    ]
+
+
+def time_stage(fn, make_args, ctx: dict, repeat: int):
+    """Best wall time over `repeat` runs, and the tracemalloc peak of the first run in bytes."""
+    args = make_args(ctx)
+    tracemalloc.start()
+    with _quiet():
+        fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del args
+
+    best = float("inf")
+    for _ in range(repeat):
+        args = make_args(ctx)
+        with _quiet():
+            start = time.perf_counter()
+            fn(*args)
+            best = min(best, time.perf_counter() - start)
+        del args
+    return best, peak
+
+
+def check_accuracy(ctx: dict, truth: dict, white: int) -> dict:
+    """Compare the analysis of a synthetic frame with its ground truth."""
+    h, w = ctx["img"].shape[:2]
+    x, y, cw, ch = (int(v) for v in ctx["crop_rect"])
+    tx, ty, tw, th = truth["crop_rect"]
+    # edges within 0.5% of the frame size
+    crop_err = max(abs(x - tx) / w, abs(y - ty) / h, abs(x + cw - tx - tw) / w, abs(y + ch - ty - th) / h)
+    # minAreaRect may report a skew as its complement (e.g. -87 for +3)
+    folded = (ctx["angle"] + 45.0) % 90.0 - 45.0
+    angle_err = abs(folded - truth["skew_angle"])
+    blend_err = float(np.max(np.abs(np.asarray(ctx["ref"], dtype=float) - truth["blend_color"])))
+    # the fused deskew-and-crop warp against rotating the whole frame: interpolation rounding only
+    warp_err = int(np.max(np.abs(ctx["cropped"].astype(np.int32)
+                                 - full_frame_deskew(ctx["rgb"], ctx["crop_rect"], ctx["angle"]))))
+    return {
+        "crop_rect": [x, y, cw, ch],
+        "crop_rect_truth": truth["crop_rect"],
+        "crop_error": round(crop_err, 5),
+        "skew_angle": float(ctx["angle"]),
+        "skew_angle_truth": truth["skew_angle"],
+        "angle_error": round(angle_err, 4),
+        "blend_color": [float(v) for v in ctx["ref"]],
+        "blend_color_truth": truth["blend_color"],
+        "blend_error": round(blend_err, 3),
+        "warp_error": warp_err,
+        "ok": bool(crop_err <= 0.005 and angle_err <= 0.25 and blend_err <= 1.5 * white / 255
+                   and warp_err <= white // 255),
+    }
+
+
+def run(sizes, repeat: int = 3, skew: float = 2.5, bits: int = 8, only=None):
+    """Benchmark all stages for each size. Yields one record per (size, stage) and one accuracy record per size."""
+    dtype = np.uint16 if bits == 16 else np.uint8
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for mp in sizes:
+            img, truth = synth.make_negative(mp, skew=skew, dtype=dtype)
+            h, w = img.shape[:2]
+            megapixels = w * h / 1e6
+            ctx = prepare(img)
+            accuracy = check_accuracy(ctx, truth, image_io.max_value(img))
+            accuracy.update(kind="accuracy", size_mp=mp, width=w, height=h)
+            yield accuracy
+            for name, make_args, fn in stages(tmpdir):
+                if only and not any(s in name for s in only):
+                    continue
+                seconds, peak = time_stage(fn, make_args, ctx, repeat)
+                yield {"kind": "stage", "size_mp": mp, "stage": name, "seconds": round(seconds, 5),
+                       "mp_per_s": round(megapixels / seconds, 2), "peak_mb": round(peak / 2**20, 1)}
+            del img, ctx
+
+
+def max_rss_mb():
+    """Peak resident set size of this process (not available on Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def environment() -> dict:
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(results: list, baseline_path: str):
+    """Print the speed-up of every stage against an earlier results file."""
+    with open(baseline_path, 'r') as bf:
+        baseline = json.load(bf)
+    before = {(r["size_mp"], r["stage"]): r["seconds"] for r in baseline["results"] if r["kind"] == "stage"}
+    print(f"\nSpeed-up against {baseline_path}:")
+    for r in results:
+        old = before.get((r["size_mp"], r.get("stage")))
+        if r["kind"] == "stage" and old:
+            print(f"{r['size_mp']:>5} MP  {r['stage']:<48} {old:8.3f} s -> {r['seconds']:8.3f} s"
+                  f"  x{old / r['seconds']:.2f}")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark neg2pos stages on synthetic negatives.")
+    p.add_argument("--sizes", type=float, nargs="+", default=list(DEFAULT_SIZES),
+                   help="Frame sizes in megapixels (default: 12 24 45 100)")
+    p.add_argument("--repeat", type=int, default=3, help="Timed runs per stage; the best is kept (default: 3)")
+    p.add_argument("--skew", type=float, default=2.5, help="Skew angle of the synthetic frames in degrees")
+    p.add_argument("--bits", type=int, choices=(8, 16), default=8, help="Bit depth of the synthetic frames")
+    p.add_argument("--stage", action="append", help="Only run stages whose name contains this (repeatable)")
+    p.add_argument("-o", "--output", default="bench_results.json", help="Results JSON (default: bench_results.json)")
+    p.add_argument("--compare", help="Earlier results JSON to compare against")
+    p.add_argument("--threads", type=int, default=1,
+                   help="Row-band threads for the pointwise stages (bands.py; 0: one per core; default: 1)")
+    args = p.parse_args()
+    bands.set_threads(args.threads)
+
+    results = []
+    failed = False
+    for r in run(args.sizes, repeat=args.repeat, skew=args.skew, bits=args.bits, only=args.stage):
+        results.append(r)
+        if r["kind"] == "accuracy":
+            failed |= not r["ok"]
+            print(f"{r['size_mp']:>5} MP  {r['width']}x{r['height']}  accuracy {'ok' if r['ok'] else 'FAILED'}:"
+                  f" crop {r['crop_error']:.4f}, angle {r['angle_error']:.3f} deg, blend {r['blend_error']:.2f}")
+        else:
+            print(f"{r['size_mp']:>5} MP  {r['stage']:<48} {r['seconds']:8.3f} s {r['mp_per_s']:8.1f} MP/s"
+                  f" {r['peak_mb']:8.1f} MB", flush=True)
+
+    env = environment()
+    env.update(repeat=args.repeat, skew=args.skew, bits=args.bits, threads=bands.threads(),
+               max_rss_mb=max_rss_mb())
+    with open(args.output, 'w') as of:
+        json.dump({"environment": env, "results": results}, of, indent=1)
+    print(f"Results saved as {args.output}", file=sys.stderr)
+
+    if args.compare:
+        compare(results, args.compare)
+    if failed:
+        print("Accuracy check FAILED", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Synthetic film-negative frames with known ground truth.
+
+A frame is a white backlight, a 35 mm style strip with an orange-mask rebate
+and pure-white perforations along both long edges, and a darker image area
+in the middle; the whole scan is then rotated by a known skew angle.
+make_strip puts several image areas on one strip, as when a whole strip is
+captured in one exposure.
+"""
+import cv2
+import numpy as np
+
+ORANGE_MASK = (230, 150, 100)
+
+
+def frame_size(megapixels: float, aspect: float = 1.5):
+    """(width, height) of a frame with the given pixel count and aspect ratio."""
+    h = int(round(np.sqrt(megapixels * 1e6 / aspect)))
+    return int(round(h * aspect)), h
+
+
+def _scene(iw: int, ih: int, rng) -> np.ndarray:
+    """Smooth scene plus grain, always denser than the mask."""
+    yy, xx = np.mgrid[0:ih, 0:iw].astype(np.float32)
+    xs, ys = xx * (3000.0 / iw), yy * (2000.0 / ih)
+    scene = np.empty((ih, iw, 3), dtype=np.float32)
+    scene[..., 0] = 120 + 60 * np.sin(xs / 90.0)
+    scene[..., 1] = 90 + 50 * np.cos(ys / 70.0)
+    scene[..., 2] = 60 + 40 * np.sin((xs + ys) / 120.0)
+    scene += rng.normal(0, 5, scene.shape).astype(np.float32)
+    return np.clip(scene, 0, 255).astype(np.uint8)
+
+
+def _film(w: int, h: int, fw: int, fh: int, mask):
+    """Backlight with a film strip of fw x fh centred on it, perforated along both long edges."""
+    img = np.full((h, w, 3), 255, dtype=np.uint8)
+    x0, y0 = (w - fw) // 2, (h - fh) // 2
+    img[y0:y0 + fh, x0:x0 + fw] = mask
+    unit = max(4, fh // 40)
+    for px in range(x0 + 2 * unit, x0 + fw - 4 * unit, 4 * unit):
+        img[y0 + unit // 2:y0 + 2 * unit, px:px + 2 * unit] = 255
+        img[y0 + fh - 2 * unit:y0 + fh - unit // 2, px:px + 2 * unit] = 255
+    return img, x0, y0
+
+
+def _skew(img: np.ndarray, skew: float, rects, mask, dtype):
+    """Rotate the scan and return it with the ground truth of the given image rectangles."""
+    h, w = img.shape[:2]
+    M = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), skew, 1.0)
+    img = cv2.warpAffine(img, M, (w, h), flags=cv2.INTER_LINEAR,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+    crop_rects = []
+    for ix, iy, iw, ih in rects:
+        corners = np.array([[ix, iy, 1], [ix + iw, iy, 1], [ix, iy + ih, 1], [ix + iw, iy + ih, 1]], dtype=float)
+        rotated = corners @ M.T
+        bx, by = rotated.min(axis=0)
+        bx1, by1 = rotated.max(axis=0)
+        crop_rects.append([int(round(bx)), int(round(by)), int(round(bx1 - bx)), int(round(by1 - by))])
+    blend_color = [float(v) for v in mask]
+    if np.dtype(dtype) == np.uint16:
+        img = img.astype(np.uint16) * 257
+        blend_color = [v * 257 for v in blend_color]
+    return img, {"blend_color": blend_color, "skew_angle": -skew, "crop_rects": crop_rects}
+
+
+def make_negative(megapixels: float = 24, skew: float = 2.5, seed: int = 0,
+                  mask=ORANGE_MASK, dtype=np.uint8):
+    """
+    Build a synthetic negative scan.
+    Returns the RGB image and its ground truth: the blend colour (orange mask),
+    the skew angle and the axis-aligned bounding box (x, y, w, h) of the image
+    area in scan coordinates.
+    """
+    rng = np.random.default_rng(seed)
+    w, h = frame_size(megapixels)
+    fw, fh = int(w * 0.9), int(h * 0.85)
+    img, x0, y0 = _film(w, h, fw, fh, mask)
+
+    iw, ih = int(fw * 0.85), int(fh * 0.75)
+    ix, iy = x0 + (fw - iw) // 2, y0 + (fh - ih) // 2
+    img[iy:iy + ih, ix:ix + iw] = _scene(iw, ih, rng)
+
+    img, truth = _skew(img, skew, [(ix, iy, iw, ih)], mask, dtype)
+    truth["crop_rect"] = truth.pop("crop_rects")[0]
+    return img, truth
+
+
+def make_strip(frames: int = 4, megapixels: float = 24, skew: float = 1.5, seed: int = 0,
+               mask=ORANGE_MASK, dtype=np.uint8):
+    """
+    Build a synthetic capture of a whole strip with `frames` 3:2 image areas
+    side by side. Ground truth as make_negative, with 'crop_rects' listing
+    the bounding box of every frame from left to right.
+    """
+    rng = np.random.default_rng(seed)
+    aspect = frames * (0.8 * 0.72 * 1.5) * 1.1 / 0.96   # ~10% rebate between frames
+    w, h = frame_size(megapixels, aspect)
+    fw, fh = int(w * 0.96), int(h * 0.8)
+    img, x0, y0 = _film(w, h, fw, fh, mask)
+
+    ih = int(fh * 0.72)
+    iw = int(ih * 1.5)
+    gap = (fw - frames * iw) // (frames + 1)
+    iy = y0 + (fh - ih) // 2
+    rects = []
+    for i in range(frames):
+        ix = x0 + gap + i * (iw + gap)
+        img[iy:iy + ih, ix:ix + iw] = _scene(iw, ih, rng)
+        rects.append((ix, iy, iw, ih))
+    return _skew(img, skew, rects, mask, dtype)
@@ -0,0 +1,109 @@
+"""
+On-disk cache of the shape analysis, keyed by the content of the scan.
+
+When a folder is re-run with different inversion settings (auto contrast,
+percentiles) the source frames have not changed, so neither has their crop,
+skew and blend colour. Each entry is stored under a key made of the SHA-1 of
+the file and the parameters that affect the analysis:
+
+    <key>.json   the analysis result (blend_color, skew_angle, crop_rect, input_size)
+    <key>.npy    optionally the cropped/deskewed frame, memory-mapped on reuse
+
+A hit on the .json skips the analysis; a hit on the .npy also skips decoding
+and perforation removal. The folder is kept under max_mb by evicting the
+least recently used entries (reads refresh an entry's mtime).
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """SHA-1 of a file's content."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class AnalysisCache:
+    def __init__(self, folder: str, max_mb: float = 4096):
+        self.folder = folder
+        self.max_bytes = int(max_mb * 2**20)
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, image_path: str, **params) -> str:
+        """Cache key for a scan and the analysis parameters used on it."""
+        h = hashlib.sha1(file_digest(image_path).encode())
+        h.update(json.dumps({"version": CACHE_VERSION, **params}, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.folder, key + ext)
+
+    def get(self, key: str):
+        """
+        Return (result, frame): the cached analysis result or None, and the
+        cached cropped frame (read-only memmap) or None.
+        """
+        try:
+            with open(self._path(key, ".json"), 'r') as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        frame = None
+        frame_path = self._path(key, ".npy")
+        if os.path.exists(frame_path):
+            try:
+                frame = np.load(frame_path, mmap_mode='r')
+                os.utime(frame_path)
+            except (OSError, ValueError):
+                frame = None
+        os.utime(self._path(key, ".json"))
+        return result, frame
+
+    def put(self, key: str, result: dict, frame: np.ndarray = None):
+        """Store an analysis result (and optionally the cropped frame), then evict to the size limit."""
+        if frame is not None:
+            self._write(key, ".npy", lambda f: np.save(f, frame))
+        self._write(key, ".json", lambda f: f.write(json.dumps(result).encode()))
+        self.evict()
+
+    def _write(self, key: str, ext: str, write):
+        # write then rename, so concurrent workers never read half an entry
+        path = self._path(key, ext)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+
+    def evict(self):
+        """Delete least recently used entries until the folder fits in max_bytes."""
+        entries = {}
+        total = 0
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                key, ext = os.path.splitext(entry.name)
+                if ext not in (".json", ".npy"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                size, used = entries.get(key, (0, 0.0))
+                entries[key] = (size + st.st_size, max(used, st.st_mtime))
+                total += st.st_size
+        for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            for ext in (".npy", ".json"):
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+            total -= size
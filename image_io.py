@@ -0,0 +1,224 @@
+"""
+Reading and writing RGB frames at their native bit depth.
+
+8-bit frames are written with Pillow, as before; 16-bit frames (TIFF/PNG
+camera scans) are read and written with OpenCV, since Pillow has no 48-bit
+RGB mode and would truncate them to 8 bits.
+
+Outputs can be PNG (zlib level 0-9), uncompressed or LZW TIFF, or JPEG. PNG
+encoding of a large frame takes seconds, so AsyncWriter can run it in a
+background thread while the next frame is processed (both encoders release
+the GIL). Outputs are written under a temporary name and renamed into
+place, so an interrupted run never leaves a truncated file under the final
+name.
+
+Between shape_image.py and invert_image.py a frame can also be handed over
+as raw pixels: a headerless file memory-mapped on both sides, with its shape
+and dtype carried in the JSON, so it is neither encoded nor decoded.
+
+OpenCV is imported on first use, so tools that only parse arguments (or
+write 8-bit frames) do not pay for loading it.
+"""
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+import instrument
+
+# --format choices: (Pillow format, extension)
+OUTPUT_FORMATS = {
+    "png": ("PNG", ".png"),
+    "tiff": ("TIFF", ".tif"),
+    "tiff-lzw": ("TIFF", ".tif"),
+    "jpeg": ("JPEG", ".jpg"),
+}
+
+# 16-bit PNG levels written with the RLE strategy, OpenCV's default: much faster than
+# zlib's default strategy at low levels; higher levels ask for size and get it
+PNG_RLE_MAX_LEVEL = 3
+
+
+def max_value(image_np: np.ndarray) -> int:
+    """White level of an integer image: 255 for uint8, 65535 for uint16."""
+    return int(np.iinfo(image_np.dtype).max)
+
+
+def rescale_levels(values, bits, dtype) -> np.ndarray:
+    """
+    Colour values measured on frames of `bits` bits per channel, as floats in
+    the scale of dtype (e.g. an 8-bit roll profile applied to 16-bit scans).
+    Unchanged when bits is None or matches dtype.
+    """
+    values = np.asarray(values, dtype=float)
+    white = int(np.iinfo(dtype).max)
+    if not bits or 2 ** int(bits) - 1 == white:
+        return values
+    return values * (white / float(2 ** int(bits) - 1))
+
+
+def to_8bit(image_np: np.ndarray) -> np.ndarray:
+    """8-bit copy of an image for previews and viewers."""
+    if image_np.dtype == np.uint8:
+        return image_np
+    return (image_np >> 8).astype(np.uint8)
+
+
+@instrument.timed
+def read_rgb(path: str) -> np.ndarray:
+    """Read an image as RGB uint8 or uint16 (as stored). Returns None if unreadable."""
+    import cv2
+    bgr = cv2.imread(path, cv2.IMREAD_COLOR | cv2.IMREAD_ANYDEPTH)
+    if bgr is None:
+        return None
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+
+@instrument.timed
+def write_rgb(path: str, image_np: np.ndarray, format: str = None, compress_level: int = None,
+              jpeg_quality: int = 95, lzw: bool = False) -> str:
+    """
+    Write an RGB uint8 or uint16 image; the format follows the file extension
+    unless given (Pillow name: PNG, TIFF, JPEG). compress_level is the PNG zlib
+    level (None: the encoder default, 6 for Pillow and 1 with the RLE strategy
+    for OpenCV), lzw compresses TIFF. JPEG is 8-bit only, 16-bit frames are
+    reduced with to_8bit.
+    """
+    format = (format or os.path.splitext(path)[1][1:]).upper()
+    format = {"TIF": "TIFF", "JPG": "JPEG"}.get(format, format)
+    if format == "JPEG":
+        image_np = to_8bit(image_np)
+    if image_np.dtype == np.uint8:
+        from PIL import Image
+        params = {}
+        if format == "PNG" and compress_level is not None:
+            params["compress_level"] = compress_level
+        elif format == "TIFF" and lzw:
+            params["compression"] = "tiff_lzw"
+        elif format == "JPEG":
+            params.update(quality=jpeg_quality, subsampling=0)  # 4:4:4, no chroma loss
+        Image.fromarray(image_np).save(path, format=format, **params)
+        return path
+    import cv2
+    params = []
+    if format == "PNG" and compress_level is not None:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, compress_level]
+        # An explicit level drops OpenCV's default RLE strategy for zlib's default one,
+        # which made level 1 about 3x slower than no level at all on 16-bit frames.
+        if 1 <= compress_level <= PNG_RLE_MAX_LEVEL:
+            params += [cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE]
+    elif format == "TIFF":
+        params = [cv2.IMWRITE_TIFF_COMPRESSION, 5 if lzw else 1]
+    if not cv2.imwrite(path, cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR), params):
+        raise IOError(f"Couldn’t write {path}")
+    return path
+
+
+def output_params(output_format: str = "png", compress_level: int = None, jpeg_quality: int = 95) -> dict:
+    """write_rgb keyword arguments for a --format choice."""
+    return {"format": OUTPUT_FORMATS[output_format][0], "compress_level": compress_level,
+            "jpeg_quality": jpeg_quality, "lzw": output_format == "tiff-lzw"}
+
+
+def write_timed(path: str, image_np: np.ndarray, durable: bool = False, **params) -> float:
+    """
+    write_rgb, returning the seconds spent encoding and writing. The file is
+    written under partial_path(path) and renamed into place, so `path` never
+    holds half an image; durable also flushes it to disk first (see commit).
+    """
+    start = time.perf_counter()
+    tmp = partial_path(path)
+    try:
+        write_rgb(tmp, image_np, **params)
+        commit(tmp, path, durable)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return time.perf_counter() - start
+
+
+def partial_path(path: str) -> str:
+    """Temporary name for an output being written: same folder and extension (the encoder follows it)."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.partial-{os.getpid()}-{threading.get_ident()}{ext}"
+
+
+def commit(tmp: str, path: str, durable: bool = False):
+    """
+    Rename a finished temporary file to path. durable fsyncs the file before
+    the rename and the folder after it, so once this returns the output
+    survives a crash or power loss.
+    """
+    if durable:
+        with open(tmp, 'rb+') as f:
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+    if durable and os.name != "nt":   # Windows cannot open a folder to flush it
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class AsyncWriter:
+    """
+    Encodes and writes frames in a background thread so the caller can go on
+    with the next frame. At most `pending` frames wait to be written; submit()
+    blocks beyond that, which bounds the memory held by queued frames.
+    on_done(record) is called from the writer thread for every frame, with
+    'output_path', 'encode_seconds' and 'error' (if the write failed) added to
+    the record given to submit().
+    """
+
+    def __init__(self, on_done=None, pending: int = 1):
+        self.on_done = on_done
+        self.queue = queue.Queue(maxsize=pending)
+        self.thread = threading.Thread(target=self._run, name="AsyncWriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, path: str, image_np: np.ndarray, record: dict = None, **params):
+        self.queue.put((path, image_np, dict(record or {}), params))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, image_np, record, params = item
+            record["output_path"] = path
+            try:
+                record["encode_seconds"] = write_timed(path, image_np, **params)
+            except Exception as e:
+                record["error"] = f"Couldn’t write {path}: {e}"
+            del image_np
+            if self.on_done:
+                self.on_done(record)
+
+    def close(self):
+        """Wait until every submitted frame is written."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+def create_raw(path: str, shape, dtype) -> np.memmap:
+    """Writable memory-mapped raw file for an image of the given shape and dtype."""
+    return np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape))
+
+
+@instrument.timed
+def write_raw(path: str, image_np: np.ndarray) -> dict:
+    """Write an image as raw pixels. Returns its {'shape', 'dtype'} for open_raw."""
+    raw = create_raw(path, image_np.shape, image_np.dtype)
+    raw[...] = image_np
+    raw.flush()
+    del raw
+    return {"shape": list(image_np.shape), "dtype": np.dtype(image_np.dtype).name}
+
+
+def open_raw(path: str, shape, dtype) -> np.memmap:
+    """Read-only memory map of a raw image written by write_raw."""
+    return np.memmap(path, dtype=np.dtype(dtype), mode='r', shape=tuple(shape))
@@ -0,0 +1,109 @@
+"""
+Histogram based image statistics shared by shape_image and invert_image.
+
+Brightness is the integer sum of R, G and B (0..765 for 8-bit images), i.e.
+compute_brightness() times three without the float64 map. A bincount of it
+is built once per image and percentile thresholds are read from its
+cumulative histogram instead of running np.percentile over every pixel.
+"""
+import numpy as np
+
+import bands
+
+
+def luminance_sum(rgb: np.ndarray) -> np.ndarray:
+    """Per-pixel R + G + B (brightness in steps of 1/3), uint16 for 8-bit images."""
+    dtype = np.uint16 if rgb.dtype.itemsize == 1 else np.uint32
+    lum = np.empty(rgb.shape[:-1], dtype=dtype)
+
+    def band(y0, y1):
+        # channel by channel: much faster than a strided sum(axis=2)
+        part = lum[y0:y1]
+        part[...] = rgb[y0:y1, ..., 0]
+        part += rgb[y0:y1, ..., 1]
+        part += rgb[y0:y1, ..., 2]
+
+    bands.run(band, len(rgb), rgb.size // max(len(rgb), 1))
+    return lum
+
+
+def luminance_levels(rgb) -> int:
+    """Number of distinct luminance_sum values for an image (or its dtype)."""
+    return 3 * int(np.iinfo(getattr(rgb, 'dtype', rgb)).max) + 1
+
+
+def histogram(values: np.ndarray, levels: int) -> np.ndarray:
+    """Counts of each integer value in 0..levels-1."""
+    return np.bincount(values.ravel(), minlength=levels)
+
+
+def histograms(values: np.ndarray, levels: int) -> np.ndarray:
+    """Per-frame counts of a stack of value maps (N, ...): one bincount over frame-offset values, (N, levels)."""
+    n = len(values)
+    offsets = (np.arange(n, dtype=np.int64) * levels).reshape((n,) + (1,) * (values.ndim - 1))
+    return np.bincount((values + offsets).ravel(), minlength=n * levels).reshape(n, levels)
+
+
+def percentiles(hists: np.ndarray, pct: float) -> np.ndarray:
+    """percentile() of every row of an (N, levels) histogram array at once: shape (N,)."""
+    cdf = np.cumsum(hists, axis=1)
+    total = cdf[:, -1]
+    last = np.maximum(total - 1, 0)
+    pos = last * pct / 100.0
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, last)
+    # searchsorted(side='right') row by row: the number of cumulative counts <= the rank
+    v_lo = (cdf <= lo[:, None]).sum(axis=1)
+    v_hi = (cdf <= hi[:, None]).sum(axis=1)
+    return np.where(total > 0, v_lo + (v_hi - v_lo) * (pos - lo), 0.0)
+
+
+def percentile(hist: np.ndarray, pct: float) -> float:
+    """
+    Percentile of the values counted in hist, with the same linear
+    interpolation between order statistics as np.percentile.
+    """
+    cdf = np.cumsum(hist)
+    total = cdf[-1]
+    if total == 0:
+        return 0.0
+    pos = (total - 1) * pct / 100.0
+    lo = int(np.floor(pos))
+    hi = min(lo + 1, total - 1)
+    v_lo = np.searchsorted(cdf, lo, side='right')
+    v_hi = np.searchsorted(cdf, hi, side='right')
+    return float(v_lo + (v_hi - v_lo) * (pos - lo))
+
+
+def top_count_threshold(hist: np.ndarray, n_select: int):
+    """
+    Level t such that the n_select highest values are everything above t plus
+    some of the values equal to t. Returns (t, number of values above t).
+    """
+    above = np.cumsum(hist[::-1])[::-1]  # above[t] = count of values >= t
+    t = int(np.nonzero(above >= n_select)[0][-1])
+    n_above = int(above[t + 1]) if t + 1 < len(hist) else 0
+    return t, n_above
+
+
+def mean_rgb_of_top(rgb: np.ndarray, key: np.ndarray, hist: np.ndarray, percent: float,
+                    valid: np.ndarray = None) -> np.ndarray:
+    """
+    Mean RGB of the `percent` % of pixels with the highest key, answered from the
+    key histogram. hist must count only the valid pixels (all pixels if valid is
+    None). Pixels tied at the threshold contribute with their mean colour.
+    """
+    count = int(hist.sum())
+    n_select = max(1, int(count * percent / 100.0))
+    t, n_above = top_count_threshold(hist, n_select)
+
+    sel_above = key > t
+    sel_tie = key == t
+    if valid is not None:
+        sel_above &= valid
+        sel_tie &= valid
+    total = rgb[sel_above].sum(axis=0, dtype=np.float64)
+    n_tie = n_select - n_above
+    if n_tie > 0:
+        total += rgb[sel_tie].mean(axis=0) * n_tie
+    return total / n_select
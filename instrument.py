@@ -0,0 +1,149 @@
+"""
+Per-stage timing for the pipeline.
+
+The processing functions of shape_image and invert_image, image_io's
+read/write and tiled.invert_tiled are wrapped with @timed;
+pipeline.process_file records the whole frame as the "process_file" stage.
+Nothing is measured unless a recording() is active in the calling thread, so
+the wrappers cost one attribute lookup otherwise.
+
+Each stage record holds the wall time, the process CPU time (all threads, so
+OpenCV's own threads make it exceed the wall time) and, when tracemalloc is
+tracing, the peak bytes allocated during the stage. Nested stages are named
+by their path, e.g. "analyze_frame/get_rebate_crop".
+"""
+import functools
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+class Recorder:
+    """Collects stage records for one frame."""
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.records = []
+        self._stack = []   # [name, peak bytes seen so far]
+
+    @contextmanager
+    def stage(self, name: str):
+        path = "/".join([s[0] for s in self._stack] + [name])
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        entry = [name, current]
+        self._stack.append(entry)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = {"stage": path,
+                      "wall": round(time.perf_counter() - wall, 6),
+                      "cpu": round(time.process_time() - cpu, 6)}
+            self._stack.pop()
+            if self.trace_memory:
+                entry[1] = max(entry[1], tracemalloc.get_traced_memory()[1])
+                record["alloc"] = entry[1] - current
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], entry[1])
+            self.records.append(record)
+
+
+def active() -> Recorder:
+    """The recorder of the calling thread, or None."""
+    return getattr(_local, "recorder", None)
+
+
+@contextmanager
+def recording(trace_memory: bool = False, cprofile_path: str = None):
+    """
+    Record the stages run in this thread. trace_memory turns on tracemalloc
+    (slow: every allocation is tracked) to report allocated bytes per stage;
+    cprofile_path also runs cProfile and saves its stats there.
+    Yields the Recorder.
+    """
+    recorder = Recorder(trace_memory)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profiler = None
+    if cprofile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+    previous, _local.recorder = active(), recorder
+    if profiler:
+        profiler.enable()
+    try:
+        yield recorder
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+        _local.recorder = previous
+        if started_tracing:
+            tracemalloc.stop()
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block as a stage of the active recording (no-op without one)."""
+    recorder = active()
+    if recorder is None:
+        yield
+    else:
+        with recorder.stage(name):
+            yield
+
+
+def timed(fn):
+    """Decorator: record each call of fn as a stage named after the function."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        recorder = active()
+        if recorder is None:
+            return fn(*args, **kwargs)
+        with recorder.stage(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def summarize(results) -> dict:
+    """
+    Per-roll summary of the 'timings' of several frame results:
+    {stage: {calls, wall_total, wall_mean, wall_max, cpu_total[, alloc_max]}},
+    slowest stage first.
+    """
+    summary = {}
+    for result in results:
+        for record in result.get("timings", ()):
+            s = summary.setdefault(record["stage"], {"calls": 0, "wall_total": 0.0, "wall_max": 0.0,
+                                                     "cpu_total": 0.0})
+            s["calls"] += 1
+            s["wall_total"] += record["wall"]
+            s["wall_max"] = max(s["wall_max"], record["wall"])
+            s["cpu_total"] += record["cpu"]
+            if "alloc" in record:
+                s["alloc_max"] = max(s.get("alloc_max", 0), record["alloc"])
+    for s in summary.values():
+        s["wall_mean"] = s["wall_total"] / s["calls"]
+        for key in ("wall_total", "wall_mean", "wall_max", "cpu_total"):
+            s[key] = round(s[key], 6)
+    return dict(sorted(summary.items(), key=lambda item: -item[1]["wall_total"]))
+
+
+def format_summary(summary: dict) -> str:
+    """Human-readable table of a summarize() result."""
+    lines = [f"{'stage':<60} {'calls':>6} {'total s':>9} {'mean s':>8} {'max s':>8} {'cpu s':>9} {'alloc MB':>9}"]
+    for name, s in summary.items():
+        alloc = f"{s['alloc_max'] / 2**20:9.1f}" if "alloc_max" in s else f"{'-':>9}"
+        lines.append(f"{name:<60} {s['calls']:>6} {s['wall_total']:9.3f} {s['wall_mean']:8.3f}"
+                     f" {s['wall_max']:8.3f} {s['cpu_total']:9.3f} {alloc}")
+    return "\n".join(lines)
@@ -2,57 +2,119 @@
 import argparse
 import json
 import numpy as np
-from PIL import Image
-import datetime
 import os
 
+import bands
+import image_io
+import image_stats
+import instrument
+
 debug=0
 
+@instrument.timed
 def divide_blend(image_np: np.ndarray, blend_color: np.ndarray) -> np.ndarray:
-    """Divide each channel by the blend color and scale back to 0–255."""
-    divided = (image_np.astype(float) / blend_color.astype(float)) * 255.0
-    return np.clip(divided, 0, 255).astype(np.uint8)
+    """Divide each channel by the blend color and scale back to 0–255 (0–65535 for 16-bit)."""
+    white = image_io.max_value(image_np)
+    blend_color = blend_color.astype(float)
+    return bands.pointwise(
+        lambda band: np.clip((band.astype(float) / blend_color) * float(white), 0, white).astype(band.dtype),
+        image_np)
 
 
+@instrument.timed
 def invert_image(image_np: np.ndarray) -> np.ndarray:
-    """Invert an image: 255 - pixel value."""
-    return 255 - image_np
+    """Invert an image: 255 (65535 for 16-bit) - pixel value."""
+    white = image_io.max_value(image_np)
+    return bands.pointwise(lambda band: white - band, image_np)
 
 
+@instrument.timed
 def compute_brightness(image_np: np.ndarray) -> np.ndarray:
     """Compute luminance as weighted sum of R, G, B."""
-    return np.dot(image_np[..., :3], [0.3333, 0.3333, 0.3334])
+    return bands.pointwise(lambda band: np.dot(band[..., :3], [0.3333, 0.3333, 0.3334]), image_np,
+                           shape=image_np.shape[:2], dtype=float)
 
 
-def enhanced_white_balance(image_np: np.ndarray,
-                           bright_pct: float,
-                           dark_pct: float) -> np.ndarray:
+def white_balance_thresholds(hist: np.ndarray, bright_pct: float, dark_pct: float):
+    """Brightness thresholds (bright, dark) from an image_stats luminance histogram."""
+    return image_stats.percentile(hist, bright_pct), image_stats.percentile(hist, dark_pct)
+
+
+@instrument.timed
+def white_balance_levels(image_np: np.ndarray,
+                         bright_pct: float,
+                         dark_pct: float,
+                         brightness: np.ndarray = None,
+                         hist: np.ndarray = None):
     """
-    Apply white balance by stretching based on brightest and darkest percentiles.
+    Find the white balance levels: per-channel minimum of the brightest pixels
+    and maximum of the darkest pixels, selected by brightness percentiles.
+    brightness (image_stats.luminance_sum) and its histogram can be passed
+    in when they are kept across calls with other percentiles.
     """
-    brightness = compute_brightness(image_np)
-    bright_th = np.percentile(brightness, bright_pct)
-    dark_th = np.percentile(brightness, dark_pct)
+    if brightness is None:
+        brightness = image_stats.luminance_sum(image_np)
+    if hist is None:
+        hist = image_stats.histogram(brightness, image_stats.luminance_levels(image_np))
+    bright_th, dark_th = white_balance_thresholds(hist, bright_pct, dark_pct)
 
     bright_vals = image_np[brightness >= bright_th]
     dark_vals = image_np[brightness <= dark_th]
 
     max_vals = dark_vals.max(axis=0)
     min_vals = bright_vals.min(axis=0)
+    return min_vals, max_vals
 
-    scale = 253.0 / (min_vals - max_vals)
-    offset = 2.0 - max_vals * scale
 
-    wb = image_np.astype(float) * scale + offset
-    return np.clip(wb, 0, 255).astype(np.uint8)
+def white_balance_scale(levels, white: int = 255):
+    """
+    Per-channel scale and offset mapping the dark level to 2 and the bright
+    level to 255 (in 8-bit units; scaled to the white level for 16-bit).
+    """
+    min_vals, max_vals = levels
+    top = white * 253.0 / 255.0
+    bottom = white * 2.0 / 255.0
+    scale = top / (min_vals - max_vals)
+    offset = bottom - max_vals * scale
+    return scale, offset
 
 
-def auto_contrast(image_np: np.ndarray, clip_pct: float) -> np.ndarray:
+@instrument.timed
+def enhanced_white_balance(image_np: np.ndarray,
+                           bright_pct: float,
+                           dark_pct: float,
+                           levels=None) -> np.ndarray:
     """
-    Stretch contrast by clipping a percentage of extreme pixels.
+    Apply white balance by stretching based on brightest and darkest percentiles.
+    Pass precomputed (min_vals, max_vals) levels, e.g. from a roll profile,
+    to skip the per-frame estimation.
     """
-    gray = np.dot(image_np[..., :3], [0.299, 0.587, 0.114])
-    hist, _ = np.histogram(gray.flatten(), bins=256, range=(0,256))
+    if levels is None:
+        levels = white_balance_levels(image_np, bright_pct, dark_pct)
+    white = image_io.max_value(image_np)
+    scale, offset = white_balance_scale(levels, white)
+
+    return bands.pointwise(lambda band: np.clip(band.astype(float) * scale + offset, 0, white).astype(band.dtype),
+                           image_np)
+
+
+@instrument.timed
+def gray_histogram(image_np: np.ndarray, band_rows: int = 256) -> np.ndarray:
+    """
+    Histogram of the 0.299/0.587/0.114 gray level, one bin per level (256 for
+    8-bit, 65536 for 16-bit), accumulated in row bands so no full-size float
+    image is allocated.
+    """
+    levels = image_io.max_value(image_np) + 1
+    hist = np.zeros(levels, dtype=np.int64)
+    for y in range(0, image_np.shape[0], band_rows):
+        gray = np.dot(image_np[y:y+band_rows, :, :3], [0.299, 0.587, 0.114])
+        hist += np.histogram(gray.flatten(), bins=levels, range=(0,levels))[0]
+    return hist
+
+
+def contrast_limits(hist: np.ndarray, clip_pct: float):
+    """Gray levels (low, high) clipping clip_pct of the histogram at each end, or None."""
     cdf = hist.cumsum()
     total = cdf[-1]
     clip = clip_pct * total
@@ -60,23 +122,441 @@ def auto_contrast(image_np: np.ndarray, clip_pct: float) -> np.ndarray:
     low = np.searchsorted(cdf, clip)
     high = np.searchsorted(cdf, total - clip)
     if high <= low:
+        return None
+    return low, high
+
+
+@instrument.timed
+def auto_contrast_limits(image_np: np.ndarray, clip_pct: float):
+    """
+    Find the gray levels (low, high) that clip a percentage of extreme pixels,
+    or None if there is nothing to stretch.
+    """
+    return contrast_limits(gray_histogram(image_np), clip_pct)
+
+
+@instrument.timed
+def auto_contrast(image_np: np.ndarray, clip_pct: float, limits=None) -> np.ndarray:
+    """
+    Stretch contrast by clipping a percentage of extreme pixels.
+    Pass precomputed (low, high) limits to skip the per-frame estimation.
+    """
+    if limits is None:
+        limits = auto_contrast_limits(image_np, clip_pct)
+    if limits is None:
         return image_np.copy()
+    low, high = limits
+    white = image_io.max_value(image_np)
+
+    scale = float(white) / (high - low)
+    offset = -low * scale
+    return bands.pointwise(lambda band: np.clip(band.astype(float) * scale + offset, 0, white).astype(band.dtype),
+                           image_np)
+
+
+# --- Lookup table fast path ---
+# Every stage after the statistics are known is a per-channel map of integer
+# values, so the chain is composed into one (3, 256) table (3, 65536 for
+# 16-bit) and applied once. Each table entry goes through exactly the same
+# float arithmetic as the array functions above, so the result is identical
+# to the float path.
+
+@instrument.timed
+def build_invert_lut(blend_color: np.ndarray, dtype=np.uint8) -> np.ndarray:
+    """Per-channel table for divide_blend followed by invert_image."""
+    levels = np.arange(np.iinfo(dtype).max + 1, dtype=dtype)
+    lut = np.empty((3, len(levels)), dtype=dtype)
+    for c in range(3):
+        lut[c] = invert_image(divide_blend(levels, blend_color[c]))
+    return lut
+
+
+def compose_white_balance_lut(lut: np.ndarray, levels) -> np.ndarray:
+    """Append the enhanced_white_balance scale/offset to a per-channel table."""
+    white = image_io.max_value(lut)
+    scale, offset = white_balance_scale(levels, white)
+    wb = lut.astype(float) * scale[:, None] + offset[:, None]
+    return np.clip(wb, 0, white).astype(lut.dtype)
+
+
+def compose_auto_contrast_lut(lut: np.ndarray, limits) -> np.ndarray:
+    """Append the auto_contrast stretch to a per-channel table."""
+    if limits is None:
+        return lut
+    low, high = limits
+    white = image_io.max_value(lut)
+    scale = float(white) / (high - low)
+    offset = -low * scale
+    ac = lut.astype(float) * scale + offset
+    return np.clip(ac, 0, white).astype(lut.dtype)
+
+
+@instrument.timed
+def apply_lut(image_np: np.ndarray, lut: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    Map each channel of an RGB image through its table, into out if given.
+    8-bit frames go through one cv2.LUT call for all three channels; 16-bit
+    frames (which cv2.LUT does not take) through per-channel fancy indexing.
+    """
+    if out is None:
+        out = np.empty_like(image_np)
+
+    if image_np.dtype == np.uint8:
+        import cv2
+        table = np.ascontiguousarray(lut.T).reshape(256, 1, 3)
+
+        def band(y0, y1):
+            dst = out[y0:y1]
+            mapped = cv2.LUT(image_np[y0:y1], table, dst=dst)
+            if mapped is not dst:   # out not usable as a cv2 destination (e.g. a strided view)
+                dst[...] = mapped
+    else:
+        def band(y0, y1):
+            for c in range(3):
+                out[y0:y1, ..., c] = lut[c][image_np[y0:y1, ..., c]]
+
+    bands.run(band, len(image_np), image_np.size // max(len(image_np), 1))
+    return out
+
+
+# --- Stacks of frames ---
+# Contact sheets and previews process hundreds of small, equally sized
+# proxies. The *_stack functions take an (N, H, W, 3) stack or a list of
+# frames and work on chunks of frames at once: per-frame histograms from one
+# bincount over frame-offset values, percentiles and contrast limits row by
+# row, an (N, levels, 3) table array composed for all frames, and one
+# broadcast gather to apply it. Chunks hold at most STACK_CHUNK elements, so
+# temporaries do not grow with the stack. Per frame the results are
+# identical to the single-frame functions; shared=True takes the statistics
+# of the whole stack instead, so every frame of a roll gets the same levels.
+
+STACK_CHUNK = 1 << 22   # elements (pixel values or histogram bins) per chunk of frames
+
+
+def _stack_output(frames, out: np.ndarray = None) -> np.ndarray:
+    """out, or a new (N, H, W, 3) array for the frames."""
+    if out is None:
+        out = np.empty((len(frames),) + frames[0].shape, dtype=frames[0].dtype)
+    return out
+
+
+def _stack_chunks(frames, levels: int = 0):
+    """(i, j, chunk) for runs of frames within STACK_CHUNK elements, each with histograms of `levels` bins."""
+    step = max(1, STACK_CHUNK // max(frames[0].size, levels))
+    for i in range(0, len(frames), step):
+        chunk = frames[i:i+step]
+        yield i, i + len(chunk), chunk if isinstance(chunk, np.ndarray) else np.stack(chunk)
+
+
+def _lut_chunks(luts: np.ndarray):
+    """(i, j) runs of an (N, levels, 3) table array within STACK_CHUNK entries."""
+    step = max(1, STACK_CHUNK // (luts.shape[1] * 3))
+    return [(i, min(i + step, len(luts))) for i in range(0, len(luts), step)]
+
+
+def build_invert_luts(blend_colors: np.ndarray, dtype=np.uint8) -> np.ndarray:
+    """build_invert_lut for each row of an (N, 3) blend colour array: (N, levels, 3)."""
+    white = np.iinfo(dtype).max
+    levels = np.arange(white + 1, dtype=float)[None, :, None]
+    luts = np.empty((len(blend_colors), white + 1, 3), dtype=dtype)
+    for i, j in _lut_chunks(luts):
+        divided = np.clip((levels / blend_colors[i:j, None, :]) * float(white), 0, white).astype(dtype)
+        luts[i:j] = white - divided
+    return luts
 
-    scale = 255.0 / (high - low)
+
+def identity_luts(n: int, dtype=np.uint8) -> np.ndarray:
+    """(N, levels, 3) tables mapping every level to itself."""
+    levels = np.arange(np.iinfo(dtype).max + 1, dtype=dtype)
+    return np.repeat(np.broadcast_to(levels[None, :, None], (1, len(levels), 3)), n, axis=0)
+
+
+def compose_white_balance_luts(luts: np.ndarray, levels) -> np.ndarray:
+    """compose_white_balance_lut for every frame, in place; levels are (min_vals, max_vals) of shape (N, 3)."""
+    white = image_io.max_value(luts)
+    scale, offset = white_balance_scale(levels, white)
+    for i, j in _lut_chunks(luts):
+        luts[i:j] = np.clip(luts[i:j].astype(float) * scale[i:j, None, :] + offset[i:j, None, :], 0, white)
+    return luts
+
+
+def compose_auto_contrast_luts(luts: np.ndarray, limits) -> np.ndarray:
+    """compose_auto_contrast_lut for every frame, in place; limits has one (low, high) or None per frame."""
+    white = image_io.max_value(luts)
+    # None leaves the table as it is: (0, white) is the identity stretch
+    low = np.array([0 if lim is None else lim[0] for lim in limits], dtype=np.int64)
+    high = np.array([white if lim is None else lim[1] for lim in limits], dtype=np.int64)
+    scale = float(white) / (high - low)
     offset = -low * scale
-    ac = image_np.astype(float) * scale + offset
-    return np.clip(ac, 0, 255).astype(np.uint8)
+    for i, j in _lut_chunks(luts):
+        luts[i:j] = np.clip(luts[i:j].astype(float) * scale[i:j, None, None] + offset[i:j, None, None], 0, white)
+    return luts
+
+
+@instrument.timed
+def apply_luts(frames, luts: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """Map every frame through its own tables (luts: (N, levels, 3)) with one gather per chunk, into out if given."""
+    out = _stack_output(frames, out)
+    for i, j, chunk in _stack_chunks(frames):
+        mapped = np.take_along_axis(luts[i:j], chunk.reshape(j - i, -1, 3), axis=1)
+        out[i:j] = mapped.reshape(chunk.shape)
+    return out
+
+
+def _extreme_levels(chunk: np.ndarray, brightness: np.ndarray, bright_th: np.ndarray, dark_th: np.ndarray):
+    """Per-frame channel minimum of the pixels at or above bright_th and maximum at or below dark_th."""
+    white = image_io.max_value(chunk)
+    bright = brightness >= bright_th[:, None, None]
+    dark = brightness <= dark_th[:, None, None]
+    min_vals = np.empty((len(chunk), 3), dtype=chunk.dtype)
+    max_vals = np.empty((len(chunk), 3), dtype=chunk.dtype)
+    for c in range(3):
+        channel = chunk[..., c]
+        min_vals[:, c] = channel.min(axis=(1, 2), initial=white, where=bright)
+        max_vals[:, c] = channel.max(axis=(1, 2), initial=0, where=dark)
+    return min_vals, max_vals
+
+
+@instrument.timed
+def white_balance_levels_stack(frames, bright_pct: float, dark_pct: float, shared: bool = False):
+    """
+    white_balance_levels of every frame: (min_vals, max_vals), each (N, 3).
+    With shared=True the thresholds come from the brightness histogram of
+    all frames and the levels are the same for every frame.
+    """
+    n = len(frames)
+    dtype = frames[0].dtype
+    levels = image_stats.luminance_levels(dtype)
+    min_vals = np.empty((n, 3), dtype=dtype)
+    max_vals = np.empty((n, 3), dtype=dtype)
+    total = np.zeros(levels, dtype=np.int64)
+    for i, j, chunk in _stack_chunks(frames, levels):
+        brightness = image_stats.luminance_sum(chunk)
+        hists = image_stats.histograms(brightness, levels)
+        if shared:
+            total += hists.sum(axis=0)
+            continue
+        bright_th = image_stats.percentiles(hists, bright_pct)
+        dark_th = image_stats.percentiles(hists, dark_pct)
+        min_vals[i:j], max_vals[i:j] = _extreme_levels(chunk, brightness, bright_th, dark_th)
+    if not shared:
+        return min_vals, max_vals
+
+    bright_th, dark_th = white_balance_thresholds(total, bright_pct, dark_pct)
+    for i, j, chunk in _stack_chunks(frames):
+        min_vals[i:j], max_vals[i:j] = _extreme_levels(chunk, image_stats.luminance_sum(chunk),
+                                                       np.full(j - i, bright_th), np.full(j - i, dark_th))
+    min_vals[:] = min_vals.min(axis=0)
+    max_vals[:] = max_vals.max(axis=0)
+    return min_vals, max_vals
+
 
+@instrument.timed
+def enhanced_white_balance_stack(frames, bright_pct: float, dark_pct: float, levels=None,
+                                 shared: bool = False, out: np.ndarray = None) -> np.ndarray:
+    """
+    enhanced_white_balance of every frame. levels are (min_vals, max_vals) of
+    shape (N, 3), or (3,) for all frames (e.g. from a roll profile).
+    """
+    if levels is None:
+        levels = white_balance_levels_stack(frames, bright_pct, dark_pct, shared=shared)
+    levels = [np.broadcast_to(v, (len(frames), 3)) for v in levels]
+    luts = compose_white_balance_luts(identity_luts(len(frames), frames[0].dtype), levels)
+    return apply_luts(frames, luts, out=out)
+
+
+def _gray_levels(chunk: np.ndarray) -> np.ndarray:
+    """Integer 0.299/0.587/0.114 gray of a chunk of frames, as binned by gray_histogram."""
+    gray = np.empty(chunk.shape[:3], dtype=np.int32)
+    # float -> int assignment truncates, i.e. the bin index of np.histogram(range=(0, levels))
+    gray[...] = np.dot(chunk[..., :3], [0.299, 0.587, 0.114])
+    return gray
+
+
+@instrument.timed
+def auto_contrast_limits_stack(frames, clip_pct: float, shared: bool = False) -> list:
+    """
+    auto_contrast_limits of every frame: a list of (low, high) or None per
+    frame. With shared=True every frame gets the limits of the summed histogram.
+    """
+    levels = image_io.max_value(frames[0]) + 1
+    total = np.zeros(levels, dtype=np.int64)
+    limits = []
+    for i, j, chunk in _stack_chunks(frames, levels):
+        hists = image_stats.histograms(_gray_levels(chunk), levels)
+        if shared:
+            total += hists.sum(axis=0)
+            continue
+        cdf = hists.cumsum(axis=1)
+        clip = clip_pct * cdf[:, -1]
+        # searchsorted(side='left') row by row: the number of cumulative counts < the target
+        low = (cdf < clip[:, None]).sum(axis=1)
+        high = (cdf < (cdf[:, -1] - clip)[:, None]).sum(axis=1)
+        limits += [(lo, hi) if hi > lo else None for lo, hi in zip(low, high)]
+    if shared:
+        return [contrast_limits(total, clip_pct)] * len(frames)
+    return limits
+
+
+@instrument.timed
+def auto_contrast_stack(frames, clip_pct: float, shared: bool = False, out: np.ndarray = None) -> np.ndarray:
+    """auto_contrast of every frame."""
+    limits = auto_contrast_limits_stack(frames, clip_pct, shared=shared)
+    luts = compose_auto_contrast_luts(identity_luts(len(frames), frames[0].dtype), limits)
+    return apply_luts(frames, luts, out=out)
+
+
+@instrument.timed
+def invert_stack(frames,
+                 blend_color: np.ndarray,
+                 autocontrast: bool = False,
+                 bright_pct: float = 99.99,
+                 dark_pct: float = 0.1,
+                 clip_pct: float = 0.01,
+                 wb_levels=None,
+                 shared: bool = False,
+                 out: np.ndarray = None) -> np.ndarray:
+    """
+    invert_array for every frame, into out if given. blend_color is (3,) for
+    all frames or (N, 3) per frame; wb_levels as in enhanced_white_balance_stack.
+    With shared=True white balance and auto contrast use roll-wide statistics.
+    """
+    n = len(frames)
+    out = _stack_output(frames, out)
+    blend_colors = np.broadcast_to(np.asarray(blend_color, dtype=float), (n, 3))
+    # 1) + 2) Divide blend and invert
+    luts = build_invert_luts(blend_colors, out.dtype)
+    apply_luts(frames, luts, out=out)
+    # 3) White balance, statistics taken on the inverted frames
+    if wb_levels is None:
+        wb_levels = white_balance_levels_stack(out, bright_pct, dark_pct, shared=shared)
+    compose_white_balance_luts(luts, [np.broadcast_to(v, (n, 3)) for v in wb_levels])
+    # 4) Optional auto-contrast, statistics taken on the white balanced frames
+    if autocontrast:
+        apply_luts(frames, luts, out=out)
+        compose_auto_contrast_luts(luts, auto_contrast_limits_stack(out, clip_pct, shared=shared))
+    return apply_luts(frames, luts, out=out)
 
-def save_image(image_np: np.ndarray, base_name: str, suffix: str) -> str:
-    """Save array as PNG with timestamped filename."""
+
+@instrument.timed
+def save_image(image_np: np.ndarray, base_name: str, suffix: str, output_format: str = "png",
+               compress_level: int = None, jpeg_quality: int = 95) -> str:
+    """Save array (8- or 16-bit) as PNG (or TIFF / JPEG, see image_io.OUTPUT_FORMATS) with timestamped filename."""
     #ts = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
     #filename = f"{base_name}inverted_{ts}.png"
-    filename = f"{base_name}inverted.png"
-    Image.fromarray(image_np).save(filename, format="PNG")
+    filename = f"{base_name}inverted{image_io.OUTPUT_FORMATS[output_format][1]}"
+    image_io.write_rgb(filename, image_np, **image_io.output_params(output_format, compress_level, jpeg_quality))
     return filename
 
 
+def parse_blend_color(bc):
+    """Turn the JSON 'blend_color' ({r, g, b} or [r, g, b]) into a float array, or None."""
+    corrector=[0,0,0]
+    if isinstance(bc, dict):
+        return np.array([bc.get('r')+corrector[0], bc.get('g')+corrector[1], bc.get('b')+corrector[2]], dtype=float)
+    elif isinstance(bc, (list, tuple, np.ndarray)) and len(bc) == 3:
+        return np.array(bc, dtype=float)
+    return None
+
+
+def parse_wb_levels(wb, dtype=np.uint8, bits: int = None):
+    """
+    Turn the JSON 'white_balance' ({bright: [r, g, b], dark: [r, g, b]}) into
+    levels for images of the given dtype, or None. bits is the bit depth the
+    levels were measured at (a roll profile's 'bits'); levels of another bit
+    depth are rescaled to dtype.
+    """
+    if isinstance(wb, dict) and 'bright' in wb and 'dark' in wb:
+        white = np.iinfo(dtype).max
+        return tuple(np.clip(np.round(image_io.rescale_levels(wb[key], bits, dtype)), 0, white).astype(dtype)
+                     for key in ('bright', 'dark'))
+    return None
+
+
+@instrument.timed
+def load_image(config: dict) -> np.ndarray:
+    """
+    The frame named by a JSON config: memory-mapped when shape_image.py handed
+    it over as raw pixels ('raw': {'shape', 'dtype'}), decoded otherwise.
+    Returns None if unreadable.
+    """
+    raw = config.get('raw')
+    if raw:
+        return image_io.open_raw(config['image_path'], raw['shape'], raw['dtype'])
+    return image_io.read_rgb(config['image_path'])
+
+
+def invert_array(img_np: np.ndarray,
+                 blend_color: np.ndarray,
+                 autocontrast: bool = False,
+                 bright_pct: float = 99.99,
+                 dark_pct: float = 0.1,
+                 clip_pct: float = 0.01,
+                 wb_levels=None,
+                 float_path: bool = False,
+                 out: np.ndarray = None,
+                 ac_limits=None) -> np.ndarray:
+    """
+    Divide blend, invert, white balance and optionally auto-contrast a negative.
+    wb_levels overrides the per-frame white balance estimation, ac_limits
+    the auto contrast one (see color_levels).
+    By default the stages are composed into one lookup table; float_path runs
+    the original per-stage float arithmetic (same result, for verification).
+    out is an optional preallocated array of the image's shape and dtype for
+    the result (lookup table path only).
+    """
+    if float_path:
+        # 1) Divide blend
+        divided = divide_blend(img_np, blend_color)
+        # 2) Invert
+        inverted = invert_image(divided)
+        # 3) White balance with fixed percentiles
+        result = enhanced_white_balance(inverted, bright_pct=bright_pct, dark_pct=dark_pct, levels=wb_levels)
+        # 4) Optional auto-contrast
+        if autocontrast:
+            result = auto_contrast(result, clip_pct=clip_pct, limits=ac_limits)
+        return result
+
+    # 1) + 2) Divide blend and invert
+    lut = build_invert_lut(np.asarray(blend_color, dtype=float), img_np.dtype)
+    work = apply_lut(img_np, lut, out=out)
+    # 3) White balance, statistics taken on the inverted frame
+    if wb_levels is None:
+        wb_levels = white_balance_levels(work, bright_pct, dark_pct)
+    lut = compose_white_balance_lut(lut, wb_levels)
+    # 4) Optional auto-contrast, statistics taken on the white balanced frame
+    if autocontrast:
+        if ac_limits is None:
+            apply_lut(img_np, lut, out=work)
+            ac_limits = auto_contrast_limits(work, clip_pct)
+        lut = compose_auto_contrast_lut(lut, ac_limits)
+    return apply_lut(img_np, lut, out=work)
+
+
+def color_levels(img_np: np.ndarray,
+                 blend_color: np.ndarray,
+                 autocontrast: bool = False,
+                 bright_pct: float = 99.99,
+                 dark_pct: float = 0.1,
+                 clip_pct: float = 0.01,
+                 wb_levels=None):
+    """
+    The white balance levels and auto contrast limits (None without
+    autocontrast) that invert_array estimates for a frame. Measured on a
+    proxy and passed to invert_array for the full frame, they give both the
+    same colours.
+    """
+    lut = build_invert_lut(np.asarray(blend_color, dtype=float), img_np.dtype)
+    work = apply_lut(img_np, lut)
+    if wb_levels is None:
+        wb_levels = white_balance_levels(work, bright_pct, dark_pct)
+    ac_limits = None
+    if autocontrast:
+        apply_lut(img_np, compose_white_balance_lut(lut, wb_levels), out=work)
+        ac_limits = auto_contrast_limits(work, clip_pct)
+    return wb_levels, ac_limits
+
+
 def main():
     """Read JSON config from file, process image, and show/save results."""
     parser = argparse.ArgumentParser(
@@ -99,46 +579,41 @@ def main():
         return
 
     # Read blend_color from JSON
-    bc = config.get('blend_color')
-    corrector=[0,0,0]
-    if isinstance(bc, dict):
-        blend_color = np.array([bc.get('r')+corrector[0], bc.get('g')+corrector[1], bc.get('b')+corrector[2]], dtype=float)
-    elif isinstance(bc, list) and len(bc) == 3:
-        blend_color = np.array(bc, dtype=float)
-    else:
+    blend_color = parse_blend_color(config.get('blend_color'))
+    if blend_color is None:
         print("Config missing or invalid 'blend_color'.")
         return
 
-    # Load image
-    img = Image.open(image_path).convert('RGB')
-    img_np = np.array(img)
+    # Load image (8- or 16-bit), or map the raw hand-off of shape_image.py
+    img_np = load_image(config)
+    if img_np is None:
+        print(f"Couldn’t open {image_path}")
+        return
     base, _ = os.path.splitext(image_path)
 
-    # 1) Divide blend
-    divided = divide_blend(img_np, blend_color)
-    print(f"Divide blend applied with color {blend_color.tolist()}")
+    # Optional roll-level white balance levels (see roll_profile.py)
+    wb_levels = parse_wb_levels(config.get('white_balance'), img_np.dtype)
 
-    # 2) Invert
-    inverted = invert_image(divided)
+    autocontrast = config.get('autocontrast', False)
+    out_np = invert_array(img_np, blend_color, autocontrast=autocontrast, wb_levels=wb_levels,
+                          float_path=config.get('float_path', False))
+    print(f"Divide blend applied with color {blend_color.tolist()}")
     print("Image inverted")
 
-    # 3) White balance with fixed percentiles
-    wb_np = enhanced_white_balance(inverted, bright_pct=99.99, dark_pct=0.1)
-     
-    wb_file = save_image(wb_np, base, 'wb')
-    if debug:    
-        print(f"White balanced image saved as {wb_file}")
-        Image.fromarray(wb_np).show()
-
-    # 4) Optional auto-contrast via JSON flag
-    if config.get('autocontrast', False) :
-        ac_np = auto_contrast(wb_np, clip_pct=0.01)
-        ac_file = save_image(ac_np, base, 'ac')
-        print(f"Auto contrast image saved as {ac_file}")
-        Image.fromarray(ac_np).show()
+    # Optional output encoding: "output_format" png / tiff / tiff-lzw / jpeg, "compress_level", "jpeg_quality"
+    out_file = save_image(out_np, base, 'ac' if autocontrast else 'wb', output_format=config.get('output_format', 'png'),
+                          compress_level=config.get('compress_level'), jpeg_quality=config.get('jpeg_quality', 95))
+    from PIL import Image  # previews only
+    if autocontrast:
+        print(f"Auto contrast image saved as {out_file}")
+        Image.fromarray(image_io.to_8bit(out_np)).show()
     else:
+        if debug:
+            print(f"White balanced image saved as {out_file}")
+            Image.fromarray(image_io.to_8bit(out_np)).show()
         print("Auto contrast not applied")
         
+    del img_np  # release a raw memory map before the file is deleted
     should_delete = config.get("delete_after_use", False)
 
     if should_delete:
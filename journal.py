@@ -0,0 +1,172 @@
+"""
+Progress journal for resumable batch jobs (batch.py --journal DIR).
+
+Skipping frames whose `<name>_inverted.png` exists cannot tell a finished
+output from one cut off by a crash, and redoes the analysis of frames that
+were interrupted during inversion. The journal keeps one small JSON file
+per frame (named by the SHA-1 of the scan's absolute path), replaced
+atomically and fsynced at each step:
+
+    {"image_path": ..., "input": [size, mtime_ns], "options": <key>, "analysis_key": <key>,
+     "analysis": {"blend_color": ..., "crop_rect": ..., "skew_angle": ..., "input_size": ...},
+     "outputs": [{"path": ..., "size": ..., "sha1": ...}], "done": true}
+
+"analysis" is written by the worker as soon as the frame is analysed,
+"outputs" and "done" by batch.py once the positive has been fsynced and
+renamed into place. Restarting the same command resumes the job: frames
+done with the same input and options whose outputs are intact are skipped, frames with
+only an analysis are inverted without analysing them again, and the rest
+start over. The SHA-1 of every output is checked as well, so a damaged or
+replaced output of the same size is converted again. manifest.json records
+the options of the job; batch.py warns before resuming a journal written
+with other options, whose finished frames are then converted again.
+"""
+import hashlib
+import json
+import os
+
+import image_io
+
+JOURNAL_VERSION = 1
+
+# process_file options that change the output, and those that change the analysis
+OUTPUT_OPTIONS = ("autocontrast", "profile", "analysis_size", "strip", "max_frames", "output_format",
+                  "compress_level", "jpeg_quality", "interpolation", "min_skew")
+ANALYSIS_OPTIONS = ("profile", "analysis_size", "strip", "max_frames")
+
+
+def options_key(options: dict, names) -> str:
+    """SHA-1 of the named options, with the journal version."""
+    values = {name: options.get(name) for name in names}
+    return hashlib.sha1(json.dumps({"version": JOURNAL_VERSION, **values}, sort_keys=True,
+                                   default=str).encode()).hexdigest()
+
+
+def input_stamp(image_path: str):
+    st = os.stat(image_path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def output_paths(result: dict):
+    """Every output of a result record (one, or one per frame in strip mode)."""
+    if "frames" in result:
+        return [f["output_path"] for f in result["frames"]]
+    return [result["output_path"]]
+
+
+def write_json_durable(path: str, obj):
+    """Write JSON under a temporary name, fsync it and rename it into place."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    image_io.commit(tmp, path, durable=True)
+
+
+class Journal:
+    """Per-frame progress records of a batch job in one folder."""
+
+    def __init__(self, folder: str, options: dict):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.options = options_key(options, OUTPUT_OPTIONS)
+        self.analysis_options = options_key(options, ANALYSIS_OPTIONS)
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.folder, "manifest.json")
+
+    def changed_options(self, options: dict):
+        """
+        Names of the output options that differ from those in manifest.json
+        ([] for a new journal or the same options).
+        """
+        try:
+            with open(self._manifest_path(), 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return []
+        if manifest.get("options_key") == self.options:
+            return []
+        stored = manifest.get("options", {})
+        current = json.loads(json.dumps({name: options.get(name) for name in OUTPUT_OPTIONS}, default=str))
+        return [name for name in OUTPUT_OPTIONS if stored.get(name) != current[name]] or ["version"]
+
+    def write_manifest(self, options: dict, frames: int):
+        manifest = {"version": JOURNAL_VERSION, "frames": frames, "options_key": self.options,
+                    "options": {name: options.get(name) for name in OUTPUT_OPTIONS}}
+        write_json_durable(self._manifest_path(), manifest)
+
+    def _path(self, image_path: str) -> str:
+        name = hashlib.sha1(os.path.abspath(image_path).encode()).hexdigest()
+        return os.path.join(self.folder, name + ".json")
+
+    def load(self, image_path: str):
+        try:
+            with open(self._path(image_path), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def plan(self, image_path: str):
+        """
+        ("done", record), ("analysed", analysis result) or ("todo", None) for
+        a frame.
+        """
+        record = self.load(image_path)
+        try:
+            stamp = input_stamp(image_path)
+        except OSError:
+            return "todo", None
+        if not record or record.get("input") != stamp or record.get("analysis_key") != self.analysis_options:
+            return "todo", None
+        if record.get("done") and record.get("options") == self.options and self._outputs_intact(record):
+            return "done", record
+        return ("analysed", record["analysis"]) if "analysis" in record else ("todo", None)
+
+    @staticmethod
+    def _outputs_intact(record: dict) -> bool:
+        """Every output still has its recorded size and SHA-1 (hashed only when the size matches)."""
+        import cache
+        for out in record.get("outputs", ()):
+            try:
+                if os.path.getsize(out["path"]) != out["size"] or cache.file_digest(out["path"]) != out.get("sha1"):
+                    return False
+            except OSError:
+                return False
+        return bool(record.get("outputs"))
+
+    def record_analysis(self, image_path: str, result: dict):
+        """Called by the worker once the frame is analysed."""
+        analysis = {key: result[key] for key in ("blend_color", "crop_rect", "skew_angle", "input_size")}
+        write_json_durable(self._path(image_path), {
+            "image_path": image_path, "input": input_stamp(image_path),
+            "analysis_key": self.analysis_options, "analysis": analysis})
+
+    def record_done(self, image_path: str, result: dict):
+        """Called by batch.py once every output of the frame is on disk; stores their sizes and SHA-1."""
+        import cache
+        record = self.load(image_path) or {}
+        record.update(image_path=image_path, input=input_stamp(image_path), analysis_key=self.analysis_options,
+                      options=self.options, done=True,
+                      outputs=[{"path": path, "size": os.path.getsize(path), "sha1": cache.file_digest(path)}
+                               for path in output_paths(result)])
+        if "frames" not in result:
+            record["analysis"] = {key: result[key] for key in ("blend_color", "crop_rect", "skew_angle",
+                                                               "input_size")}
+        write_json_durable(self._path(image_path), record)
+
+
+def remove_partials(out_path: str):
+    """Delete temporary files of interrupted writes of out_path (image_io.partial_path)."""
+    folder = os.path.dirname(os.path.abspath(out_path))
+    root, ext = os.path.splitext(os.path.basename(out_path))
+    prefix = root + ".partial-"
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+    for name in names:
+        if name.startswith(prefix) and name.endswith(ext):
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
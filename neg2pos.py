@@ -0,0 +1,298 @@
+"""
+Python API: embed the neg2pos pipeline in another program.
+
+    from neg2pos import Pipeline, Settings
+
+    pipe = Pipeline(Settings(autocontrast=True, analysis_size=1500))
+    positive, result = pipe.process(rgb)            # RGB uint8 / uint16 array
+    result = pipe.process_file("frame01.tif")       # writes frame01_inverted.png
+
+    session = Session("frame01.tif", Settings())    # interactive tuning of one frame
+    positive, result = session.render(clip_pct=0.1) # only the stages after a change rerun
+
+Settings holds every parameter the command-line tools take from argv or
+from the shape_image -> invert_image JSON, plus the percentiles and limits
+those tools fix (white balance and contrast percentiles, the rebate
+threshold, the skew cutoff). It is checked when it is created, so a typo
+fails at start-up rather than on the first frame.
+
+A Pipeline is created once and reused for any number of frames. It keeps
+its output buffer between frames, so the positive returned by process() is
+overwritten by the next call: copy it if it has to outlive that call, or
+pass reuse_buffers=False. Use one Pipeline per thread.
+
+A Session keeps the output of every stage for one frame in memory, keyed
+by the parameters it was computed with, so a re-render after changing
+clip_pct only recomputes the contrast limits and the final lookup.
+"""
+import json
+import os
+from dataclasses import dataclass, fields, replace
+from typing import Optional, Sequence
+
+import numpy as np
+
+import bands
+import image_io
+import image_stats
+import invert_image
+import pipeline
+import shape_image
+
+__all__ = ["Settings", "Pipeline", "Session"]
+
+
+@dataclass
+class Settings:
+    """Processing parameters of a Pipeline; the defaults are those of the command-line tools."""
+    # inversion
+    autocontrast: bool = False
+    bright_pct: float = 99.99        # white balance: percentile taken as white
+    dark_pct: float = 0.1            # white balance: percentile taken as black
+    clip_pct: float = 0.01           # auto contrast: percent clipped at each end
+    float_path: bool = False         # per-stage float arithmetic instead of the lookup table
+    # shape analysis
+    highlight_pct: float = 3         # brightest percent of the frame averaged into the blend colour
+    rebate_pct: float = 90           # brightness percentile separating the rebate
+    max_skew: float = 20             # larger skew angles are misdetections and ignored
+    analysis_size: Optional[int] = None   # analyse a proxy with this longest edge
+    blend_color: Optional[Sequence[float]] = None   # fixed [r, g, b]; skips the estimation
+    profile: Optional[dict] = None   # roll profile (roll_profile.py); overrides blend_color
+    # deskew warp
+    interpolation: str = "linear"
+    min_skew: float = 0.0
+    # output
+    output_format: str = "png"
+    compress_level: Optional[int] = None
+    jpeg_quality: int = 95
+
+    def __post_init__(self):
+        for name in ("bright_pct", "dark_pct", "clip_pct", "highlight_pct", "rebate_pct"):
+            if not 0 <= getattr(self, name) <= 100:
+                raise ValueError(f"{name} must be a percentage, got {getattr(self, name)}")
+        if self.dark_pct >= self.bright_pct:
+            raise ValueError("dark_pct must be below bright_pct")
+        if self.interpolation not in shape_image.INTERPOLATIONS:
+            raise ValueError(f"interpolation must be one of {', '.join(shape_image.INTERPOLATIONS)}")
+        if self.output_format not in image_io.OUTPUT_FORMATS:
+            raise ValueError(f"output_format must be one of {', '.join(sorted(image_io.OUTPUT_FORMATS))}")
+        if self.compress_level is not None and not 0 <= self.compress_level <= 9:
+            raise ValueError("compress_level must be 0-9")
+        if self.blend_color is not None and len(self.blend_color) != 3:
+            raise ValueError("blend_color must be [r, g, b]")
+        if self.analysis_size is not None and self.analysis_size <= 0:
+            raise ValueError("analysis_size must be positive")
+
+    @classmethod
+    def from_dict(cls, config: dict) -> "Settings":
+        """Settings from a dict of field names (e.g. parsed JSON); unknown keys are an error."""
+        names = {f.name for f in fields(cls)}
+        unknown = sorted(set(config) - names)
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(unknown)}")
+        return cls(**config)
+
+    def profile_or_blend_color(self) -> Optional[dict]:
+        """The roll profile, or a minimal one holding the fixed blend colour."""
+        if self.profile is not None:
+            return self.profile
+        if self.blend_color is not None:
+            r, g, b = (float(v) for v in self.blend_color)
+            return {"blend_color": {"r": r, "g": g, "b": b}}
+        return None
+
+
+class Pipeline:
+    """Shape analysis, inversion and writing of frames with one Settings."""
+
+    def __init__(self, settings: Settings = None, reuse_buffers: bool = True, threads: int = None):
+        """threads: row-band threads of the pointwise stages in this process (see bands.py)."""
+        if threads is not None:
+            bands.set_threads(threads)
+        self.settings = settings or Settings()
+        self.reuse_buffers = reuse_buffers
+        self._buffers = {}   # dtype -> flat array, grown to the largest frame seen
+
+    def _output_buffer(self, shape, dtype) -> Optional[np.ndarray]:
+        if not self.reuse_buffers or self.settings.float_path:
+            return None
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        flat = self._buffers.get(dtype)
+        if flat is None or flat.size < size:
+            flat = self._buffers[dtype] = np.empty(size, dtype=dtype)
+        return flat[:size].reshape(shape)
+
+    def analyze(self, rgb: np.ndarray):
+        """
+        Shape analysis of a frame as read from disk (modified in place by the
+        perforation removal). Returns the cropped frame, the blend colour, the
+        white balance levels (None unless profiled) and the result record.
+        """
+        s = self.settings
+        return pipeline.analyze_array(rgb, profile=s.profile_or_blend_color(), analysis_size=s.analysis_size,
+                                      interpolation=s.interpolation, min_skew=s.min_skew,
+                                      highlight_pct=s.highlight_pct, rebate_pct=s.rebate_pct,
+                                      max_skew=s.max_skew)
+
+    def invert(self, cropped: np.ndarray, blend_color, wb_levels=None) -> np.ndarray:
+        """Invert a cropped frame; the result is in the reused buffer unless reuse_buffers is off."""
+        s = self.settings
+        return invert_image.invert_array(cropped, np.asarray(blend_color, dtype=float),
+                                         autocontrast=s.autocontrast, bright_pct=s.bright_pct,
+                                         dark_pct=s.dark_pct, clip_pct=s.clip_pct, wb_levels=wb_levels,
+                                         float_path=s.float_path,
+                                         out=self._output_buffer(cropped.shape, cropped.dtype))
+
+    def process(self, rgb: np.ndarray):
+        """
+        Positive of an RGB frame (uint8 or uint16, modified in place), with the
+        same bit depth, and the result record: blend_color, skew_angle,
+        crop_rect and input_size.
+        """
+        cropped, blend_color, wb_levels, result = self.analyze(rgb)
+        return self.invert(cropped, blend_color, wb_levels), result
+
+    def process_file(self, image_path: str, out_path: str = None) -> dict:
+        """
+        Process a scan on disk and write its positive (by default next to it as
+        <name>_inverted.<ext>). Returns the result record with image_path,
+        output_path and encode_seconds added.
+        """
+        s = self.settings
+        rgb = image_io.read_rgb(image_path)
+        if rgb is None:
+            raise IOError(f"Couldn’t open {image_path}")
+        positive, result = self.process(rgb)
+        out_path = out_path or pipeline.output_path_for(image_path, output_format=s.output_format)
+        result["image_path"] = image_path
+        result["output_path"] = out_path
+        result["encode_seconds"] = image_io.write_timed(
+            out_path, positive, **image_io.output_params(s.output_format, s.compress_level, s.jpeg_quality))
+        return result
+
+
+class Session:
+    """
+    Memoised stages of one frame for interactive tuning:
+
+        decode + perforation removal    file (path, size, mtime)
+        normalisation + crop detection  blend_color / profile, highlight_pct, rebate_pct,
+                                        max_skew, analysis_size
+        deskew                          interpolation, min_skew
+        divide/invert                   (blend colour, from the analysis)
+        white balance                   bright_pct, dark_pct (or the profile's levels)
+        auto contrast                   autocontrast, clip_pct
+
+    With float_path the inversion runs the per-stage float arithmetic of
+    invert_image.invert_array as one stage, keyed by all of its parameters.
+
+    Each stage's output is kept with the key of its parameters and of every
+    stage before it; render() reruns a stage only when that key changed.
+    Perforation removal has no parameters, so it is kept together with the
+    decoded frame. The statistics that do not depend on a stage's own
+    parameters (the brightness histogram of the inverted frame, the gray
+    histogram of the white balanced frame) are kept too, so changing a
+    percentile costs a histogram lookup and one table pass over the frame.
+    """
+
+    def __init__(self, image_path: str, settings: Settings = None):
+        self.image_path = image_path
+        self.settings = settings or Settings()
+        self._memo = {}   # stage -> (key, value)
+
+    def _stage(self, name: str, key, compute, recomputed: list):
+        cached = self._memo.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        value = compute()
+        self._memo[name] = (key, value)
+        recomputed.append(name)
+        return value
+
+    def render(self, settings: Settings = None, **changes):
+        """
+        Positive of the frame and its result record with the session's
+        settings, replaced by settings and/or updated with changes (Settings
+        fields). The new settings become the session's. The result lists the
+        stages that were run in 'recomputed'. The positive is kept for the next
+        render with the same settings, so it must not be modified.
+        """
+        s = self.settings = replace(settings or self.settings, **changes)
+        recomputed = []
+
+        def decode():
+            rgb = image_io.read_rgb(self.image_path)
+            if rgb is None:
+                raise IOError(f"Couldn’t open {self.image_path}")
+            return shape_image.remove_perforation(rgb)
+
+        st = os.stat(self.image_path)
+        key = (self.image_path, st.st_size, st.st_mtime_ns)
+        rgb = self._stage("decode", key, decode, recomputed)
+
+        profile_rgb, profile_wb = pipeline.profile_values(s.profile_or_blend_color(), rgb.dtype)
+        key += (json.dumps(profile_rgb), s.highlight_pct, s.rebate_pct, s.max_skew, s.analysis_size)
+        ref_rgb, crop_rect, angle = self._stage(
+            "analysis", key, lambda: shape_image.analyze_frame(rgb, ref_rgb=profile_rgb, analysis_size=s.analysis_size,
+                                                               highlight_pct=s.highlight_pct,
+                                                               rebate_pct=s.rebate_pct, max_skew=s.max_skew),
+            recomputed)
+
+        key += (s.interpolation, s.min_skew)
+        cropped = self._stage("deskew", key, lambda: shape_image.apply_crop_and_deskew(
+            rgb, crop_rect, angle, interpolation=s.interpolation, min_skew=s.min_skew), recomputed)
+
+        if s.float_path:
+            positive = self._render_float(s, key, cropped, ref_rgb, profile_wb, recomputed)
+        else:
+            positive = self._render_lut(s, key, cropped, ref_rgb, profile_wb, recomputed)
+
+        result = {
+            "image_path": self.image_path,
+            "blend_color": {"r": ref_rgb[0], "g": ref_rgb[1], "b": ref_rgb[2]},
+            "skew_angle": angle,
+            "crop_rect": [int(v) for v in crop_rect],
+            "input_size": [rgb.shape[1], rgb.shape[0]],
+            "recomputed": recomputed,
+        }
+        return positive, result
+
+    def _render_float(self, s: Settings, key, cropped, ref_rgb, profile_wb, recomputed: list):
+        # the per-stage float arithmetic is for verification, so it is kept as one stage
+        key += (s.float_path, json.dumps(profile_wb and [v.tolist() for v in profile_wb]),
+                s.bright_pct, s.dark_pct, s.autocontrast, s.clip_pct)
+        return self._stage("render", key, lambda: invert_image.invert_array(
+            cropped, np.asarray(ref_rgb, dtype=float), autocontrast=s.autocontrast, bright_pct=s.bright_pct,
+            dark_pct=s.dark_pct, clip_pct=s.clip_pct, wb_levels=profile_wb, float_path=True), recomputed)
+
+    def _render_lut(self, s: Settings, key, cropped, ref_rgb, profile_wb, recomputed: list):
+        def invert():
+            lut = invert_image.build_invert_lut(np.asarray(ref_rgb, dtype=float), cropped.dtype)
+            inverted = invert_image.apply_lut(cropped, lut)
+            brightness = image_stats.luminance_sum(inverted)
+            return lut, inverted, brightness, image_stats.histogram(brightness,
+                                                                    image_stats.luminance_levels(inverted))
+
+        lut, inverted, brightness, hist = self._stage("invert", key, invert, recomputed)
+
+        if profile_wb is None:
+            key += (s.bright_pct, s.dark_pct)
+            wb_levels = self._stage("white_balance", key, lambda: invert_image.white_balance_levels(
+                inverted, s.bright_pct, s.dark_pct, brightness=brightness, hist=hist), recomputed)
+        else:
+            key += (json.dumps([v.tolist() for v in profile_wb]),)
+            wb_levels = profile_wb
+        lut = invert_image.compose_white_balance_lut(lut, wb_levels)
+
+        if s.autocontrast:
+            gray_hist = self._stage("auto_contrast", key, lambda: invert_image.gray_histogram(
+                invert_image.apply_lut(cropped, lut)), recomputed)
+            lut = invert_image.compose_auto_contrast_lut(lut, invert_image.contrast_limits(gray_hist, s.clip_pct))
+            key += (s.clip_pct,)
+        key += (s.autocontrast, s.float_path)
+        return self._stage("render", key, lambda: invert_image.apply_lut(cropped, lut), recomputed)
+
+    def clear(self):
+        """Drop every kept stage output."""
+        self._memo.clear()
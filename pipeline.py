@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+Single-process neg2pos pipeline.
+
+Chains the shape_image analysis (perforation removal, highlight reference,
+rebate/inner crop, deskew) and the invert_image stages (divide blend, invert,
+white balance, auto contrast) on an in-memory array, so there is no
+intermediate `<name>_.png`, no JSON hand-off and no second interpreter.
+Any number of frames can be processed in one process.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import bands
+import image_io
+import instrument
+import shape_image
+import invert_image
+
+
+def output_path_for(image_path: str, index: int = None, output_format: str = "png") -> str:
+    """
+    Same naming as the shape_image -> invert_image chain: <name>_inverted.png;
+    <name>_inverted_<index>.png for the frames of a strip capture. The
+    extension follows output_format (.tif for TIFF, .jpg for JPEG).
+    """
+    ext = image_io.OUTPUT_FORMATS[output_format][1]
+    if index is None:
+        return os.path.splitext(image_path)[0] + "_inverted" + ext
+    return f"{os.path.splitext(image_path)[0]}_inverted_{index}{ext}"
+
+
+def analyze_array(rgb: np.ndarray, profile: dict = None, analysis_size: int = None, analysis: dict = None,
+                  interpolation: str = "linear", min_skew: float = 0.0, highlight_pct: float = 3,
+                  rebate_pct: float = 90, max_skew: float = 20):
+    """
+    Shape analysis half of the pipeline: perforation removal (in place),
+    blend colour, crop and deskew. With a roll profile (see roll_profile.py)
+    the blend colour and white balance levels are taken from it instead of
+    being estimated per frame. analysis_size runs the crop/skew analysis on a
+    downscaled proxy. A previous analysis result (e.g. from the cache) skips
+    the analysis and only crops and deskews. interpolation and min_skew are
+    passed to shape_image.apply_crop_and_deskew, highlight_pct, rebate_pct
+    and max_skew to shape_image.analyze_frame.
+    Returns the cropped frame, the blend colour, the white balance levels
+    (None unless profiled) and the analysis result.
+    """
+    profile_rgb, wb_levels = profile_values(profile, rgb.dtype)
+
+    h, w = rgb.shape[:2]
+    rgb_orig = shape_image.remove_perforation(rgb)
+    if analysis:
+        bc = analysis["blend_color"]
+        ref_rgb, crop_rect, angle = [bc["r"], bc["g"], bc["b"]], tuple(analysis["crop_rect"]), analysis["skew_angle"]
+    else:
+        ref_rgb, crop_rect, angle = shape_image.analyze_frame(rgb_orig, ref_rgb=profile_rgb,
+                                                              analysis_size=analysis_size,
+                                                              highlight_pct=highlight_pct, rebate_pct=rebate_pct,
+                                                              max_skew=max_skew)
+    cropped = shape_image.apply_crop_and_deskew(rgb_orig, crop_rect, angle, interpolation=interpolation,
+                                                min_skew=min_skew)
+
+    result = analysis_record(ref_rgb, crop_rect, angle, w, h)
+    return cropped, np.asarray(ref_rgb, dtype=float), wb_levels, result
+
+
+def analysis_record(ref_rgb, crop_rect, angle, w: int, h: int) -> dict:
+    """The analysis result of a w x h frame, as cached and journaled."""
+    return {
+        "blend_color": {"r": ref_rgb[0], "g": ref_rgb[1], "b": ref_rgb[2]},
+        "skew_angle": angle,
+        "crop_rect": [int(v) for v in crop_rect],
+        "input_size": [w, h],
+    }
+
+
+# warp settings of cached frames stored before they were recorded
+DEFAULT_WARP = {"interpolation": "linear", "min_skew": 0.0}
+
+
+def profile_values(profile: dict, dtype):
+    """
+    Blend colour [r, g, b] and white balance levels of a roll profile for
+    frames of dtype (None, None without one). A profile measured at another
+    bit depth (its 'bits') is rescaled, so an 8-bit profile fits 16-bit scans.
+    """
+    if not profile:
+        return None, None
+    bc = profile["blend_color"]
+    bits = profile.get("bits")
+    blend_color = image_io.rescale_levels([bc["r"], bc["g"], bc["b"]], bits, dtype).tolist()
+    return blend_color, invert_image.parse_wb_levels(profile.get("white_balance"), dtype, bits)
+
+
+def analyze_file(image_path: str, profile: dict = None, analysis_size: int = None,
+                 cache_dir: str = None, cache_frames: bool = False, cache_mb: float = 4096,
+                 interpolation: str = "linear", min_skew: float = 0.0, analysis: dict = None):
+    """
+    analyze_array for a scan on disk, with an optional analysis cache (see
+    cache.py): a cached result skips the analysis, a cached frame (stored with
+    cache_frames) also skips decoding, if it was warped with the same
+    interpolation and min_skew. A previous analysis result (e.g. from a batch
+    journal, see journal.py) skips the analysis like a cached one. Returns the same tuple as analyze_array;
+    the result has 'cache' set to "frame", "analysis" or "miss" when cache_dir is given.
+    """
+    store = key = cached = None
+    warp = {"interpolation": interpolation, "min_skew": min_skew}
+    if cache_dir:
+        import cache
+        store = cache.AnalysisCache(cache_dir, max_mb=cache_mb)
+        profile_rgb = [profile["blend_color"][c] for c in "rgb"] if profile else None
+        key = store.key(image_path, analysis_size=analysis_size, profile_blend_color=profile_rgb)
+        cached, frame = store.get(key)
+        if frame is not None and cached.pop("warp", DEFAULT_WARP) == warp:
+            _, wb_levels = profile_values(profile, frame.dtype)
+            bc = cached["blend_color"]
+            result = dict(cached, cache="frame")
+            return frame, np.array([bc["r"], bc["g"], bc["b"]], dtype=float), wb_levels, result
+
+    if cached is None:
+        cached = analysis
+    rgb = image_io.read_rgb(image_path)
+    if rgb is None:
+        raise IOError(f"Couldn’t open {image_path}")
+    cropped, blend_color, wb_levels, result = analyze_array(rgb, profile=profile, analysis_size=analysis_size,
+                                                            analysis=cached, **warp)
+    if store:
+        if cached is None or cache_frames:
+            store.put(key, dict(result, warp=warp) if cache_frames else result, cropped if cache_frames else None)
+        result["cache"] = "analysis" if cached else "miss"
+    return cropped, blend_color, wb_levels, result
+
+
+def process_array(rgb: np.ndarray, autocontrast: bool = False, profile: dict = None,
+                  float_path: bool = False, analysis_size: int = None, interpolation: str = "linear",
+                  min_skew: float = 0.0):
+    """
+    Run the full pipeline on an RGB frame (uint8 or uint16) as read from disk;
+    the positive has the same bit depth.
+    The array is modified in place by the perforation removal.
+    float_path selects the per-stage float inversion instead of the lookup table.
+    Returns the positive image and the analysis result.
+    """
+    cropped, blend_color, wb_levels, result = analyze_array(rgb, profile=profile, analysis_size=analysis_size,
+                                                            interpolation=interpolation, min_skew=min_skew)
+    positive = invert_image.invert_array(cropped, blend_color, autocontrast=autocontrast, wb_levels=wb_levels,
+                                          float_path=float_path)
+    return positive, result
+
+
+def process_file(image_path: str, out_path: str = None, autocontrast: bool = False,
+                 profile: dict = None, float_path: bool = False, analysis_size: int = None,
+                 tile_mb: float = None, timings: bool = False, trace_memory: bool = False,
+                 cprofile_dir: str = None, cache_dir: str = None, cache_frames: bool = False,
+                 cache_mb: float = 4096, strip: bool = False, max_frames: int = 6,
+                 output_format: str = "png", compress_level: int = None, jpeg_quality: int = 95,
+                 writer=None, interpolation: str = "linear", min_skew: float = 0.0, threads: int = None,
+                 durable: bool = False, analysis: dict = None, on_analysis=None) -> dict:
+    """
+    Process one scan from disk and write the positive. Returns the result record.
+    threads sets the row-band threads of the pointwise stages in this process
+    (see bands.py; 0 for one per core).
+    durable fsyncs the output before it is renamed into place (see
+    image_io.commit). A previous analysis result skips the analysis, and
+    on_analysis(result) is called once the analysis is done, before the
+    inversion (both used by journal.py; not in strip mode).
+    output_format is a key of image_io.OUTPUT_FORMATS; compress_level is the PNG
+    zlib level and jpeg_quality the JPEG quality. The encode time is reported
+    as 'encode_seconds'. With an image_io.AsyncWriter the positive is handed
+    to its thread instead, and the result carries 'async_write' = True.
+    With tile_mb the frame is analysed, cropped and inverted strip by strip
+    within that memory budget and streamed to the encoder (see _process_tiled).
+    cache_dir keeps the shape analysis (and with cache_frames the cropped
+    frame) in an on-disk cache of at most cache_mb, see analyze_file.
+    strip treats the scan as a capture of several frames (see strip.py) and
+    writes each as <name>_inverted_<n>.png; the cache and tile_mb do not apply.
+    timings adds the per-stage wall/CPU times to the result ('timings', see
+    instrument.py); trace_memory also measures allocated bytes per stage and
+    cprofile_dir saves a cProfile of the frame as <name>.prof in that folder.
+    """
+    options = dict(out_path=out_path, autocontrast=autocontrast, profile=profile, float_path=float_path,
+                   analysis_size=analysis_size, tile_mb=tile_mb, cache_dir=cache_dir, cache_frames=cache_frames,
+                   cache_mb=cache_mb, strip=strip, max_frames=max_frames, output_format=output_format,
+                   compress_level=compress_level, jpeg_quality=jpeg_quality, writer=writer,
+                   interpolation=interpolation, min_skew=min_skew, durable=durable, analysis=analysis,
+                   on_analysis=on_analysis)
+    if threads is not None:
+        bands.set_threads(threads)
+    if not (timings or trace_memory or cprofile_dir):
+        return _process_file(image_path, **options)
+
+    cprofile_path = None
+    if cprofile_dir:
+        os.makedirs(cprofile_dir, exist_ok=True)
+        cprofile_path = os.path.join(cprofile_dir, os.path.splitext(os.path.basename(image_path))[0] + ".prof")
+    with instrument.recording(trace_memory=trace_memory, cprofile_path=cprofile_path) as recorder:
+        with instrument.stage("process_file"):
+            result = _process_file(image_path, **options)
+    result["timings"] = recorder.records
+    return result
+
+
+def _process_file(image_path: str, out_path: str = None, autocontrast: bool = False,
+                  profile: dict = None, float_path: bool = False, analysis_size: int = None,
+                  tile_mb: float = None, cache_dir: str = None, cache_frames: bool = False,
+                  cache_mb: float = 4096, strip: bool = False, max_frames: int = 6,
+                  output_format: str = "png", compress_level: int = None, jpeg_quality: int = 95,
+                  writer=None, interpolation: str = "linear", min_skew: float = 0.0, durable: bool = False,
+                  analysis: dict = None, on_analysis=None) -> dict:
+    params = dict(image_io.output_params(output_format, compress_level, jpeg_quality), durable=durable)
+    if strip:
+        import strip as strip_mode
+        return strip_mode.process_strip_file(image_path, autocontrast=autocontrast, profile=profile,
+                                             analysis_size=analysis_size, max_frames=max_frames,
+                                             output_format=output_format, params=params,
+                                             interpolation=interpolation, min_skew=min_skew)
+    out_path = out_path or output_path_for(image_path, output_format=output_format)
+    if tile_mb:
+        return _process_tiled(image_path, out_path, autocontrast=autocontrast, profile=profile,
+                              analysis_size=analysis_size, tile_mb=tile_mb, cache_dir=cache_dir,
+                              cache_mb=cache_mb, output_format=output_format, compress_level=compress_level,
+                              interpolation=interpolation, min_skew=min_skew, durable=durable,
+                              analysis=analysis, on_analysis=on_analysis)
+    cropped, blend_color, wb_levels, result = analyze_file(image_path, profile=profile, analysis_size=analysis_size,
+                                                           cache_dir=cache_dir, cache_frames=cache_frames,
+                                                           cache_mb=cache_mb, interpolation=interpolation,
+                                                           min_skew=min_skew, analysis=analysis)
+    result["image_path"] = image_path
+    result["output_path"] = out_path
+    if on_analysis:
+        on_analysis(result)
+    positive = invert_image.invert_array(cropped, blend_color, autocontrast=autocontrast, wb_levels=wb_levels,
+                                          float_path=float_path)
+    if writer:
+        writer.submit(out_path, positive, {"image_path": image_path}, **params)
+        result["async_write"] = True
+    else:
+        result["encode_seconds"] = image_io.write_timed(out_path, positive, **params)
+    return result
+
+
+# proxy size of the tiled analysis when --analysis-size is not given
+TILED_ANALYSIS_SIZE = 1500
+
+
+def _process_tiled(image_path: str, out_path: str, autocontrast: bool = False, profile: dict = None,
+                   analysis_size: int = None, tile_mb: float = 64, cache_dir: str = None,
+                   cache_mb: float = 4096, output_format: str = "png", compress_level: int = None,
+                   interpolation: str = "linear", min_skew: float = 0.0, durable: bool = False,
+                   analysis: dict = None, on_analysis=None) -> dict:
+    """
+    The tile_mb half of _process_file. The frame is only ever read in strips
+    (see tiled.py): the perforations are removed per strip, the shape
+    analysis runs on a proxy built from the strips (TILED_ANALYSIS_SIZE
+    without analysis_size), and the crop and deskew are applied to each strip
+    as invert_tiled reads it. Analysis results are cached apart from the
+    whole-frame ones; cache_frames does not apply.
+    """
+    import tiled
+    if output_format not in ("png", "tiff"):
+        raise ValueError("--tile-mb streams PNG or uncompressed TIFF only")
+    source = tiled.PerforationSource(tiled.open_source(image_path))
+    h, w = source.shape[:2]
+    rows = tiled.strip_rows(w, tile_mb, source.dtype)
+    profile_rgb, wb_levels = profile_values(profile, source.dtype)
+    analysis_size = analysis_size or TILED_ANALYSIS_SIZE
+
+    store = key = cached = None
+    if cache_dir:
+        import cache
+        store = cache.AnalysisCache(cache_dir, max_mb=cache_mb)
+        key = store.key(image_path, analysis_size=analysis_size, tiled=True,
+                        profile_blend_color=[profile["blend_color"][c] for c in "rgb"] if profile else None)
+        cached, _ = store.get(key)
+    previous = cached or analysis
+    if previous:
+        bc = previous["blend_color"]
+        ref_rgb, crop_rect, angle = [bc["r"], bc["g"], bc["b"]], previous["crop_rect"], previous["skew_angle"]
+    else:
+        # analyze_frame only takes the full-size shape from the source
+        ref_rgb, crop_rect, angle = shape_image.analyze_frame(source, ref_rgb=profile_rgb,
+                                                              proxy=tiled.make_proxy(source, analysis_size, rows))
+    result = analysis_record(ref_rgb, crop_rect, angle, w, h)
+    if store:
+        if cached is None:
+            store.put(key, result)
+        result["cache"] = "analysis" if cached else "miss"
+    result["image_path"] = image_path
+    result["output_path"] = out_path
+    if on_analysis:
+        on_analysis(result)
+
+    cropped = tiled.WarpSource(source, crop_rect, angle, interpolation=interpolation, min_skew=min_skew)
+    tmp = image_io.partial_path(out_path)
+    try:
+        tiled.invert_tiled(cropped, tmp, np.asarray(ref_rgb, dtype=float), autocontrast=autocontrast,
+                           wb_levels=wb_levels, tile_mb=tile_mb,
+                           compress_level=6 if compress_level is None else compress_level)
+        image_io.commit(tmp, out_path, durable)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return result
+
+
+def add_timing_arguments(parser):
+    """Instrumentation flags shared by pipeline.py, batch.py and watch.py."""
+    parser.add_argument("--timings", action="store_true",
+                        help="Add per-stage wall/CPU times to each result ('timings')")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Also record bytes allocated per stage (tracemalloc; slows processing)")
+    parser.add_argument("--cprofile", metavar="DIR", help="Save a cProfile of each frame as DIR/<name>.prof")
+
+
+def timing_options(args) -> dict:
+    return {"timings": args.timings, "trace_memory": args.trace_memory, "cprofile_dir": args.cprofile}
+
+
+def add_strip_arguments(parser):
+    """Strip mode flags shared by pipeline.py, batch.py and watch.py."""
+    parser.add_argument("--strip", action="store_true",
+                        help="Each scan holds several frames (a strip shot in one exposure); "
+                             "write them as <name>_inverted_<n>.png")
+    parser.add_argument("--max-frames", type=int, default=6, help="Most frames per strip capture (default: 6)")
+
+
+def strip_options(args) -> dict:
+    return {"strip": args.strip, "max_frames": args.max_frames}
+
+
+def add_output_arguments(parser):
+    """Output encoding flags shared by pipeline.py, batch.py and watch.py."""
+    parser.add_argument("--format", choices=sorted(image_io.OUTPUT_FORMATS), default="png",
+                        help="Output format: png, tiff (uncompressed), tiff-lzw or jpeg (default: png)")
+    parser.add_argument("--png-level", type=int, choices=range(10), default=None, metavar="0-9",
+                        help="PNG zlib level (default: the encoder's). 8-bit: 1 encodes ~3x faster than the "
+                             "default 6, files ~20%% larger. 16-bit frames already default to a fast level 1 "
+                             "with RLE; 1-3 keep RLE, 4-9 trade much longer encoding for smaller files")
+    parser.add_argument("--jpeg-quality", type=int, default=95, help="JPEG quality, 4:4:4 (default: 95)")
+
+
+def output_options(args) -> dict:
+    return {"output_format": args.format, "compress_level": args.png_level, "jpeg_quality": args.jpeg_quality}
+
+
+def add_warp_arguments(parser):
+    """Deskew warp flags (--interpolation, --min-skew), see shape_image.add_warp_arguments."""
+    shape_image.add_warp_arguments(parser)
+
+
+def warp_options(args) -> dict:
+    return {"interpolation": args.interpolation, "min_skew": args.min_skew}
+
+
+def add_thread_arguments(parser):
+    """Intra-frame threading flag shared by pipeline.py, batch.py, watch.py, progressive.py and serve.py."""
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Threads per frame for the pointwise stages, in row bands (0: one per core; "
+                             "default: 1, as the worker processes already share the cores)")
+
+
+def add_cache_arguments(parser):
+    """Analysis cache flags shared by pipeline.py, batch.py and watch.py."""
+    parser.add_argument("--cache", metavar="DIR",
+                        help="Reuse crop/skew/blend colour analysis from this cache folder (keyed by file content)")
+    parser.add_argument("--cache-frames", action="store_true",
+                        help="Also cache the cropped frame as raw .npy, so re-runs skip decoding too")
+    parser.add_argument("--cache-mb", type=float, default=4096,
+                        help="Cache size limit in MB; least recently used entries are evicted (default: 4096)")
+
+
+def cache_options(args) -> dict:
+    return {"cache_dir": args.cache, "cache_frames": args.cache_frames, "cache_mb": args.cache_mb}
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="Convert scanned negatives to positives in a single process.")
+    p.add_argument("image_paths", nargs="+", help="Scanned frame images")
+    p.add_argument("--autocontrast", action="store_true", help="Apply auto contrast after white balance")
+    p.add_argument("--profile", help="Roll profile JSON from roll_profile.py")
+    p.add_argument("--float-path", action="store_true",
+                   help="Use the per-stage float inversion instead of the lookup table (verification)")
+    p.add_argument("--analysis-size", type=int, default=None,
+                   help="Run crop/skew analysis on a proxy with this longest edge in pixels (e.g. 1500)")
+    p.add_argument("--tile-mb", type=float, default=None,
+                   help="Analyse, crop and invert in strips within this memory budget in MB (for very large scans)")
+    add_timing_arguments(p)
+    add_cache_arguments(p)
+    add_strip_arguments(p)
+    add_warp_arguments(p)
+    add_output_arguments(p)
+    add_thread_arguments(p)
+    args = p.parse_args()
+
+    profile = None
+    if args.profile:
+        import roll_profile
+        profile = roll_profile.load_profile(args.profile)
+
+    failed = 0
+    for image_path in args.image_paths:
+        try:
+            result = process_file(image_path, autocontrast=args.autocontrast, profile=profile,
+                                  float_path=args.float_path, analysis_size=args.analysis_size,
+                                  tile_mb=args.tile_mb, **timing_options(args), **cache_options(args),
+                                  **strip_options(args), **output_options(args), **warp_options(args),
+                                  threads=args.threads)
+        except Exception as e:
+            print(json.dumps({"image_path": image_path, "error": str(e)}), file=sys.stderr)
+            failed += 1
+            continue
+        print(json.dumps(result))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Progressive conversion: a small positive preview first, the full-resolution
+positive after.
+
+The scan is decoded and cleaned of perforations once; the crop, skew and
+blend colour are measured on a proxy (see pipeline --analysis-size), and the
+white balance levels and auto contrast limits on the cropped proxy. The
+preview (<name>_preview.jpg, 1600 px by default) is written from the proxy
+straight away. The full-resolution frame is then warped and inverted with
+the same blend colour, levels and limits in a background thread, so the
+preview shows the colours of the delivered positive.
+
+With several scans, the preview of the next one is made while the previous
+full-resolution positive is still being rendered.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import bands
+import image_io
+import invert_image
+import pipeline
+import shape_image
+
+
+def preview_path_for(image_path: str) -> str:
+    return os.path.splitext(image_path)[0] + "_preview.jpg"
+
+
+def levels_record(wb_levels, ac_limits) -> dict:
+    """JSON form of the colour parameters shared by the preview and the final positive."""
+    min_vals, max_vals = wb_levels
+    record = {"white_balance": {"bright": [int(v) for v in min_vals], "dark": [int(v) for v in max_vals]}}
+    if ac_limits is not None:
+        record["auto_contrast"] = [int(v) for v in ac_limits]
+    return record
+
+
+def render_preview(rgb: np.ndarray, preview_size: int = 1600, autocontrast: bool = False,
+                   profile: dict = None, interpolation: str = "linear", min_skew: float = 0.0):
+    """
+    Analyse a scan as read from disk (perforations are removed in place) on a
+    proxy of preview_size pixels and invert the cropped proxy.
+    Returns the preview positive, the colour levels (white balance levels,
+    auto contrast limits) for render_final and the analysis result:
+    crop_rect, skew_angle, blend_color and the levels as JSON ('levels').
+    """
+    profile_rgb, wb_levels = pipeline.profile_values(profile, rgb.dtype)
+    h, w = rgb.shape[:2]
+    rgb = shape_image.remove_perforation(rgb)
+    # one proxy for the analysis and the preview
+    proxy, scale = shape_image.make_proxy(rgb, preview_size)
+    ref_rgb, crop_rect, angle = shape_image.analyze_frame(rgb, ref_rgb=profile_rgb, analysis_size=preview_size,
+                                                          proxy=(proxy, scale))
+    blend_color = np.asarray(ref_rgb, dtype=float)
+
+    x, y, cw, ch = crop_rect
+    proxy_rect = (int(round(x * scale)), int(round(y * scale)),
+                  max(1, int(round(cw * scale))), max(1, int(round(ch * scale))))
+    cropped = shape_image.apply_crop_and_deskew(proxy, proxy_rect, angle, interpolation=interpolation,
+                                                min_skew=min_skew)
+    wb_levels, ac_limits = invert_image.color_levels(cropped, blend_color, autocontrast=autocontrast,
+                                                     wb_levels=wb_levels)
+    preview = invert_image.invert_array(cropped, blend_color, autocontrast=autocontrast, wb_levels=wb_levels,
+                                        ac_limits=ac_limits)
+    result = {
+        "blend_color": {"r": ref_rgb[0], "g": ref_rgb[1], "b": ref_rgb[2]},
+        "skew_angle": angle,
+        "crop_rect": [int(v) for v in crop_rect],
+        "input_size": [w, h],
+        "levels": levels_record(wb_levels, ac_limits),
+    }
+    return preview, (wb_levels, ac_limits), result
+
+
+def render_final(rgb: np.ndarray, result: dict, levels, autocontrast: bool = False,
+                 interpolation: str = "linear", min_skew: float = 0.0) -> np.ndarray:
+    """Full-resolution positive of a scan after render_preview, with the preview's colour levels."""
+    wb_levels, ac_limits = levels
+    bc = result["blend_color"]
+    cropped = shape_image.apply_crop_and_deskew(rgb, tuple(result["crop_rect"]), result["skew_angle"],
+                                                interpolation=interpolation, min_skew=min_skew)
+    return invert_image.invert_array(cropped, np.array([bc["r"], bc["g"], bc["b"]], dtype=float),
+                                     autocontrast=autocontrast, wb_levels=wb_levels, ac_limits=ac_limits)
+
+
+def process_progressive(image_path: str, final_pool: ThreadPoolExecutor, preview_size: int = 1600,
+                        preview_quality: int = 90, autocontrast: bool = False, profile: dict = None,
+                        interpolation: str = "linear", min_skew: float = 0.0, output_format: str = "png",
+                        compress_level: int = None, jpeg_quality: int = 95):
+    """
+    Write the preview of a scan and queue its full-resolution positive on
+    final_pool. Returns the preview result record (with 'preview_path' and
+    'preview_seconds' from the start of decoding) and the future of the
+    final result record.
+    """
+    start = time.perf_counter()
+    rgb = image_io.read_rgb(image_path)
+    if rgb is None:
+        raise IOError(f"Couldn’t open {image_path}")
+    preview, levels, result = render_preview(rgb, preview_size, autocontrast=autocontrast, profile=profile,
+                                             interpolation=interpolation, min_skew=min_skew)
+    preview_path = preview_path_for(image_path)
+    image_io.write_rgb(preview_path, preview, format="JPEG", jpeg_quality=preview_quality)
+    result.update(image_path=image_path, preview_path=preview_path,
+                  preview_seconds=time.perf_counter() - start)
+
+    def final():
+        positive = render_final(rgb, result, levels, autocontrast=autocontrast, interpolation=interpolation,
+                                min_skew=min_skew)
+        out_path = pipeline.output_path_for(image_path, output_format=output_format)
+        encode_seconds = image_io.write_timed(out_path, positive,
+                                              **image_io.output_params(output_format, compress_level, jpeg_quality))
+        return dict(result, output_path=out_path, encode_seconds=encode_seconds,
+                    seconds=time.perf_counter() - start)
+
+    return dict(result), final_pool.submit(final)
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="Write a fast positive preview of each scan, then the full-resolution positive.")
+    p.add_argument("image_paths", nargs="+", help="Scanned frame images")
+    p.add_argument("--preview-size", type=int, default=1600, help="Longest edge of the preview (default: 1600)")
+    p.add_argument("--preview-quality", type=int, default=90, help="JPEG quality of the preview (default: 90)")
+    p.add_argument("--autocontrast", action="store_true", help="Apply auto contrast after white balance")
+    p.add_argument("--profile", help="Roll profile JSON from roll_profile.py")
+    p.add_argument("--viewer", help="Open each preview, then each final positive, with this program "
+                                    "(e.g. IrfanView's i_view64.exe)")
+    pipeline.add_warp_arguments(p)
+    pipeline.add_output_arguments(p)
+    pipeline.add_thread_arguments(p)
+    args = p.parse_args()
+    if args.threads is not None:
+        bands.set_threads(args.threads)
+
+    profile = None
+    if args.profile:
+        import roll_profile
+        profile = roll_profile.load_profile(args.profile)
+    options = dict(preview_size=args.preview_size, preview_quality=args.preview_quality,
+                   autocontrast=args.autocontrast, profile=profile, **pipeline.warp_options(args),
+                   **pipeline.output_options(args))
+
+    def show(path):
+        if args.viewer:
+            subprocess.Popen([args.viewer, path])
+
+    failed = 0
+    pending = []
+    # one full-resolution render at a time; at most two scans are held in memory
+    with ThreadPoolExecutor(max_workers=1) as final_pool:
+        for image_path in args.image_paths:
+            while len(pending) >= 2:
+                failed += report_final(*pending.pop(0), show)
+            try:
+                preview, future = process_progressive(image_path, final_pool, **options)
+            except Exception as e:
+                print(json.dumps({"image_path": image_path, "error": str(e)}), file=sys.stderr)
+                failed += 1
+                continue
+            print(f"   Preview: {preview['preview_path']} in {preview['preview_seconds']:.2f} s", file=sys.stderr)
+            print(json.dumps(preview), flush=True)
+            show(preview["preview_path"])
+            pending.append((image_path, future))
+        for image_path, future in pending:
+            failed += report_final(image_path, future, show)
+    sys.exit(1 if failed else 0)
+
+
+def report_final(image_path: str, future, show) -> int:
+    """Print the final result of a scan; returns 1 if it failed."""
+    try:
+        result = future.result()
+    except Exception as e:
+        print(json.dumps({"image_path": image_path, "error": str(e)}), file=sys.stderr)
+        return 1
+    print(f"   Done: {result['output_path']} in {result['seconds']:.2f} s", file=sys.stderr)
+    print(json.dumps(result), flush=True)
+    show(result["output_path"])
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Roll-level calibration shared by every frame of a roll.
+
+Samples a few frames, measures the orange-mask blend colour (mean of the
+brightest 3%, as shape_image does per frame) and the white balance levels on
+each, and keeps the per-channel median. The result is stored in a small JSON
+profile; shape_image --profile, invert_image (white_balance key), pipeline.py
+and batch.py then skip the per-frame estimation and give consistent colour
+across the roll.
+
+Profile format:
+    {"blend_color": {"r": .., "g": .., "b": ..},
+     "white_balance": {"bright": [r, g, b], "dark": [r, g, b]},
+     "bright_pct": 99.99, "dark_pct": 0.1, "bits": 8, "frames": [...]}
+
+Colour values are in the frames' own scale (0-255, or 0-65535 for 16-bit),
+given by "bits"; frames of the other bit depth get the profile rescaled.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import shape_image
+import invert_image
+
+DEFAULT_PROFILE_NAME = "roll_profile.json"
+
+
+def sample_frames(image_paths, count: int):
+    """Pick up to `count` frames spread evenly over the roll."""
+    if count <= 0 or len(image_paths) <= count:
+        return list(image_paths)
+    idx = np.linspace(0, len(image_paths) - 1, count).round().astype(int)
+    return [image_paths[i] for i in sorted(set(idx))]
+
+
+def build_profile(image_paths, sample: int = 8, bright_pct: float = 99.99, dark_pct: float = 0.1) -> dict:
+    """
+    Compute a roll profile from a sample of the given frames. Only one
+    frame is in memory at a time, so each sampled frame is decoded once per
+    pass.
+    """
+    frames = sample_frames(image_paths, sample)
+
+    # 1) Blend colour: median of the per-frame highlight references
+    readable, refs, depths = [], [], set()
+    for path in frames:
+        rgb_orig = shape_image.load_frame(path)
+        if rgb_orig is None:
+            print(f"Skipping unreadable frame {path}", file=sys.stderr)
+            continue
+        readable.append(path)
+        depths.add(rgb_orig.dtype.itemsize)
+        refs.append(shape_image.mean_rgb_of_top_percent_full(rgb_orig, 3))
+        del rgb_orig
+    if not refs:
+        raise ValueError("No readable frames to build a roll profile from")
+    if len(depths) > 1:
+        raise ValueError("The sampled frames mix 8-bit and 16-bit scans; build one profile per bit depth")
+    bits = 8 * depths.pop()
+    blend_color = np.median(np.array(refs, dtype=float), axis=0)
+
+    # 2) White balance levels measured with the shared blend colour
+    brights, darks = [], []
+    for path in readable:
+        rgb_orig = shape_image.load_frame(path)
+        if rgb_orig is None:
+            continue
+        _, crop_rect, angle = shape_image.analyze_frame(rgb_orig, ref_rgb=blend_color)
+        cropped = shape_image.apply_crop_and_deskew(rgb_orig, crop_rect, angle)
+        del rgb_orig
+        inverted = invert_image.invert_image(invert_image.divide_blend(cropped, blend_color))
+        min_vals, max_vals = invert_image.white_balance_levels(inverted, bright_pct, dark_pct)
+        brights.append(min_vals)
+        darks.append(max_vals)
+
+    return {
+        "blend_color": {"r": blend_color[0], "g": blend_color[1], "b": blend_color[2]},
+        "white_balance": {
+            "bright": np.median(np.array(brights), axis=0).round().astype(int).tolist(),
+            "dark": np.median(np.array(darks), axis=0).round().astype(int).tolist(),
+        },
+        "bright_pct": bright_pct,
+        "dark_pct": dark_pct,
+        "bits": bits,
+        "frames": [os.path.basename(p) for p in frames],
+    }
+
+
+def load_profile(path: str) -> dict:
+    with open(path, 'r') as pf:
+        return json.load(pf)
+
+
+def save_profile(profile: dict, path: str) -> str:
+    with open(path, 'w') as pf:
+        json.dump(profile, pf, indent=2)
+    return path
+
+
+def main():
+    import batch
+
+    p = argparse.ArgumentParser(
+        description="Compute a shared blend colour and white balance for a whole roll.")
+    p.add_argument("inputs", nargs="+", help="Folders, glob patterns or image files of the roll")
+    p.add_argument("-n", "--sample", type=int, default=8, help="Number of frames to sample (0 = all)")
+    p.add_argument("-o", "--output", help=f"Profile path (default: {DEFAULT_PROFILE_NAME} next to the first frame)")
+    args = p.parse_args()
+
+    image_paths = [path for path in batch.collect_images(args.inputs)
+                   if "_inverted" not in os.path.basename(path).lower()]
+    if not image_paths:
+        print("No frames found.", file=sys.stderr)
+        sys.exit(1)
+
+    profile = build_profile(image_paths, sample=args.sample)
+    out_path = args.output or os.path.join(os.path.dirname(image_paths[0]), DEFAULT_PROFILE_NAME)
+    save_profile(profile, out_path)
+    print(f"Roll profile saved as {out_path}", file=sys.stderr)
+    print(json.dumps(profile))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Local HTTP service for tethered-capture clients.
+
+Replaces the per-frame invert2.bat call (two fresh interpreters and a
+shared %TEMP%\\c4c.json): frames are submitted over HTTP, queued in FIFO
+order and converted by a persistent pool of worker processes that import
+NumPy/OpenCV once and keep a neg2pos.Pipeline each. Every job has its own
+id, so overlapping frames cannot overwrite each other's hand-off.
+
+    POST /jobs                 {"image_path": "D:/Scans/f01.tif", "settings": {"autocontrast": true}}
+                               and optionally "out_path", relative to --output-dir
+    POST /jobs?name=f01.tif    raw image bytes as the body; settings as query
+                               parameters with JSON values (?autocontrast=true)
+    GET  /jobs/<id>            status: queued, running, done or failed; the
+                               result record once done. ?wait=SECONDS blocks
+                               until the job finishes or the time is up.
+    GET  /jobs/<id>/output     the positive image of a finished job
+    GET  /health               workers and queue length
+
+settings are neg2pos.Settings fields (bright_pct, clip_pct, blend_color,
+...) overriding the defaults given on the command line. The service binds
+to 127.0.0.1 unless --host says otherwise; it has no authentication.
+
+Finished jobs are kept for polling for --retention seconds (and at most the
+last --keep-jobs); an uploaded scan and its positive in --upload-dir are
+deleted together with their job.
+"""
+import argparse
+import dataclasses
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import batch
+
+_pipeline = None   # this worker's neg2pos.Pipeline, reused across jobs
+
+
+def _init_worker(threads: int = None):
+    # One OpenCV thread per worker, the pool already uses every core.
+    import cv2
+    import bands
+    import neg2pos  # noqa: F401
+    cv2.setNumThreads(1)
+    if threads is not None:
+        bands.set_threads(threads)
+
+
+def _run_job(image_path: str, out_path: str, settings: dict) -> dict:
+    global _pipeline
+    import neg2pos
+    if _pipeline is None:
+        _pipeline = neg2pos.Pipeline()
+    _pipeline.settings = neg2pos.Settings.from_dict(settings)
+    start = time.perf_counter()
+    result = _pipeline.process_file(image_path, out_path)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+class JobQueue:
+    """
+    Job table in front of the worker pool. The pool's own queue keeps jobs in
+    FIFO order; the table keeps the status and result of the last
+    `keep` jobs, finished at most `retention` seconds ago, for polling.
+    """
+
+    def __init__(self, workers: int, defaults: dict, keep: int = 1000, threads: int = None,
+                 retention: float = 3600):
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads,))
+        # start the workers now rather than on the first frame
+        for f in [self.pool.submit(_init_worker, threads) for _ in range(workers)]:
+            f.result()
+        self.workers = workers
+        self.defaults = defaults
+        self.keep = keep
+        self.retention = retention
+        self.jobs = OrderedDict()   # id -> job record
+        self.lock = threading.Lock()
+
+    def settings_for(self, overrides: dict) -> dict:
+        """Default settings with a job's overrides; raises ValueError for invalid ones."""
+        import neg2pos
+        settings = dict(self.defaults, **overrides)
+        neg2pos.Settings.from_dict(settings)
+        return settings
+
+    def submit(self, image_path: str, overrides: dict = None, out_path: str = None, job_id: str = None,
+               upload: bool = False) -> dict:
+        """Queue a job; with upload the scan and its positive are deleted when the job is evicted."""
+        settings = self.settings_for(overrides or {})
+        job_id = job_id or uuid.uuid4().hex
+        job = {"id": job_id, "image_path": image_path, "submitted": time.time(),
+               "done": threading.Event(), "upload": upload}
+        future = self.pool.submit(_run_job, image_path, out_path, settings)
+        job["future"] = future
+        with self.lock:
+            self.jobs[job_id] = job
+            self._evict()
+        future.add_done_callback(lambda f: self._finish(job, f))
+        return job
+
+    def _finish(self, job: dict, future):
+        job["finished"] = time.time()
+        if future.cancelled():
+            job["error"] = "Cancelled"
+            job["done"].set()
+            return
+        try:
+            job["result"] = future.result()
+        except Exception as e:
+            job["error"] = str(e)
+        job["latency"] = job["finished"] - job["submitted"]
+        job["done"].set()
+
+    def _evict(self):
+        # drop the oldest finished jobs beyond `keep` and those finished over `retention` seconds ago
+        now = time.time()
+        for job_id in list(self.jobs):
+            job = self.jobs[job_id]
+            if not job["done"].is_set():
+                continue
+            if len(self.jobs) > self.keep or now - job["finished"] > self.retention:
+                del self.jobs[job_id]
+                self._remove_files(job)
+
+    @staticmethod
+    def _remove_files(job: dict):
+        """Delete an uploaded scan and its positive."""
+        if not job["upload"]:
+            return
+        paths = [job["image_path"]]
+        if "result" in job:
+            paths.append(job["result"]["output_path"])
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, job_id: str):
+        with self.lock:
+            self._evict()
+            return self.jobs.get(job_id)
+
+    def queued(self) -> int:
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if not job["future"].running() and not job["done"].is_set())
+
+    @staticmethod
+    def status(job: dict) -> dict:
+        """JSON view of a job record."""
+        if job["done"].is_set():
+            state = "failed" if "error" in job else "done"
+        else:
+            state = "running" if job["future"].running() else "queued"
+        view = {"id": job["id"], "status": state, "image_path": job["image_path"]}
+        for key in ("result", "error", "latency"):
+            if key in job:
+                view[key] = job[key]
+        return view
+
+    def close(self):
+        """Cancel the jobs still queued and let the running ones finish."""
+        with self.lock:
+            for job in self.jobs.values():
+                job["future"].cancel()
+        self.pool.shutdown(wait=True)
+
+
+def parse_query_settings(query: dict) -> dict:
+    """Settings from query parameters; values are JSON (true, 99.5, [250, 240, 230]) or plain strings."""
+    settings = {}
+    for key, values in query.items():
+        try:
+            settings[key] = json.loads(values[-1])
+        except ValueError:
+            settings[key] = values[-1]
+    return settings
+
+
+def resolve_out_path(out_path: str, output_dir: str) -> str:
+    """
+    A client's out_path as a path under output_dir; raises ValueError
+    without an output_dir or if the path leads out of it.
+    """
+    if not output_dir:
+        raise ValueError("'out_path' needs the server to run with --output-dir")
+    if not isinstance(out_path, str) or not out_path:
+        raise ValueError(f"Invalid out_path: {out_path!r}")
+    root = os.path.realpath(output_dir)
+    path = os.path.realpath(os.path.join(root, out_path))
+    if os.path.commonpath([root, path]) != root or path == root:
+        raise ValueError(f"out_path leads outside the output folder: {out_path}")
+    return path
+
+
+class Handler(BaseHTTPRequestHandler):
+    jobs: JobQueue = None
+    upload_dir: str = None
+    output_dir: str = None
+
+    def _send_json(self, code: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job_or_404(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if job is None:
+            self._send_json(404, {"error": f"No job {job_id}"})
+        return job
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["health"]:
+            return self._send_json(200, {"workers": self.jobs.workers, "queued": self.jobs.queued()})
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = self._job_or_404(parts[1])
+            if job:
+                wait = parse_qs(url.query).get("wait")
+                if wait:
+                    try:
+                        job["done"].wait(min(float(wait[-1]), 300))
+                    except ValueError:
+                        return self._send_json(400, {"error": f"Invalid wait: {wait[-1]}"})
+                self._send_json(200, JobQueue.status(job))
+            return
+        if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "output":
+            job = self._job_or_404(parts[1])
+            if job:
+                if "result" not in job:
+                    return self._send_json(409, JobQueue.status(job))
+                self._send_file(job["result"]["output_path"])
+            return
+        self._send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def _send_file(self, path: str):
+        ext = os.path.splitext(path)[1].lower()
+        content_type = {".png": "image/png", ".tif": "image/tiff", ".jpg": "image/jpeg"}.get(ext,
+                                                                                       "application/octet-stream")
+        size = os.path.getsize(path)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/jobs":
+            return self._send_json(404, {"error": f"Unknown path {url.path}"})
+        query = parse_qs(url.query)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError(f"Invalid Content-Length: {length}")
+            if "name" in query:
+                job = self._submit_upload(query, length)
+            else:
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(body, dict):
+                    raise ValueError("The body must be a JSON object")
+                if not body.get("image_path"):
+                    raise ValueError("Missing 'image_path'")
+                if not isinstance(body["image_path"], str) or not os.path.isfile(body["image_path"]):
+                    raise ValueError(f"No such file: {body['image_path']}")
+                out_path = body.get("out_path")
+                if out_path is not None:
+                    out_path = resolve_out_path(out_path, self.output_dir)
+                job = self.jobs.submit(body["image_path"], body.get("settings"), out_path)
+        except (ValueError, TypeError) as e:
+            return self._send_json(400, {"error": str(e)})
+        self._send_json(202, JobQueue.status(job))
+
+    def _submit_upload(self, query: dict, length: int) -> dict:
+        name = os.path.basename(query.pop("name")[-1])
+        if not name.lower().endswith(batch.IMAGE_EXTENSIONS):
+            raise ValueError(f"Unsupported file type: {name}")
+        settings = parse_query_settings(query)
+        self.jobs.settings_for(settings)   # reject bad settings before reading the upload
+        job_id = uuid.uuid4().hex
+        path = os.path.join(self.upload_dir, f"{job_id}_{name}")
+        remaining = length
+        with open(path, "wb") as f:
+            while remaining:
+                chunk = self.rfile.read(min(remaining, 1 << 20))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining:
+            os.remove(path)
+            raise ValueError("Upload ended early")
+        try:
+            return self.jobs.submit(path, settings, job_id=job_id, upload=True)
+        except BaseException:
+            os.remove(path)
+            raise
+
+    def log_message(self, format, *args):
+        print(f"   {self.address_string()} {format % args}", file=sys.stderr)
+
+
+def main():
+    import tempfile
+
+    import pipeline
+
+    p = argparse.ArgumentParser(
+        description="Local HTTP service converting scans with a warm worker pool.")
+    p.add_argument("--host", default="127.0.0.1", help="Address to bind (default: 127.0.0.1)")
+    p.add_argument("--port", type=int, default=8765, help="Port (default: 8765)")
+    p.add_argument("-j", "--workers", type=int, default=2, help="Frames processed concurrently (default: 2)")
+    p.add_argument("--upload-dir", default=os.path.join(tempfile.gettempdir(), "neg2pos-uploads"),
+                   help="Folder for uploaded scans and their positives; both are deleted with their job")
+    p.add_argument("--output-dir",
+                   help="Folder that a job's 'out_path' is relative to; without it, 'out_path' is refused")
+    p.add_argument("--retention", type=float, default=3600,
+                   help="Seconds a finished job (and its uploaded files) is kept for polling (default: 3600)")
+    p.add_argument("--keep-jobs", type=int, default=1000,
+                   help="Finished jobs kept at most, oldest dropped first (default: 1000)")
+    p.add_argument("--autocontrast", action="store_true", help="Apply auto contrast after white balance")
+    p.add_argument("--profile", help="Roll profile JSON from roll_profile.py")
+    p.add_argument("--analysis-size", type=int, default=None,
+                   help="Run crop/skew analysis on a proxy with this longest edge in pixels (e.g. 1500)")
+    pipeline.add_warp_arguments(p)
+    pipeline.add_output_arguments(p)
+    pipeline.add_thread_arguments(p)
+    args = p.parse_args()
+
+    import neg2pos
+    defaults = {"autocontrast": args.autocontrast, "analysis_size": args.analysis_size,
+                **pipeline.warp_options(args), **pipeline.output_options(args)}
+    if args.profile:
+        import roll_profile
+        defaults["profile"] = roll_profile.load_profile(args.profile)
+    try:
+        defaults = dataclasses.asdict(neg2pos.Settings.from_dict(defaults))
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+
+    os.makedirs(args.upload_dir, exist_ok=True)
+    Handler.jobs = JobQueue(args.workers, defaults, keep=args.keep_jobs, threads=args.threads,
+                            retention=args.retention)
+    Handler.upload_dir = args.upload_dir
+    Handler.output_dir = args.output_dir
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"Serving on http://{args.host}:{args.port} with {args.workers} warm workers", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopped.", file=sys.stderr)
+    finally:
+        server.server_close()
+        Handler.jobs.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,29 +2,39 @@
 import argparse
 import cv2
 import numpy as np
-from PIL import Image
-import matplotlib.pyplot as plt
 import sys
 import json
 import os
 
+import bands
+import image_io
+import image_stats
+import instrument
 
 debug=0
 
+@instrument.timed
 def compute_brightness(img_np: np.ndarray) -> np.ndarray:
     """Compute a simple luminance map by averaging R, G, B."""
-    return np.dot(img_np[..., :3], [0.3333, 0.3333, 0.3334])
+    return bands.pointwise(lambda band: np.dot(band[..., :3], [0.3333, 0.3333, 0.3334]), img_np,
+                           shape=img_np.shape[:2], dtype=float)
 
 
-def get_rebate_crop(rgb: np.ndarray, pct: float = 98, ksz: int = 15, min_area_frac: float = 0.8):
+@instrument.timed
+def get_rebate_crop(rgb: np.ndarray, pct: float = 98, ksz: int = 15, min_area_frac: float = 0.8,
+                    lum: np.ndarray = None):
     """
     Crop out the bright film rebate by thresholding...
     If no contour found, or if cropped area is < min_area_frac of total area,
     return full image coverage and top-left (0,0).
+    lum is an optional precomputed image_stats.luminance_sum of rgb.
+    The returned threshold is in compute_brightness units.
     """
-    bright = compute_brightness(rgb)
-    thresh = np.percentile(bright, pct)
-    mask = (bright >= thresh).astype(np.uint8) * 255
+    if lum is None:
+        lum = image_stats.luminance_sum(rgb)
+    lum_thresh = image_stats.percentile(image_stats.histogram(lum, image_stats.luminance_levels(rgb)), pct)
+    thresh = lum_thresh / 3.0
+    mask = (lum >= lum_thresh).astype(np.uint8) * 255
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (ksz, ksz))
     closed = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
     cnts, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -42,17 +52,13 @@ def get_rebate_crop(rgb: np.ndarray, pct: float = 98, ksz: int = 15, min_area_fr
 
 
 
-def crop_inner_and_find_bright(crop_rgb: np.ndarray,
-                               rebate_thresh: float,
-                               close1: int = 15,
-                               close2: int = 25,
-                               top_pct: float = 1):
+def inner_contours(lum: np.ndarray, rebate_thresh: float, close1: int = 15, close2: int = 25):
     """
-    Crop inner image and compute avg RGB of brightest pixels...
-    If no contour found, return full crop and avg [255,255,255].
+    External contours of the image areas: everything darker than the rebate,
+    cleaned up by morphological closing/opening. lum is a luminance sum map.
     """
-    bright = compute_brightness(crop_rgb)
-    mask = (bright >= rebate_thresh).astype(np.uint8) * 255
+    # back to luminance sum units; the epsilon absorbs the /3 round-off
+    mask = (lum >= rebate_thresh * 3.0 - 1e-6).astype(np.uint8) * 255
     k1 = cv2.getStructuringElement(cv2.MORPH_RECT, (close1, close1))
     closed1 = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, k1)
     inv = cv2.bitwise_not(closed1)
@@ -60,6 +66,60 @@ def crop_inner_and_find_bright(crop_rgb: np.ndarray,
     clean = cv2.morphologyEx(inv, cv2.MORPH_CLOSE, k2)
     clean = cv2.morphologyEx(clean, cv2.MORPH_OPEN, k2)
     cnts, _ = cv2.findContours(clean, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return cnts
+
+
+@instrument.timed
+def find_frames(lum: np.ndarray, rebate_thresh: float, close1: int = 15, close2: int = 25,
+                max_frames: int = 6, min_area_frac: float = 0.3):
+    """
+    All image areas of a multi-frame capture (a strip or sheet shot in one
+    exposure), found in one pass with the same mask as crop_inner_and_find_bright.
+    Contours touching the edge are blacked-out backlight, not frames, and
+    contours smaller than min_area_frac of the largest frame are ignored.
+    Returns up to max_frames [(angle, (x, y, w, h))], ordered along the strip.
+    """
+    h, w = lum.shape[:2]
+    cnts = inner_contours(lum, rebate_thresh, close1, close2)
+    inside = []
+    for c in cnts:
+        x, y, cw, ch = cv2.boundingRect(c)
+        if x > 0 and y > 0 and x + cw < w and y + ch < h:
+            inside.append(c)
+    cnts = inside or cnts
+    if not cnts:
+        return []
+    areas = [cv2.contourArea(c) for c in cnts]
+    largest = max(areas)
+    cnts = [c for c, a in sorted(zip(cnts, areas), key=lambda ca: -ca[1]) if a >= min_area_frac * largest]
+    frames = []
+    for c in cnts[:max_frames]:
+        angle = cv2.minAreaRect(c)[2]
+        # minAreaRect may give a small skew as its complement (-87 for 3)
+        angle = (angle + 45.0) % 90.0 - 45.0
+        if abs(angle) > 20:
+            angle = 0
+        frames.append((angle, cv2.boundingRect(c)))
+    # left to right for a horizontal strip, top to bottom for a vertical one
+    axis = 0 if w >= h else 1
+    return sorted(frames, key=lambda f: f[1][axis])
+
+
+@instrument.timed
+def crop_inner_and_find_bright(crop_rgb: np.ndarray,
+                               rebate_thresh: float,
+                               close1: int = 15,
+                               close2: int = 25,
+                               top_pct: float = 1,
+                               lum: np.ndarray = None):
+    """
+    Crop inner image and compute avg RGB of brightest pixels...
+    If no contour found, return full crop and avg [255,255,255].
+    lum is an optional precomputed image_stats.luminance_sum of crop_rgb.
+    """
+    if lum is None:
+        lum = image_stats.luminance_sum(crop_rgb)
+    cnts = inner_contours(lum, rebate_thresh, close1, close2)
     if not cnts:
         # fallback: full crop
         h, w = crop_rgb.shape[:2]
@@ -72,30 +132,48 @@ def crop_inner_and_find_bright(crop_rgb: np.ndarray,
     print(f"Detected skew angle: {angle:.2f} degrees", file=sys.stderr)
     x, y, w, h = cv2.boundingRect(c)
     inner_crop = crop_rgb[y:y+h, x:x+w]
-    inner_bright = compute_brightness(inner_crop)
-    bright_thresh = np.percentile(inner_bright, 100 - top_pct)
-    mask_bright = inner_bright >= bright_thresh
+    inner_lum = lum[y:y+h, x:x+w]
+    hist = image_stats.histogram(inner_lum, image_stats.luminance_levels(crop_rgb))
+    mask_bright = inner_lum >= image_stats.percentile(hist, 100 - top_pct)
     pixels = inner_crop[mask_bright]
     avg = pixels.mean(axis=0).tolist()
     return inner_crop, mask_bright, avg, angle, (x, y, w, h)
 
-def apply_crop_and_deskew(orig_rgb, crop_rect, angle):
+# --interpolation choices for the deskew warp
+INTERPOLATIONS = {
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "cubic": cv2.INTER_CUBIC,
+    "lanczos": cv2.INTER_LANCZOS4,
+}
+
+
+@instrument.timed
+def apply_crop_and_deskew(orig_rgb, crop_rect, angle, interpolation: str = "linear", min_skew: float = 0.0):
     """
     Crops and deskews the original (non-normalized) image using the
     provided crop rectangle (x, y, w, h) and rotation angle (degrees).
     Returns the final cropped image.
+    The rotation about the image centre and the crop are one affine warp
+    whose output is only the crop rectangle, so no pixel outside it is
+    interpolated. Below min_skew degrees the frame is only sliced, without
+    a warp (the result is then a view of orig_rgb).
     """
     x, y, w, h = crop_rect
-    # 1. Rotate image by -angle (deskew)
+    if abs(angle) <= min_skew:
+        return orig_rgb[y:y+h, x:x+w]
+    white = image_io.max_value(orig_rgb)
     h_img, w_img = orig_rgb.shape[:2]
     center = (w_img / 2.0, h_img / 2.0)
     M = cv2.getRotationMatrix2D(center, angle, 1.0)
-    rotated = cv2.warpAffine(orig_rgb, M, (w_img, h_img), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(255,255,255))
-    # 2. Crop the rotated image
-    cropped = rotated[y:y+h, x:x+w]
-    return cropped
+    # shift the rotated image so the crop's top-left corner lands at (0, 0)
+    M[0, 2] -= x
+    M[1, 2] -= y
+    return cv2.warpAffine(orig_rgb, M, (w, h), flags=INTERPOLATIONS[interpolation],
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=(white, white, white))
 
 
+@instrument.timed
 def rotate_image(rgb: np.ndarray, angle: float) -> np.ndarray:
     h, w = rgb.shape[:2]
     center = (w / 2.0, h / 2.0)
@@ -104,95 +182,269 @@ def rotate_image(rgb: np.ndarray, angle: float) -> np.ndarray:
                            borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
 
     # --- Normalize image using mean RGB of brightest 3% of non-black pixels ---
-def mean_rgb_of_top_percent_full(img, percent=3):
-        rgb = img.reshape(-1, 3)
-        # Exclude black pixels (from perforation removal)
-        mask_nonblack = np.any(rgb > 0, axis=1)
-        rgb_nonblack = rgb[mask_nonblack]
-        if rgb_nonblack.shape[0] == 0:
-            return np.array([254, 254, 254])
-        gray = cv2.cvtColor(rgb_nonblack.reshape(-1, 1, 3), cv2.COLOR_RGB2GRAY).flatten()
-        n_select = max(1, int(len(gray) * percent / 100.0))
-        brightest_idx = np.argpartition(-gray, n_select-1)[:n_select]
-        mean_val = rgb_nonblack[brightest_idx].mean(axis=0)
-        return mean_val
-
-def remove_perforation(rgb: np.ndarray, dilation_radius: int = 15) -> np.ndarray:
-    # 1. Zero out pure white pixels
-    mask_white = np.all(rgb == 255, axis=2)
-    rgb[mask_white] = [0, 0, 0]
-    # 2. Dilate the black (zeroed) regions to cover possible border leaks
-    mask_black = np.all(rgb == 0, axis=2).astype(np.uint8) * 255
+@instrument.timed
+def mean_rgb_of_top_percent_full(img, percent=3, lum=None):
+        # Exclude black pixels (from perforation removal): R + G + B == 0
+        if lum is None:
+            lum = image_stats.luminance_sum(img)
+        mask_nonblack = lum > 0
+        n_black = lum.size - np.count_nonzero(mask_nonblack)
+        if n_black == lum.size:
+            return np.array([254, 254, 254]) * (image_io.max_value(img) / 255.0)
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        hist = image_stats.histogram(gray, image_io.max_value(img) + 1)
+        hist[0] -= n_black  # black pixels all have gray level 0
+        return image_stats.mean_rgb_of_top(img, gray, hist, percent, valid=mask_nonblack)
+
+def dilate_near_edges(mask: np.ndarray, kernel: np.ndarray, radius: int, block: int = 128) -> np.ndarray:
+    """
+    Same as cv2.dilate(mask, kernel) for a kernel of the given radius, but
+    only blocks near the edge of the mask are dilated: blocks that are fully
+    masked, or have no masked pixel within `radius`, are copied as they are.
+    The backlight and perforations cover a small band around the frame, so
+    most of the frame is skipped.
+    """
+    h, w = mask.shape
+    block = max(block, radius + 1)
+    nby, nbx = -(-h // block), -(-w // block)
+    padded = np.zeros((nby * block, nbx * block), dtype=np.uint8)
+    padded[:h, :w] = mask
+    blocks = padded.reshape(nby, block, nbx, block)
+    has_mask = blocks.max(axis=(1, 3)) > 0
+    full = blocks.min(axis=(1, 3)) > 0   # partial edge blocks never count as full
+    del padded, blocks
+    # radius < block, so only the 8 neighbouring blocks can reach into a block
+    near = np.zeros((nby + 2, nbx + 2), dtype=bool)
+    for dy in range(3):
+        for dx in range(3):
+            near[dy:dy + nby, dx:dx + nbx] |= has_mask
+    work = near[1:-1, 1:-1] & ~full
+
+    out = mask.copy()
+    for by in range(nby):
+        if not work[by].any():
+            continue
+        y0, y1 = by * block, min(h, (by + 1) * block)
+        wy0, wy1 = max(0, y0 - radius), min(h, y1 + radius)
+        # dilate each run of consecutive blocks of this row in one call
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], work[by].view(np.int8), [0]))))
+        for bx0, bx1 in zip(edges[::2], edges[1::2]):
+            x0, x1 = bx0 * block, min(w, bx1 * block)
+            wx0, wx1 = max(0, x0 - radius), min(w, x1 + radius)
+            dilated = cv2.dilate(mask[wy0:wy1, wx0:wx1], kernel)
+            out[y0:y1, x0:x1] = dilated[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0]
+    return out
+
+@instrument.timed
+def remove_perforation(rgb: np.ndarray, dilation_radius: int = 15, fast: bool = True) -> np.ndarray:
+    """
+    Black out pure white pixels (backlight, perforations) and everything within
+    dilation_radius of them or of already black pixels, in place.
+    fast=False is the original full-frame version, kept for verification;
+    both give identical results.
+    """
+    white = image_io.max_value(rgb)
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (dilation_radius*2+1, dilation_radius*2+1))
-    mask_dilated = cv2.dilate(mask_black, kernel, iterations=1)
-    rgb[mask_dilated == 255] = [0, 0, 0]
+    if not fast:
+        # 1. Zero out pure white pixels (255, or 65535 for 16-bit scans)
+        mask_white = np.all(rgb == white, axis=2)
+        rgb[mask_white] = [0, 0, 0]
+        # 2. Dilate the black (zeroed) regions to cover possible border leaks
+        mask_black = np.all(rgb == 0, axis=2).astype(np.uint8) * 255
+        mask_dilated = cv2.dilate(mask_black, kernel, iterations=1)
+        rgb[mask_dilated == 255] = [0, 0, 0]
+        return rgb
+
+    # White and black pixels in one uint8 mask, without boolean temporaries
+    mask = cv2.inRange(rgb, (white, white, white), (white, white, white))
+    cv2.bitwise_or(mask, cv2.inRange(rgb, (0, 0, 0), (0, 0, 0)), dst=mask)
+    mask = dilate_near_edges(mask, kernel, dilation_radius)
+    cv2.bitwise_and(rgb, 0, dst=rgb, mask=mask)
     return rgb
 
 
 
+@instrument.timed
+def normalize_to_reference(rgb: np.ndarray, ref_rgb) -> np.ndarray:
+    """
+    Scale each channel so the reference colour maps to 254. The result is
+    always 8-bit, whatever the input depth; it is only used for analysis.
+    """
+    def normalize(band):
+        norm = band.astype(np.float32)
+        for c in range(3):
+            val = ref_rgb[c]
+            if val > 1:
+                norm[:, :, c] = np.clip((norm[:, :, c] / val) * 254.0, 0, 254)
+            else:
+                norm[:, :, c] = 0
+        return norm.astype(np.uint8)
+
+    return bands.pointwise(normalize, rgb, dtype=np.uint8)
+
+
+@instrument.timed
+def make_proxy(rgb: np.ndarray, longest_edge: int):
+    """
+    Downscale a frame so its longest edge is at most longest_edge pixels.
+    Returns the proxy and the scale factor (1.0 if no downscale was needed).
+    """
+    h, w = rgb.shape[:2]
+    if not longest_edge or max(h, w) <= longest_edge:
+        return rgb, 1.0
+    scale = longest_edge / float(max(h, w))
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    return cv2.resize(rgb, size, interpolation=cv2.INTER_AREA), scale
+
+
+def scale_kernel(ksz: int, scale: float) -> int:
+    """Morphology kernel size for a proxy: scaled, odd and at least 3."""
+    return max(3, int(round(ksz * scale)) | 1)
+
+
+def scale_rect_up(rect, scale: float, w_img: int, h_img: int):
+    """Map an (x, y, w, h) rectangle from proxy to full-resolution coordinates."""
+    x, y, w, h = rect
+    x0 = max(0, int(np.floor(x / scale)))
+    y0 = max(0, int(np.floor(y / scale)))
+    x1 = min(w_img, int(np.ceil((x + w) / scale)))
+    y1 = min(h_img, int(np.ceil((y + h) / scale)))
+    return x0, y0, x1 - x0, y1 - y0
+
+
+@instrument.timed
+def analyze_frame(rgb_orig: np.ndarray, debug_base: str = None, ref_rgb=None,
+                  analysis_size: int = None, highlight_pct: float = 3, rebate_pct: float = 90,
+                  max_skew: float = 20, proxy=None):
+    """
+    Run the shape analysis on an RGB frame (perforations already removed).
+    Returns the reference RGB (blend colour), the crop rectangle (x, y, w, h)
+    in frame coordinates and the skew angle.
+    A ref_rgb from a roll profile skips the per-frame highlight estimation.
+    With analysis_size the analysis runs on a proxy whose longest edge is
+    analysis_size pixels, with kernels scaled to match; the crop rectangle is
+    mapped back to full resolution. A caller that needs the proxy as well
+    passes make_proxy(rgb_orig, analysis_size) as proxy, so it is built once.
+    highlight_pct is the brightest share of the frame averaged into the blend
+    colour, rebate_pct the brightness percentile that separates the rebate,
+    and skew angles above max_skew degrees are taken as misdetections (0).
+    """
+    h_img, w_img = rgb_orig.shape[:2]
+    rgb_orig, scale = proxy if proxy is not None else make_proxy(rgb_orig, analysis_size)
+    ksz, close1, close2 = scale_kernel(15, scale), scale_kernel(15, scale), scale_kernel(25, scale)
+
+    # --- Highlight-based normalization ---
+    if ref_rgb is None:
+        ref_rgb = mean_rgb_of_top_percent_full(rgb_orig, highlight_pct)
+        print(f"Reference RGB for normalization (mean of brightest {highlight_pct}%): {ref_rgb}", file=sys.stderr)
+    else:
+        ref_rgb = np.asarray(ref_rgb, dtype=float)
+        print(f"Reference RGB for normalization (roll profile): {ref_rgb}", file=sys.stderr)
+    # Normalize channels so this mean becomes 254
+    rgb_norm = normalize_to_reference(rgb_orig, ref_rgb)
+
+    # Returns a crop that covers the rebate and the image inside it (rebate included).
+    # x and y are the coordinates of the rectangle’s top-left corner (in pixels, relative to the image).
+    # w and h are the rectangle’s width and height.
+    # One luminance map of the normalised frame serves both crop steps
+    lum_norm = image_stats.luminance_sum(rgb_norm)
+    rebate_crop_rgb, rebate_thresh, rx, ry, rw, rh  = get_rebate_crop(rgb_norm, pct=rebate_pct, ksz=ksz, lum=lum_norm)
+    if debug and debug_base:
+        from PIL import Image
+        Image.fromarray(rebate_crop_rgb).save(debug_base + "rebate_crop_rgb.jpg")
+
+    #To get the image inside the rebate, use crop_inner_and_find_bright on the rebate crop.
+    inner_crop, bright_mask, avg_rgb, angle, (ix, iy, iw, ih) = crop_inner_and_find_bright(
+        rebate_crop_rgb, rebate_thresh, close1=close1, close2=close2, top_pct=1,
+        lum=lum_norm[ry:ry+rh, rx:rx+rw])
+    print(f"Crop_inner_and_find_bright(rebate_crop_rgb, rebate_thresh, top_pct=1) angle : {angle}", file=sys.stderr)
+    if debug and debug_base:
+        from PIL import Image
+        Image.fromarray(inner_crop).save(debug_base + "_normalized_innercrop_01.jpg")
+
+    if (angle > max_skew) : angle=0
+    crop_rect = (ix+rx, iy+ry, iw, ih)
+    if scale != 1.0:
+        crop_rect = scale_rect_up(crop_rect, scale, w_img, h_img)
+    return ref_rgb, crop_rect, angle
+
+
+@instrument.timed
+def load_frame(image_path: str) -> np.ndarray:
+    """
+    Read a scan as RGB (8- or 16-bit, as stored) and remove the perforations.
+    Returns None if unreadable.
+    """
+    rgb_orig = image_io.read_rgb(image_path)
+    if rgb_orig is None:
+        return None
+    return remove_perforation(rgb_orig)
+
+
+def add_warp_arguments(parser):
+    """Deskew warp flags shared by shape_image.py, pipeline.py, batch.py and watch.py."""
+    parser.add_argument("--interpolation", choices=list(INTERPOLATIONS), default="linear",
+                        help="Interpolation of the deskew warp (default: linear)")
+    parser.add_argument("--min-skew", type=float, default=0.0, metavar="DEGREES",
+                        help="Only crop, without a warp, when the skew angle is at most this (default: 0)")
+
+
 def main():
     p = argparse.ArgumentParser(
         description="Crop scan pipeline with fallbacks.")
     p.add_argument("image_path", help="Path to the scanned frame image")
+    p.add_argument("--profile", help="Roll profile JSON (see roll_profile.py) with a shared blend_color")
+    p.add_argument("--analysis-size", type=int, default=None,
+                   help="Analyse a proxy with this longest edge in pixels (e.g. 1500)")
+    p.add_argument("--intermediate", choices=("png", "raw"), default="png",
+                   help="Hand-off file for invert_image.py: <name>_.png, or <name>_.raw raw pixels "
+                        "memory-mapped by the reader, with no encode/decode (default: png)")
+    add_warp_arguments(p)
     args = p.parse_args()
 
-    bgr = cv2.imread(args.image_path)
-    if bgr is None:
+    profile = None
+    if args.profile:
+        with open(args.profile, 'r') as pf:
+            profile = json.load(pf)
+
+    rgb_orig = load_frame(args.image_path)
+    if rgb_orig is None:
         print(json.dumps({"error": f"Couldn’t open {args.image_path}"}), file=sys.stderr)
         sys.exit(1)
-    rgb_orig = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-    rgb_orig = remove_perforation(rgb_orig)
-  
-    # --- Highlight-based normalization (insert here) ---
-    ref_rgb = mean_rgb_of_top_percent_full(rgb_orig, 3)
-    print(f"Reference RGB for normalization (mean of brightest 3%): {ref_rgb}", file=sys.stderr)
-    # Normalize channels so this mean becomes 254
-    norm = rgb_orig.astype(np.float32)
-    for c in range(3):
-        val = ref_rgb[c]
-        if val > 1:
-            norm[:, :, c] = np.clip((norm[:, :, c] / val) * 254.0, 0, 254)
-        else:
-            norm[:, :, c] = 0
-    rgb_norm = norm.astype(np.uint8)
-  
-    # start processing nor,malized image,
-    
-    # Returns a crop that covers the rebate and the image inside it (rebate included). 
-    # x and y are the coordinates of the rectangle’s top-left corner (in pixels, relative to the image).
-    # w and h are the rectangle’s width and height.  
-    # x, y, w, h = cv2.boundingRect(max(cnts, key=cv2.contourArea))
-    # return rgb[y:y+h, x:x+w], thresh, x, y, w, h
-    
-    rebate_crop_rgb, rebate_thresh, rx, ry, rw, rh  = get_rebate_crop(rgb_norm, pct=90)
-    #_, _, _, angle, _ = crop_inner_and_find_bright(rebate_crop_rgb, rebate_thresh, top_pct=1)
-    if debug:
-        out_path = os.path.splitext(args.image_path)[0] + "rebate_crop_rgb.jpg"
-        Image.fromarray(rebate_crop_rgb).save(out_path)
 
-    #To get the image inside the rebate, use crop_inner_and_find_bright on the rebate crop.
-    inner_crop, bright_mask, avg_rgb, angle, (ix, iy, iw, ih) = crop_inner_and_find_bright(rebate_crop_rgb, rebate_thresh, top_pct=1)
-    print(f"Crop_inner_and_find_bright(rebate_crop_rgb, rebate_thresh, top_pct=1) angle : {angle}", file=sys.stderr)
-    if debug:
-        out_path = os.path.splitext(args.image_path)[0] + "_normalized_innercrop_01.jpg"
-        Image.fromarray(inner_crop).save(out_path)
-
-    if (angle > 20) : angle=0
-   
-    final_img = apply_crop_and_deskew(rgb_orig, (ix+rx, iy+ry, iw, ih), angle)
-    out_path = os.path.splitext(args.image_path)[0] + "_.png"
-    Image.fromarray(final_img).save(out_path, format="PNG")
-
-    # end 
-    
+    profile_rgb = None
+    if profile:
+        # in this frame's scale, also for a profile measured at another bit depth
+        bc = profile["blend_color"]
+        profile_rgb = image_io.rescale_levels([bc["r"], bc["g"], bc["b"]], profile.get("bits"),
+                                              rgb_orig.dtype).tolist()
+    ref_rgb, crop_rect, angle = analyze_frame(rgb_orig, os.path.splitext(args.image_path)[0], ref_rgb=profile_rgb,
+                                              analysis_size=args.analysis_size)
+
+    final_img = apply_crop_and_deskew(rgb_orig, crop_rect, angle, interpolation=args.interpolation,
+                                      min_skew=args.min_skew)
+    out_path = os.path.splitext(args.image_path)[0] + "_." + args.intermediate
+    if args.intermediate == "raw":
+        raw = image_io.write_raw(out_path, final_img)
+    else:
+        # zlib level 1: the intermediate is read once and deleted, ~3x faster to encode than the default
+        image_io.write_rgb(out_path, final_img, format="PNG", compress_level=1)
+
+    # end
+
     result = {
         "image_path": out_path,
         "blend_color": {"r": ref_rgb[0], "g": ref_rgb[1], "b": ref_rgb[2]},
         "skew_angle": angle,
         "delete_after_use": True
     }
+    if args.intermediate == "raw":
+        result["raw"] = raw
+    if profile and "white_balance" in profile:
+        wb = profile["white_balance"]
+        result["white_balance"] = {key: image_io.rescale_levels(wb[key], profile.get("bits"), rgb_orig.dtype)
+                                   .round().astype(int).tolist() for key in ("bright", "dark")}
     print(json.dumps(result))
 
 if __name__ == "__main__":
     main()
-  
@@ -0,0 +1,114 @@
+"""
+Strip mode: several frames in one capture.
+
+When a whole 35 mm strip (or a 6x17 / sheet holder) is shot in one exposure,
+the capture is decoded and cleaned once, the blend colour is measured once on
+the shared rebate, every image area is found in one contour pass
+(shape_image.find_frames), and each frame is deskewed about its own centre,
+cropped, inverted and written in a thread of its own.
+
+Frames are written as <name>_inverted_1.png, <name>_inverted_2.png, ...
+(or the extension of the output format) in strip order (left to right, or
+top to bottom).
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import image_io
+import image_stats
+import invert_image
+import pipeline
+import shape_image
+
+
+def extract_frame(rgb: np.ndarray, crop_rect, angle: float, interpolation: str = "linear",
+                  min_skew: float = 0.0) -> np.ndarray:
+    """
+    Deskew one frame about the centre of its crop rectangle and crop it, in
+    one warp whose output is only the rectangle. Frames far from the centre
+    of a strip would drift if the whole capture were rotated about its centre.
+    Below min_skew degrees the frame is only sliced.
+    """
+    x, y, w, h = crop_rect
+    if abs(angle) <= min_skew:
+        return rgb[y:y+h, x:x+w]
+    white = image_io.max_value(rgb)
+    M = cv2.getRotationMatrix2D((x + w / 2.0, y + h / 2.0), angle, 1.0)
+    M[0, 2] -= x
+    M[1, 2] -= y
+    return cv2.warpAffine(rgb, M, (w, h), flags=shape_image.INTERPOLATIONS[interpolation],
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=(white, white, white))
+
+
+def analyze_strip(rgb_orig: np.ndarray, ref_rgb=None, analysis_size: int = None, max_frames: int = 6):
+    """
+    Shape analysis of a multi-frame capture (perforations already removed).
+    Returns the blend colour shared by all frames and [(angle, crop_rect)]
+    in strip order, in full-resolution coordinates.
+    """
+    h_img, w_img = rgb_orig.shape[:2]
+    proxy, scale = shape_image.make_proxy(rgb_orig, analysis_size)
+    ksz, close1, close2 = (shape_image.scale_kernel(k, scale) for k in (15, 15, 25))
+
+    if ref_rgb is None:
+        ref_rgb = shape_image.mean_rgb_of_top_percent_full(proxy, 3)
+    ref_rgb = np.asarray(ref_rgb, dtype=float)
+    rgb_norm = shape_image.normalize_to_reference(proxy, ref_rgb)
+    lum_norm = image_stats.luminance_sum(rgb_norm)
+    _, rebate_thresh, rx, ry, rw, rh = shape_image.get_rebate_crop(rgb_norm, pct=90, ksz=ksz, min_area_frac=0.5,
+                                                                   lum=lum_norm)
+    found = shape_image.find_frames(lum_norm[ry:ry+rh, rx:rx+rw], rebate_thresh, close1=close1, close2=close2,
+                                    max_frames=max_frames)
+    frames = []
+    for angle, (x, y, w, h) in found:
+        crop_rect = (x + rx, y + ry, w, h)
+        if scale != 1.0:
+            crop_rect = shape_image.scale_rect_up(crop_rect, scale, w_img, h_img)
+        frames.append((angle, crop_rect))
+    return ref_rgb, frames
+
+
+def process_strip_file(image_path: str, autocontrast: bool = False, profile: dict = None,
+                       analysis_size: int = None, max_frames: int = 6, workers: int = None,
+                       output_format: str = "png", params: dict = None, interpolation: str = "linear",
+                       min_skew: float = 0.0) -> dict:
+    """
+    Split, invert and write every frame of a strip capture. Returns one result
+    record for the capture with a 'frames' list (crop_rect, skew_angle,
+    output_path, encode_seconds per frame). params are image_io.write_timed
+    arguments (see image_io.output_params).
+    """
+    params = params or image_io.output_params(output_format)
+    rgb = image_io.read_rgb(image_path)
+    if rgb is None:
+        raise IOError(f"Couldn’t open {image_path}")
+    h, w = rgb.shape[:2]
+    profile_rgb, wb_levels = pipeline.profile_values(profile, rgb.dtype)
+    rgb = shape_image.remove_perforation(rgb)
+    blend_color, frames = analyze_strip(rgb, ref_rgb=profile_rgb, analysis_size=analysis_size,
+                                        max_frames=max_frames)
+    if not frames:
+        raise ValueError(f"No frames found in {image_path}")
+
+    def run(index, angle, crop_rect):
+        out_path = pipeline.output_path_for(image_path, index, output_format)
+        cropped = extract_frame(rgb, crop_rect, angle, interpolation=interpolation, min_skew=min_skew)
+        positive = invert_image.invert_array(cropped, blend_color, autocontrast=autocontrast, wb_levels=wb_levels)
+        encode_seconds = image_io.write_timed(out_path, positive, **params)
+        return {"crop_rect": [int(v) for v in crop_rect], "skew_angle": angle, "output_path": out_path,
+                "encode_seconds": encode_seconds}
+
+    # OpenCV, the lookup tables and the PNG encoder release the GIL
+    with ThreadPoolExecutor(max_workers=workers or min(len(frames), os.cpu_count() or 1)) as pool:
+        futures = [pool.submit(run, i + 1, angle, rect) for i, (angle, rect) in enumerate(frames)]
+        results = [f.result() for f in futures]
+
+    return {
+        "blend_color": {"r": blend_color[0], "g": blend_color[1], "b": blend_color[2]},
+        "input_size": [w, h],
+        "frames": results,
+        "image_path": image_path,
+    }
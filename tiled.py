@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Tiled inversion for very large scans with bounded memory.
+
+Once the global statistics are known every invert_image stage is a
+per-channel lookup (see invert_image.build_invert_lut), so the frame is read
+in horizontal strips, each strip is mapped and the result is streamed to a
+PNG or uncompressed TIFF encoder strip by strip. The statistics themselves
+(white balance levels, auto contrast limits) are accumulated over the same
+strips in a few read passes.
+
+Uncompressed inputs (.npy, raw TIFF/PPM/BMP) are memory-mapped, so peak memory
+is set by the tile budget. Compressed inputs (JPEG, PNG, LZW TIFF) cannot be
+read partially and are decoded once; only that buffer is full-size.
+Both 8-bit and 16-bit frames are supported.
+
+For pipeline.py --tile-mb the shape analysis works the same way:
+PerforationSource removes perforations strip by strip, make_proxy builds the
+analysis proxy from strips, and WarpSource crops and deskews each strip as
+it is read. The full-size frame is never held in memory beyond the decoded
+input, if any.
+"""
+import argparse
+import json
+import os
+import struct
+import sys
+import zlib
+
+import cv2
+import numpy as np
+
+import image_io
+import image_stats
+import instrument
+import invert_image
+import shape_image
+
+
+class ArraySource:
+    """Strip reader over an in-memory or memory-mapped (H, W, 3) array."""
+
+    def __init__(self, array: np.ndarray):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+    def read(self, y0: int, y1: int) -> np.ndarray:
+        # always a copy: strips are mapped in place
+        return np.array(self.array[y0:y1])
+
+
+class RawTileSource:
+    """Strip reader memory-mapping the raw RGB tiles of an uncompressed image file."""
+
+    def __init__(self, path: str, im):
+        w, h = im.size
+        self.shape = (h, w, 3)
+        self.dtype = np.dtype(np.uint8)
+        self.tiles = []
+        for tile in im.tile:
+            _, (x0, ty0, x1, ty1), offset, args = tile
+            rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else (tuple(args) + (0, 1))[:3]
+            stride = stride or w * 3
+            rows = ty1 - ty0
+            mm = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(rows, stride))
+            view = mm[:, :w * 3].reshape(rows, w, 3)
+            if orientation == -1:
+                view = view[::-1]
+            if rawmode == 'BGR':
+                view = view[..., ::-1]
+            self.tiles.append((ty0, ty1, view))
+
+    @staticmethod
+    def supports(im) -> bool:
+        if im.mode != 'RGB' or not im.tile:  # 8-bit RGB only
+            return False
+        for codec, (x0, _, x1, _), _, args in im.tile:
+            rawmode = args if isinstance(args, str) else args[0]
+            if codec != 'raw' or rawmode not in ('RGB', 'BGR') or (x0, x1) != (0, im.size[0]):
+                return False
+        return True
+
+    def read(self, y0: int, y1: int) -> np.ndarray:
+        out = np.empty((y1 - y0,) + self.shape[1:], dtype=np.uint8)
+        for ty0, ty1, view in self.tiles:
+            a, b = max(y0, ty0), min(y1, ty1)
+            if a < b:
+                out[a - y0:b - y0] = view[a - ty0:b - ty0]
+        return out
+
+
+def open_source(path: str):
+    """Open an image file as a strip source, memory-mapped where the format allows."""
+    if path.lower().endswith('.npy'):
+        return ArraySource(np.load(path, mmap_mode='r'))
+    from PIL import Image
+    im = Image.open(path)
+    if RawTileSource.supports(im):
+        return RawTileSource(path, im)
+    rgb = image_io.read_rgb(path)
+    if rgb is None:
+        raise IOError(f"Couldn’t open {path}")
+    return ArraySource(rgb)
+
+
+class PerforationSource:
+    """
+    Strip reader removing the perforations of another source
+    (shape_image.remove_perforation). Each strip is read with `radius` extra
+    rows on both sides, so the dilation matches the whole-frame one.
+    """
+
+    def __init__(self, source, radius: int = 15):
+        self.source = source
+        self.shape = source.shape
+        self.dtype = source.dtype
+        self.radius = radius
+
+    def read(self, y0: int, y1: int) -> np.ndarray:
+        a, b = max(0, y0 - self.radius), min(self.shape[0], y1 + self.radius)
+        strip = shape_image.remove_perforation(self.source.read(a, b), dilation_radius=self.radius)
+        return strip[y0 - a:y1 - a]
+
+
+class WarpSource:
+    """
+    Strip reader over the crop and deskew of another source
+    (shape_image.apply_crop_and_deskew). Each output strip is warped from
+    the source rows its pixels come from, so no full-size frame is built.
+    """
+
+    MARGIN = 5  # source rows read beyond a strip's footprint, for the interpolation kernel (lanczos: 4)
+
+    def __init__(self, source, crop_rect, angle: float, interpolation: str = "linear", min_skew: float = 0.0):
+        x, y, w, h = (int(v) for v in crop_rect)
+        self.source = source
+        self.rect = (x, y, w, h)
+        self.shape = (h, w, 3)
+        self.dtype = source.dtype
+        self.flags = shape_image.INTERPOLATIONS[interpolation]
+        self.M = None
+        if abs(angle) > min_skew:
+            h_img, w_img = source.shape[:2]
+            M = cv2.getRotationMatrix2D((w_img / 2.0, h_img / 2.0), angle, 1.0)
+            M[0, 2] -= x
+            M[1, 2] -= y
+            self.M = M
+            self.inverse = cv2.invertAffineTransform(M)
+
+    def read(self, y0: int, y1: int) -> np.ndarray:
+        x, y, w, h = self.rect
+        if self.M is None:
+            return np.array(self.source.read(y + y0, y + y1)[:, x:x + w])
+        # source rows under the strip's corners, with room for the kernel
+        corners = np.array([[0, y0, 1], [w, y0, 1], [0, y1, 1], [w, y1, 1]], dtype=float)
+        rows = corners @ self.inverse[1]
+        sy0 = max(0, int(np.floor(rows.min())) - self.MARGIN)
+        sy1 = min(self.source.shape[0], int(np.ceil(rows.max())) + self.MARGIN)
+        M = self.M.copy()
+        M[:, 2] += M[:, 1] * sy0   # the strip starts at source row sy0 ...
+        M[1, 2] -= y0              # ... and the output at row y0
+        white = int(np.iinfo(self.dtype).max)
+        if sy1 <= sy0:   # the strip lies wholly outside the frame
+            return np.full((y1 - y0, w, 3), white, dtype=self.dtype)
+        return cv2.warpAffine(self.source.read(sy0, sy1), M, (w, y1 - y0), flags=self.flags,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=(white, white, white))
+
+
+def make_proxy(source, longest_edge: int, rows: int):
+    """
+    shape_image.make_proxy of a strip source without reading it whole: the
+    frame is reduced by an integer factor f, each strip (a multiple of f
+    rows) averaged over f x f blocks. Up to f - 1 rows and columns at the
+    bottom and right edges are left out. Returns the proxy and its scale 1 / f.
+    """
+    h, w = source.shape[:2]
+    f = max(1, -(-max(h, w) // longest_edge))
+    rows = max(f, rows - rows % f)
+    ph, pw = h // f, w // f
+    proxy = np.empty((ph, pw, 3), dtype=source.dtype)
+    for y0 in range(0, ph * f, rows):
+        y1 = min(ph * f, y0 + rows)
+        strip = source.read(y0, y1)[:, :pw * f]
+        proxy[y0 // f:y1 // f] = strip if f == 1 else cv2.resize(strip, (pw, (y1 - y0) // f),
+                                                                   interpolation=cv2.INTER_AREA)
+    return proxy, 1.0 / f
+
+
+def strip_rows(width: int, tile_mb: float, dtype=np.uint8) -> int:
+    """Rows per strip so that one strip's working set fits the tile budget."""
+    itemsize = np.dtype(dtype).itemsize
+    # input and output strips, luminance sum, float64 gray level for the contrast histogram
+    bytes_per_pixel = 3 * itemsize * 2 + 2 * itemsize + 8
+    return max(1, int(tile_mb * 1024 * 1024) // (width * bytes_per_pixel))
+
+
+def iter_strips(source, rows: int):
+    h = source.shape[0]
+    for y0 in range(0, h, rows):
+        yield source.read(y0, min(h, y0 + rows))
+
+
+# --- Streaming encoders ---
+
+class PNGStripWriter:
+    """Writes an 8- or 16-bit RGB PNG strip by strip (Paeth filter, zlib stream)."""
+
+    def __init__(self, path: str, width: int, height: int, compress_level: int = 6, bits: int = 8):
+        self.f = open(path, 'wb')
+        self.width = width
+        self.bits = bits
+        self.bpp = 3 * bits // 8  # bytes per pixel, the Paeth "left" distance
+        self.z = zlib.compressobj(compress_level)
+        self.prev = np.zeros((width * self.bpp,), dtype=np.uint8)
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bits, 2, 0, 0, 0))
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(kind)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+    def write(self, strip: np.ndarray):
+        if self.bits == 16:
+            strip = strip.astype('>u2').view(np.uint8)  # PNG samples are big-endian
+        rows = strip.reshape(strip.shape[0], -1)
+        up = np.vstack([self.prev[None, :], rows[:-1]])
+        self.prev = rows[-1].copy()
+        # Paeth predictor on bytes, computed on the original (unfiltered) neighbours
+        n = self.bpp
+        a = np.zeros_like(rows, dtype=np.int16)
+        a[:, n:] = rows[:, :-n]
+        b = up.astype(np.int16)
+        c = np.zeros_like(a)
+        c[:, n:] = up[:, :-n]
+        p = a + b - c
+        pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+        pred = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+        filtered = (rows.astype(np.int16) - pred).astype(np.uint8)
+        out = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        out[:, 0] = 4  # filter type: Paeth
+        out[:, 1:] = filtered
+        data = self.z.compress(out.tobytes())
+        if data:
+            self._chunk(b'IDAT', data)
+
+    def close(self):
+        self._chunk(b'IDAT', self.z.flush())
+        self._chunk(b'IEND', b'')
+        self.f.close()
+
+
+class TIFFStripWriter:
+    """Writes an uncompressed RGB TIFF, one TIFF strip per written strip."""
+
+    def __init__(self, path: str, width: int, height: int, rows_per_strip: int, bits: int = 8):
+        self.f = open(path, 'wb')
+        self.width, self.height = width, height
+        self.rows_per_strip = rows_per_strip
+        self.bits = bits
+        self.offsets, self.counts = [], []
+        # header; the IFD offset is patched in close()
+        self.f.write(b'II*\x00\x00\x00\x00\x00')
+
+    def write(self, strip: np.ndarray):
+        self.offsets.append(self.f.tell())
+        data = strip.astype('<u%d' % (self.bits // 8), copy=False).tobytes()
+        self.counts.append(len(data))
+        self.f.write(data)
+
+    def close(self):
+        f = self.f
+        if f.tell() % 2:
+            f.write(b'\x00')
+        n = len(self.offsets)
+        bits_at = f.tell()
+        f.write(struct.pack('<3H', self.bits, self.bits, self.bits))
+        offsets_at = f.tell()
+        f.write(struct.pack('<%dI' % n, *self.offsets))
+        counts_at = f.tell()
+        f.write(struct.pack('<%dI' % n, *self.counts))
+        ifd_at = f.tell()
+        SHORT, LONG = 3, 4
+        entries = [
+            (256, LONG, 1, self.width),
+            (257, LONG, 1, self.height),
+            (258, SHORT, 3, bits_at),
+            (259, SHORT, 1, 1),          # no compression
+            (262, SHORT, 1, 2),          # RGB
+            (273, LONG, n, offsets_at if n > 1 else self.offsets[0]),
+            (277, SHORT, 1, 3),
+            (278, LONG, 1, self.rows_per_strip),
+            (279, LONG, n, counts_at if n > 1 else self.counts[0]),
+            (284, SHORT, 1, 1),          # chunky
+        ]
+        f.write(struct.pack('<H', len(entries)))
+        for tag, typ, count, value in entries:
+            if typ == SHORT and count == 1:
+                f.write(struct.pack('<HHIHH', tag, typ, count, value, 0))
+            else:
+                f.write(struct.pack('<HHII', tag, typ, count, value))
+        f.write(struct.pack('<I', 0))
+        f.seek(4)
+        f.write(struct.pack('<I', ifd_at))
+        f.close()
+
+
+def open_writer(path: str, width: int, height: int, rows: int, compress_level: int = 6, dtype=np.uint8):
+    bits = 8 * np.dtype(dtype).itemsize
+    if path.lower().endswith(('.tif', '.tiff')):
+        return TIFFStripWriter(path, width, height, rows, bits)
+    return PNGStripWriter(path, width, height, compress_level, bits)
+
+
+# --- Tiled inversion ---
+
+def white_balance_levels_tiled(source, lut: np.ndarray, rows: int, bright_pct: float, dark_pct: float):
+    """invert_image.white_balance_levels of the LUT-mapped source, in two strip passes."""
+    hist = np.zeros(image_stats.luminance_levels(source.dtype), dtype=np.int64)
+    for strip in iter_strips(source, rows):
+        hist += image_stats.histogram(image_stats.luminance_sum(invert_image.apply_lut(strip, lut)), len(hist))
+    bright_th, dark_th = invert_image.white_balance_thresholds(hist, bright_pct, dark_pct)
+
+    min_vals = np.full(3, np.iinfo(source.dtype).max, dtype=source.dtype)
+    max_vals = np.zeros(3, dtype=source.dtype)
+    for strip in iter_strips(source, rows):
+        mapped = invert_image.apply_lut(strip, lut)
+        lum = image_stats.luminance_sum(mapped)
+        bright_vals = mapped[lum >= bright_th]
+        dark_vals = mapped[lum <= dark_th]
+        if len(bright_vals):
+            min_vals = np.minimum(min_vals, bright_vals.min(axis=0))
+        if len(dark_vals):
+            max_vals = np.maximum(max_vals, dark_vals.max(axis=0))
+    return min_vals, max_vals
+
+
+def contrast_limits_tiled(source, lut: np.ndarray, rows: int, clip_pct: float):
+    hist = np.zeros(np.iinfo(source.dtype).max + 1, dtype=np.int64)
+    for strip in iter_strips(source, rows):
+        hist += invert_image.gray_histogram(invert_image.apply_lut(strip, lut))
+    return invert_image.contrast_limits(hist, clip_pct)
+
+
+@instrument.timed
+def invert_tiled(source, out_path: str, blend_color: np.ndarray,
+                 autocontrast: bool = False,
+                 bright_pct: float = 99.99,
+                 dark_pct: float = 0.1,
+                 clip_pct: float = 0.01,
+                 wb_levels=None,
+                 tile_mb: float = 64,
+                 compress_level: int = 6) -> str:
+    """
+    Same result as invert_image.invert_array, computed strip by strip with
+    at most ~tile_mb MB of working memory, and streamed to out_path
+    (.png or .tif).
+    """
+    if isinstance(source, np.ndarray):
+        source = ArraySource(source)
+    h, w = source.shape[:2]
+    rows = strip_rows(w, tile_mb, source.dtype)
+
+    lut = invert_image.build_invert_lut(np.asarray(blend_color, dtype=float), source.dtype)
+    if wb_levels is None:
+        wb_levels = white_balance_levels_tiled(source, lut, rows, bright_pct, dark_pct)
+    lut = invert_image.compose_white_balance_lut(lut, wb_levels)
+    if autocontrast:
+        lut = invert_image.compose_auto_contrast_lut(lut, contrast_limits_tiled(source, lut, rows, clip_pct))
+
+    writer = open_writer(out_path, w, h, rows, compress_level, source.dtype)
+    try:
+        for strip in iter_strips(source, rows):
+            writer.write(invert_image.apply_lut(strip, lut, out=strip))
+    finally:
+        writer.close()
+    return out_path
+
+
+def main():
+    """Same JSON config as invert_image.py, processed in strips."""
+    parser = argparse.ArgumentParser(
+        description="Invert a large scan strip by strip with bounded memory (invert_image.py JSON config).")
+    parser.add_argument("config_path", help="Path to JSON config file")
+    parser.add_argument("--tile-mb", type=float, default=64, help="Working memory budget per strip in MB (default: 64)")
+    parser.add_argument("--tiff", action="store_true", help="Write an uncompressed TIFF instead of PNG")
+    args = parser.parse_args()
+
+    with open(args.config_path, 'r') as cf:
+        config = json.load(cf)
+    image_path = config.get('image_path')
+    blend_color = invert_image.parse_blend_color(config.get('blend_color'))
+    if not image_path or blend_color is None:
+        print("Config missing 'image_path' or valid 'blend_color'.", file=sys.stderr)
+        sys.exit(1)
+
+    base, _ = os.path.splitext(image_path)
+    out_path = base + ("inverted.tif" if args.tiff else "inverted.png")
+    raw = config.get('raw')
+    source = ArraySource(image_io.open_raw(image_path, raw['shape'], raw['dtype'])) if raw else open_source(image_path)
+    invert_tiled(source, out_path, blend_color,
+                 autocontrast=config.get('autocontrast', False),
+                 wb_levels=invert_image.parse_wb_levels(config.get('white_balance'), source.dtype),
+                 tile_mb=args.tile_mb)
+    print(f"Tiled output saved as {out_path}")
+    del source  # release a raw memory map before the file is deleted
+
+    if config.get("delete_after_use", False) and os.path.exists(image_path):
+        os.remove(image_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Watch a folder during tethered capture and convert every new frame.
+
+Replaces the watch_and_invert.py flow (two fresh interpreters per file and a
+fixed 2-second delay): the pipeline runs in a persistent pool of worker
+processes that import NumPy/OpenCV once, a file counts as complete once its
+size and mtime have stopped changing, and at most --workers frames are in
+flight while further arrivals wait in a FIFO queue. Each finished frame
+reports its latency from arrival to output written. With --async-write a
+worker takes the next frame while a writer thread encodes the previous one.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import batch
+
+
+class FolderWatcher:
+    """
+    Polls a folder and reports image files whose size and mtime have been
+    stable for `settle` seconds. Each file is reported once.
+    """
+
+    def __init__(self, folder: str, settle: float = 0.3, include_existing: bool = False):
+        self.folder = folder
+        self.settle = settle
+        self.seen = {}        # path -> (size, mtime, first seen, last change)
+        self.reported = set()
+        if not include_existing:
+            self.reported.update(self._scan())
+
+    def _scan(self):
+        paths = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                name = entry.name.lower()
+                if entry.is_file() and name.endswith(batch.IMAGE_EXTENSIONS) and "_inverted" not in name \
+                        and not name.rsplit(".", 1)[0].endswith("_preview"):
+                    paths.append(entry.path)
+        return paths
+
+    def poll(self, now: float = None):
+        """Return [(path, arrival_time)] for files that just finished writing."""
+        now = time.time() if now is None else now
+        ready = []
+        for path in self._scan():
+            if path in self.reported:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # renamed or deleted in between
+            prev = self.seen.get(path)
+            if prev is None:
+                self.seen[path] = (st.st_size, st.st_mtime, now, now)
+                continue
+            size, mtime, arrival, changed = prev
+            if (st.st_size, st.st_mtime) != (size, mtime):
+                self.seen[path] = (st.st_size, st.st_mtime, arrival, now)
+            elif st.st_size > 0 and now - changed >= self.settle:
+                del self.seen[path]
+                self.reported.add(path)
+                ready.append((path, arrival))
+        return ready
+
+
+def _init_worker(written=None):
+    # Import the heavy modules once per worker so frames start warm.
+    import pipeline  # noqa: F401
+    batch.init_writer(written)
+
+
+def _run_frame(image_path: str, options: dict):
+    import pipeline
+    start = time.perf_counter()
+    result = pipeline.process_file(image_path, writer=batch.writer, **options)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def watch(folder: str, workers: int = 2, interval: float = 0.1, settle: float = 0.3,
+          include_existing: bool = False, options: dict = None, async_write: bool = False):
+    """
+    Watch a folder forever (until KeyboardInterrupt), yielding one result dict
+    per converted frame with 'latency' = arrival to output written, in seconds.
+    async_write frees a worker for the next frame while its output is encoded.
+    """
+    import pipeline
+
+    options = options or {}
+    first_output = 1 if options.get("strip") else None   # strip captures: <name>_inverted_1.png
+    output_format = options.get("output_format", "png")
+    watcher = FolderWatcher(folder, settle=settle, include_existing=include_existing)
+    tracker = batch.WriteTracker() if async_write else None
+    initargs = (tracker.written,) if tracker else ()
+    queue = deque()
+    inflight = {}
+    arrivals = {}   # image_path -> arrival time, until the frame is written
+    claims = {}     # output key (batch.output_key) -> image_path queued or in flight that writes it
+
+    def output_key(path):
+        return batch.output_key(pipeline.output_path_for(path, first_output, output_format))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as pool:
+        # start the workers now rather than on the first frame
+        for f in [pool.submit(_init_worker) for _ in range(workers)]:
+            f.result()
+        print(f"Watching {folder} with {workers} warm workers", file=sys.stderr)
+        while True:
+            # f2.jpg before f2.png when both settle in the same poll, as in invert_folder.bat
+            for path, arrival in sorted(watcher.poll(), key=lambda item: batch.extension_rank(item[0])):
+                key = output_key(path)
+                owner = claims.get(key)
+                reason = batch.skip_reason(path) or (f"output claimed by {owner}" if owner else None) or \
+                    batch.skip_reason(path, pipeline.output_path_for(path, first_output, output_format))
+                if reason:
+                    print(f"   Skipping: {path}: {reason}", file=sys.stderr)
+                else:
+                    claims[key] = path
+                    queue.append((path, arrival))
+            while queue and len(inflight) < workers:
+                path, arrival = queue.popleft()
+                inflight[pool.submit(_run_frame, path, options)] = path
+                arrivals[path] = arrival
+
+            finished = []
+            if inflight:
+                done, _ = wait(inflight, timeout=interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = inflight.pop(future)
+                    try:
+                        result = future.result()
+                        if tracker:
+                            result = tracker.add(result)
+                    except Exception as e:
+                        result = {"image_path": path, "error": str(e)}
+                    if result:
+                        finished.append(result)
+            if tracker and tracker.waiting:
+                finished += tracker.poll(timeout=0 if inflight else interval)
+            elif not inflight:
+                time.sleep(interval)
+            for result in finished:
+                # written (or failed): a later scan with the same name meets the existing output instead
+                claims.pop(output_key(result["image_path"]), None)
+                result["latency"] = time.time() - arrivals.pop(result["image_path"])
+                result["queued"] = len(queue)
+                yield result
+
+
+def main():
+    import pipeline
+
+    p = argparse.ArgumentParser(
+        description="Watch a folder and convert new scans with a warm worker pool.")
+    p.add_argument("folder", help="Folder to watch")
+    p.add_argument("-j", "--workers", type=int, default=2, help="Frames processed concurrently (default: 2)")
+    p.add_argument("--interval", type=float, default=0.1, help="Poll interval in seconds (default: 0.1)")
+    p.add_argument("--settle", type=float, default=0.3,
+                   help="Seconds a file's size/mtime must stay unchanged before it is processed (default: 0.3)")
+    p.add_argument("--existing", action="store_true", help="Also convert frames already in the folder")
+    p.add_argument("--autocontrast", action="store_true", help="Apply auto contrast after white balance")
+    p.add_argument("--profile", help="Roll profile JSON from roll_profile.py")
+    p.add_argument("--analysis-size", type=int, default=None,
+                   help="Run crop/skew analysis on a proxy with this longest edge in pixels (e.g. 1500)")
+    p.add_argument("--tile-mb", type=float, default=None,
+                   help="Analyse, crop and invert in strips within this memory budget in MB (for very large scans)")
+    pipeline.add_timing_arguments(p)
+    pipeline.add_cache_arguments(p)
+    pipeline.add_strip_arguments(p)
+    pipeline.add_warp_arguments(p)
+    pipeline.add_output_arguments(p)
+    pipeline.add_thread_arguments(p)
+    p.add_argument("--async-write", action="store_true",
+                   help="Encode each output in a writer thread while the worker takes the next frame")
+    args = p.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print(f"Folder does not exist: {args.folder}", file=sys.stderr)
+        sys.exit(1)
+
+    options = {"autocontrast": args.autocontrast, "analysis_size": args.analysis_size, "tile_mb": args.tile_mb}
+    options.update(pipeline.timing_options(args))
+    options.update(pipeline.cache_options(args))
+    options.update(pipeline.strip_options(args))
+    options.update(pipeline.warp_options(args))
+    options.update(pipeline.output_options(args))
+    options["threads"] = args.threads
+    if args.profile:
+        import roll_profile
+        options["profile"] = roll_profile.load_profile(args.profile)
+
+    timed_results = []
+    try:
+        for result in watch(args.folder, workers=args.workers, interval=args.interval, settle=args.settle,
+                            include_existing=args.existing, options=options, async_write=args.async_write):
+            if "error" in result:
+                print(json.dumps(result), file=sys.stderr)
+                continue
+            encode = result.get("encode_seconds", sum(f.get("encode_seconds", 0) for f in result.get("frames", ())))
+            print(f"   Done: {result['image_path']} in {result['seconds']:.2f} s, encode {encode:.2f} s,"
+                  f" latency {result['latency']:.2f} s", file=sys.stderr)
+            print(json.dumps(result), flush=True)
+            if "timings" in result:
+                timed_results.append(result)
+    except KeyboardInterrupt:
+        print("Stopped.", file=sys.stderr)
+    if timed_results:
+        import instrument
+        print(instrument.format_summary(instrument.summarize(timed_results)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()